@@ -5,11 +5,38 @@ This allows n8n to execute the query_kv_cache.sh and create_kv_cache.sh scripts
 """
 
 import os
+import re
+import shlex
 import subprocess
 import json
 import logging
+import time
+import codecs
 import shutil
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import hashlib
+import uuid
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import metrics
+import timings
+from db import Database
+from worker_pool import WorkerPool, WorkerError
+from kv_residency import KVResidencyCache
+from response_cache import ResponseCache
+from master_cache import MasterCache, materialize
+from context_size import ContextSizer
+from prefix_snapshots import PrefixSnapshots, DEFAULT_TEMPLATE
+from routing_index import RoutingIndex
+from cold_storage import ColdStorage
+from tiered_storage import TieredStorage
+from eviction import CacheEvictor
+from prefetch import CachePrefetcher
+from usage_stats import UsageRecorder
+from jobs import JobRegistry, JobCancelled
+from scheduler import JobScheduler, QueueFullError, QUERY, BUILD
 
 # Configure logging
 logging.basicConfig(
@@ -26,6 +53,298 @@ CREATE_SCRIPT_PATH = '/usr/local/bin/cag-scripts/create_kv_cache.sh'  # Path to
 MAX_CONTEXT = os.environ.get('LLAMACPP_MAX_CONTEXT', '128000')
 THREADS = os.environ.get('LLAMACPP_THREADS', '4')
 BATCH_SIZE = os.environ.get('LLAMACPP_BATCH_SIZE', '1024')
+# Memory-map the model read-only so workers and script processes share it through the page
+# cache (the scripts read the same variable); false loads it into private memory per process
+USE_MMAP = os.environ.get('LLAMACPP_MMAP', 'true').lower() == 'true'
+LLAMACPP_PATH = os.environ.get('LLAMACPP_PATH', '/usr/local/llamacpp')
+LLAMACPP_SERVER_BIN = os.environ.get('LLAMACPP_SERVER_BIN', os.path.join(LLAMACPP_PATH, 'build', 'bin', 'llama-server'))
+
+# Persistent inference workers (0 disables the pool and runs the query script per request)
+WORKER_POOL_SIZE = int(os.environ.get('CAG_WORKER_POOL_SIZE', '1'))
+WORKER_THREADS = os.environ.get('CAG_WORKER_THREADS', THREADS)
+WORKER_RESTART_ON_CRASH = os.environ.get('CAG_WORKER_RESTART_ON_CRASH', 'true').lower() == 'true'
+WORKER_BASE_PORT = int(os.environ.get('CAG_WORKER_BASE_PORT', '8100'))
+WORKER_SLOT_DIR = os.environ.get('CAG_WORKER_SLOT_DIR', '/dev/shm/cag_slots')
+
+# Batched decoding: concurrent queries on the same KV cache arriving within the window share
+# a worker, one slot each (1 disables batching; every slot reserves a full MAX_CONTEXT)
+QUERY_BATCH_MAX = int(os.environ.get('CAG_QUERY_BATCH_MAX', '1'))
+QUERY_BATCH_WINDOW_MS = float(os.environ.get('CAG_QUERY_BATCH_WINDOW_MS', '20'))
+
+# RAM residency for KV caches restored by the workers (copies live in WORKER_SLOT_DIR)
+KV_RESIDENT_BUDGET_MB = int(os.environ.get('CAG_KV_RESIDENT_BUDGET_MB', '2048'))
+PIN_MASTER_CACHE = os.environ.get('CAG_PIN_MASTER_CACHE', 'false').lower() == 'true'
+
+# Tokens of context added on top of cached tokens + prompt + maxTokens when sizing script queries
+QUERY_CTX_MARGIN = int(os.environ.get('CAG_QUERY_CTX_MARGIN', '256'))
+
+# Query prompt template ({query} marks the question; \n is a newline). The text before {query}
+# is prefilled once per KV cache into a snapshot so queries only evaluate the rest
+QUERY_TEMPLATE = os.environ.get('CAG_QUERY_TEMPLATE', DEFAULT_TEMPLATE).replace('\\n', '\n')
+PREFIX_SNAPSHOTS = os.environ.get('CAG_PREFIX_SNAPSHOTS', 'true').lower() == 'true'
+PREFIX_SNAPSHOT_DIR = os.environ.get('CAG_PREFIX_SNAPSHOT_DIR',
+                                     os.path.join(os.path.dirname(MASTER_KV_CACHE), 'prefix_snapshots'))
+# Disk for snapshots, which are about as large as their caches (least recently used go first; 0 = no limit)
+PREFIX_SNAPSHOT_BUDGET_MB = int(os.environ.get('CAG_PREFIX_SNAPSHOT_BUDGET_MB', '8192'))
+
+# Old master cache versions kept after a promotion (in-use versions are always kept until released)
+MASTER_KEEP_VERSIONS = int(os.environ.get('CAG_MASTER_KEEP_VERSIONS', '0'))
+
+# Background KV cache builds
+BUILD_WORKERS = int(os.environ.get('CAG_BUILD_WORKERS', '1'))
+MAX_QUEUED_BUILDS = int(os.environ.get('CAG_MAX_QUEUED_BUILDS', '16'))
+JOB_RETENTION = float(os.environ.get('CAG_JOB_RETENTION', '86400'))
+# Link an existing cache built from identical text with the same model instead of prefilling again
+REUSE_UNCHANGED_BUILDS = os.environ.get('CAG_REUSE_UNCHANGED_BUILDS', 'true').lower() == 'true'
+# Extend a document's previous cache when the new text only appends to the text it was built from
+INCREMENTAL_BUILDS = os.environ.get('CAG_INCREMENTAL_BUILDS', 'true').lower() == 'true'
+
+# Compression of chunk caches unused for this many days, restored on their next load
+# (needs the zstandard or lz4 package; 0 disables it)
+COLD_COMPRESS_AFTER_DAYS = float(os.environ.get('CAG_COLD_COMPRESS_AFTER_DAYS', '0'))
+COLD_CODEC = os.environ.get('CAG_COLD_CODEC', 'zstd')
+COLD_COMPRESS_LEVEL = int(os.environ.get('CAG_COLD_COMPRESS_LEVEL', '3'))
+COLD_SCAN_INTERVAL = float(os.environ.get('CAG_COLD_SCAN_INTERVAL', '3600'))
+
+# Hot storage tier for chunk caches (local NVMe or tmpfs; empty disables tiering). Queried caches
+# are moved there in the background and back to the kv_caches volume once idle or over budget
+HOT_TIER_DIR = os.environ.get('CAG_HOT_TIER_DIR', '')
+HOT_TIER_BUDGET_MB = int(os.environ.get('CAG_HOT_TIER_BUDGET_MB', '8192'))
+HOT_TIER_IDLE_HOURS = float(os.environ.get('CAG_HOT_TIER_IDLE_HOURS', '24'))
+HOT_TIER_MIN_USES = int(os.environ.get('CAG_HOT_TIER_MIN_USES', '2'))
+TIER_SCAN_INTERVAL = float(os.environ.get('CAG_TIER_SCAN_INTERVAL', '300'))
+# Snapshots of hot caches are kept in the hot tier with them
+HOT_SNAPSHOT_DIR = os.path.join(HOT_TIER_DIR, 'prefix_snapshots') if HOT_TIER_DIR else None
+SNAPSHOT_DIRS = (PREFIX_SNAPSHOT_DIR,) + ((HOT_SNAPSHOT_DIR,) if HOT_SNAPSHOT_DIR else ())
+
+# Disk budget for kv_caches and the hot tier (0 disables eviction; usage is still recorded in
+# processing_stats). Past the high watermark, the chunk caches worth least per byte are deleted
+# until usage is under the low watermark, and their registry rows are marked 'evicted'
+CACHE_DISK_BUDGET_MB = int(os.environ.get('CAG_CACHE_DISK_BUDGET_MB', '0'))
+EVICTION_HIGH_WATERMARK = float(os.environ.get('CAG_EVICTION_HIGH_WATERMARK', '0.9'))
+EVICTION_LOW_WATERMARK = float(os.environ.get('CAG_EVICTION_LOW_WATERMARK', '0.75'))
+EVICTION_INTERVAL = float(os.environ.get('CAG_EVICTION_INTERVAL', '300'))
+# Chunk text of every build, by content hash, so evicted caches can be rebuilt on demand
+SOURCE_DIR = os.environ.get('CAG_SOURCE_DIR', os.path.join(os.path.dirname(MASTER_KV_CACHE), 'sources'))
+
+# Predictive page-cache prefetch (0 MB disables it): every interval, the caches most queried recently and
+# in the coming hours of the day (per query_log) are read ahead with posix_fadvise(WILLNEED)
+PREFETCH_BUDGET_MB = int(os.environ.get('CAG_PREFETCH_BUDGET_MB', '0'))
+PREFETCH_INTERVAL = float(os.environ.get('CAG_PREFETCH_INTERVAL', '900'))
+PREFETCH_LOOKAHEAD_HOURS = int(os.environ.get('CAG_PREFETCH_LOOKAHEAD_HOURS', '1'))
+PREFETCH_HISTORY_DAYS = int(os.environ.get('CAG_PREFETCH_HISTORY_DAYS', '14'))
+PREFETCH_TOP_N = int(os.environ.get('CAG_PREFETCH_TOP_N', '20'))
+
+# Cache uses are counted in memory and written to the registry's last_used/usage_count in one
+# bulk UPDATE per interval; at most one interval of uses is lost if the bridge dies
+USAGE_FLUSH_INTERVAL = float(os.environ.get('CAG_USAGE_FLUSH_INTERVAL', '5'))
+USAGE_MAX_PENDING = int(os.environ.get('CAG_USAGE_MAX_PENDING', '10000'))
+
+# Memoization of deterministic (temperature 0 or seeded) query responses; 0 entries disables it
+RESPONSE_CACHE_SIZE = int(os.environ.get('CAG_RESPONSE_CACHE_SIZE', '512'))
+RESPONSE_CACHE_TTL = float(os.environ.get('CAG_RESPONSE_CACHE_TTL', '3600'))
+
+# Admission control for llama.cpp jobs (queries and cache builds); with batching enabled,
+# raise the in-flight limit to WORKER_POOL_SIZE * QUERY_BATCH_MAX so batches can fill up
+MAX_INFLIGHT_JOBS = int(os.environ.get('CAG_MAX_INFLIGHT_JOBS', '2'))
+MAX_QUEUED_JOBS = int(os.environ.get('CAG_MAX_QUEUED_JOBS', '8'))
+QUEUE_TIMEOUT = float(os.environ.get('CAG_QUEUE_TIMEOUT', '120'))
+RESERVED_QUERY_SLOTS = int(os.environ.get('CAG_RESERVED_QUERY_SLOTS', '1'))
+PAUSE_BUILDS_FOR_QUERIES = os.environ.get('CAG_PAUSE_BUILDS_FOR_QUERIES', 'true').lower() == 'true'
+MAX_BUILD_PAUSE = float(os.environ.get('CAG_MAX_BUILD_PAUSE', '60'))
+
+# /query-multi: per-cache extraction runs this many caches at once across all requests
+MULTI_QUERY_CONCURRENCY = int(os.environ.get('CAG_MULTI_QUERY_CONCURRENCY', str(MAX_INFLIGHT_JOBS)))
+MULTI_QUERY_EXTRACT_TOKENS = int(os.environ.get('CAG_MULTI_QUERY_EXTRACT_TOKENS', '512'))
+# BM25 index of chunk text and section titles, updated by every build; /route and /query-multi
+# without kvCaches use it to pick the ROUTING_TOP_K chunk caches that match a query
+ROUTING_INDEX = os.environ.get('CAG_ROUTING_INDEX', 'true').lower() == 'true'
+ROUTING_INDEX_PATH = os.environ.get('CAG_ROUTING_INDEX_PATH',
+                                    os.path.join(os.path.dirname(MASTER_KV_CACHE), 'routing_index.json'))
+ROUTING_TOP_K = int(os.environ.get('CAG_ROUTING_TOP_K', '3'))
+
+# Build and query records in PostgreSQL (needs psycopg2; an empty DB_HOST disables it)
+DB_HOST = os.environ.get('DB_HOST', '')
+DB_PORT = int(os.environ.get('DB_PORT', '5432'))
+DB_NAME = os.environ.get('DB_NAME', 'llamacag')
+DB_USER = os.environ.get('DB_USER', 'llamacag')
+DB_PASSWORD = os.environ.get('DB_PASSWORD', '')
+# query_log rows are buffered and inserted in batches of up to QUERY_LOG_BATCH at least every
+# QUERY_LOG_FLUSH_INTERVAL seconds; rows beyond QUERY_LOG_BUFFER are dropped, never waited on
+QUERY_LOG_BUFFER = int(os.environ.get('CAG_QUERY_LOG_BUFFER', '10000'))
+QUERY_LOG_BATCH = int(os.environ.get('CAG_QUERY_LOG_BATCH', '500'))
+QUERY_LOG_FLUSH_INTERVAL = float(os.environ.get('CAG_QUERY_LOG_FLUSH_INTERVAL', '1'))
+
+# Created by run_server() when the pool is enabled
+worker_pool = None
+kv_residency = None
+job_scheduler = JobScheduler(MAX_INFLIGHT_JOBS, MAX_QUEUED_JOBS, QUEUE_TIMEOUT,
+                             reserved_query_slots=RESERVED_QUERY_SLOTS,
+                             pause_builds=PAUSE_BUILDS_FOR_QUERIES,
+                             max_build_pause=MAX_BUILD_PAUSE)
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL) if RESPONSE_CACHE_SIZE > 0 else None
+build_rate = {'tokens_per_second': None}  # Observed prefill rate, used to estimate build progress
+reusable_builds = {}  # (content hash, model fingerprint) -> cache built this run, for when the registry is off
+document_builds = {}  # document id -> last cache built for it this run, for when the registry is off
+database = Database(DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD,
+                    QUERY_LOG_BUFFER, QUERY_LOG_BATCH, QUERY_LOG_FLUSH_INTERVAL)
+master_pin = {'enabled': PIN_MASTER_CACHE}  # Whether the current master version is kept resident
+multi_query_slots = threading.BoundedSemaphore(max(1, MULTI_QUERY_CONCURRENCY))
+context_sizer = ContextSizer(MAX_CONTEXT, QUERY_CTX_MARGIN, lookup=database.cache_tokens)
+
+def forget_kv_file(path):
+    """Drop a deleted KV cache file from RAM residency"""
+    if kv_residency is not None:
+        kv_residency.discard(path)
+
+def forget_master_version(real_path):
+    """Drop state held for a master cache version that has been deleted"""
+    forget_kv_file(real_path)
+    prefix_snapshots.discard(real_path)
+    if response_cache is not None:
+        response_cache.invalidate(real_path)
+
+def forget_moved_cache(old_path, new_path, direction):
+    """Point the registry at a chunk cache moved between storage tiers, taking its snapshots along"""
+    forget_kv_file(old_path)
+    prefix_snapshots.move(old_path, new_path)
+    database.relocate_cache(old_path, new_path)
+    metrics.TIER_MOVES.inc(direction=direction)
+
+def forget_evicted_cache(path, size):
+    """Mark a chunk cache deleted by the eviction daemon in the registry and drop state for it
+
+    Returns the bytes freed by deleting its prefix snapshots.
+    """
+    forget_kv_file(path)
+    freed = prefix_snapshots.discard(path)
+    routing_index.mark_evicted(tiered_storage.home(path))
+    database.mark_evicted(path, size)
+    metrics.KV_CACHES_EVICTED.inc()
+    metrics.KV_BYTES_EVICTED.inc(size + freed)
+    return freed
+
+def forget_compressed_cache(path):
+    """Delete the prefix snapshots of a chunk cache that cold storage compresses; returns the bytes freed"""
+    return prefix_snapshots.discard(path)
+
+def evict_snapshot(path):
+    """Delete a prefix snapshot for the eviction daemon; returns the bytes freed"""
+    freed = prefix_snapshots.remove(path)
+    metrics.KV_BYTES_EVICTED.inc(freed)
+    return freed
+
+def record_cache_storage(total_bytes):
+    """Report the bytes under the cache directories and drop chunk text no cache was built from"""
+    metrics.CACHE_STORAGE_BYTES.set(total_bytes)
+    database.record_cache_size(total_bytes)
+    usage = database.cache_usage()
+    if usage is None or not os.path.isdir(SOURCE_DIR):
+        return
+    referenced = {row['content_hash'] for row in usage.values() if row['content_hash']}
+    for name in os.listdir(SOURCE_DIR):
+        path = os.path.join(SOURCE_DIR, name)
+        # Sources of builds still running may not be in the registry yet
+        if name.endswith('.txt') and name[:-4] not in referenced and os.path.getmtime(path) < time.time() - 86400:
+            os.remove(path)
+
+master_cache = MasterCache(MASTER_KV_CACHE, MASTER_KEEP_VERSIONS, on_removed=forget_master_version)
+cold_storage = ColdStorage(os.path.dirname(MASTER_KV_CACHE), COLD_CODEC, COLD_COMPRESS_LEVEL,
+                           COLD_COMPRESS_AFTER_DAYS, COLD_SCAN_INTERVAL, last_used=database.cache_last_used,
+                           exclude=SNAPSHOT_DIRS + (MASTER_KV_CACHE + '.versions',)
+                           + ((HOT_TIER_DIR,) if HOT_TIER_DIR else ()), on_compressed=forget_compressed_cache)
+tiered_storage = TieredStorage(HOT_TIER_DIR, os.path.dirname(MASTER_KV_CACHE), cold_storage,
+                               HOT_TIER_BUDGET_MB * 1024 * 1024, HOT_TIER_IDLE_HOURS * 3600, HOT_TIER_MIN_USES,
+                               TIER_SCAN_INTERVAL, usage=database.cache_usage, on_moved=forget_moved_cache,
+                               exclude=SNAPSHOT_DIRS + (MASTER_KV_CACHE + '.versions',))
+routing_index = RoutingIndex(ROUTING_INDEX_PATH, enabled=ROUTING_INDEX, exists=tiered_storage.exists)
+cache_evictor = CacheEvictor([os.path.dirname(MASTER_KV_CACHE), HOT_TIER_DIR], CACHE_DISK_BUDGET_MB * 1024 * 1024,
+                             EVICTION_HIGH_WATERMARK, EVICTION_LOW_WATERMARK, EVICTION_INTERVAL,
+                             usage=database.cache_usage, last_loaded=tiered_storage.last_loaded,
+                             lock=lambda path: cold_storage.path_lock(tiered_storage.home(path)),
+                             on_evicted=forget_evicted_cache, on_scanned=record_cache_storage,
+                             exclude=SNAPSHOT_DIRS + (MASTER_KV_CACHE + '.versions',),
+                             snapshots=lambda: prefix_snapshots.snapshots(),
+                             remove_snapshot=evict_snapshot)
+def prefetch_path(cache_path):
+    """The file a query against a cache would restore: its prefix snapshot if it has one"""
+    stored = tiered_storage.stored_path(cache_path)
+    if stored is None:
+        return None
+    return prefix_snapshots.existing(stored) or stored
+
+cache_prefetcher = CachePrefetcher(PREFETCH_BUDGET_MB * 1024 * 1024, PREFETCH_INTERVAL, PREFETCH_LOOKAHEAD_HOURS,
+                                   PREFETCH_HISTORY_DAYS, PREFETCH_TOP_N, history=database.query_history,
+                                   usage=database.cache_usage, resolve=prefetch_path)
+usage_recorder = UsageRecorder(database.update_usage, USAGE_FLUSH_INTERVAL, USAGE_MAX_PENDING,
+                               enabled=database.enabled, aliases=tiered_storage.aliases)
+
+def record_cache_load(kv_cache, load_ms=None, prompt_cache=None):
+    """Count a query's cache load for prefetch ranking and report its latency by page-cache warmth
+
+    `load_ms` is the time a worker took to read and restore the cache file,
+    `prompt_cache` the file it restored when that was the cache's prefix
+    snapshot. Script runs pass no time: their load time is mostly loading the model.
+    """
+    warm = cache_prefetcher.record_load(kv_cache, load_ms, loaded=prompt_cache)
+    if load_ms is not None:
+        metrics.PREFETCH_LOAD_SECONDS.observe(load_ms / 1000, page_cache='warm' if warm else 'cold')
+
+def shell_command(*args):
+    """Join a script invocation into a command line, each argument quoted for the shell"""
+    return ' '.join(shlex.quote(str(arg)) for arg in args)
+
+def model_fingerprint():
+    """Identify the model file by path, size and mtime (hashing GGUFs is too slow)"""
+    try:
+        stat = os.stat(MODEL_PATH)
+    except OSError:
+        return None
+    return hashlib.sha1(f"{os.path.realpath(MODEL_PATH)}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()[:16]
+
+def content_hash(path, length=None):
+    """SHA-256 of a file's content (or of its first `length` bytes), read in blocks"""
+    digest = hashlib.sha256()
+    remaining = length
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            block = f.read(1024 * 1024 if remaining is None else min(1024 * 1024, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest.hexdigest()
+
+def log_query(query, response_text, success, error, run_timings, query_type='master_cache', document_ids=None,
+              **metadata):
+    """Record an answered query (with its timing breakdown) in query_log; never waits on the database"""
+    metadata['timings'] = run_timings
+    chunks_used = metadata.get('kv_caches') or ([metadata['kv_cache']] if metadata.get('kv_cache') else None)
+    database.log_query(query or '', response_text, query_type, run_timings['total_ms'], success, error, metadata,
+                       document_ids, chunks_used)
+
+def failed_timings(start_time):
+    """Timing breakdown of a query that failed before llama.cpp reported any"""
+    return dict(timings.empty(), total_ms=round((time.time() - start_time) * 1000, 1))
+
+def citation_for(kv_cache):
+    """Document name and section of a chunk cache, from its <document>_chunk<N>.bin file name"""
+    name = os.path.basename(kv_cache)
+    match = re.search(r'_?(chunk\d+)\.bin$', name)
+    if match:
+        return {'kvCache': kv_cache, 'document': name[:match.start()], 'section': match.group(1)}
+    return {'kvCache': kv_cache, 'document': os.path.splitext(name)[0], 'section': 'section'}
+
+SYNTHESIS_TEMPLATE = """Based on the following information extracted from documents, please answer this query:
+
+Query: {query}
+
+Document Extracts:
+{extracts}
+
+Please provide a complete and accurate answer based only on the information above.
+Reference specific sections if possible."""
 
 # Verify file existence at startup
 def check_files():
@@ -48,19 +367,91 @@ def check_files():
     
     return issues
 
+# Routes reported individually in /metrics; anything else is counted as "other"
+METRIC_ROUTES = ('/', '/health', '/metrics', '/query', '/query-multi', '/route', '/create-cache', '/admin/pin', '/admin/unpin',
+                 '/admin/residency')
+
+def instrumented(method):
+    """Count and time every request handled by a do_* method"""
+    @functools.wraps(method)
+    def wrapper(self):
+        self._status = None
+        start_time = time.time()
+        try:
+            return method(self)
+        finally:
+            route = self.metric_route()
+            metrics.REQUESTS.inc(route=route, method=self.command, status=self._status or 'none')
+            metrics.REQUEST_SECONDS.observe(time.time() - start_time, route=route)
+    return wrapper
+
+def update_job_gauges():
+    """Refresh the scheduler and build job gauges before /metrics is rendered"""
+    scheduler_state = job_scheduler.describe()
+    for lane, stats in scheduler_state['lanes'].items():
+        metrics.JOBS_IN_FLIGHT.set(stats['in_flight'], lane=lane)
+        metrics.JOBS_QUEUED.set(stats['queued'], lane=lane)
+    builds = build_jobs.describe()
+    for state in ('queued', 'running', 'done', 'failed', 'cancelled'):
+        metrics.BUILD_JOBS.set(builds[state], state=state)
+
 class CAGHandler(BaseHTTPRequestHandler):
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+    
+    def metric_route(self):
+        path = self.path.split('?', 1)[0]
+        if path.startswith('/jobs/'):
+            return '/jobs/{id}'
+        return path if path in METRIC_ROUTES else 'other'
+    
+    @instrumented
     def do_POST(self):
         if self.path == '/query':
-            self.handle_query()
+            self.run_admitted(self.handle_query)
+        elif self.path == '/query-multi':
+            # Each stage is admitted on its own, so the request itself holds no slot
+            self.handle_query_multi()
         elif self.path == '/create-cache':
             self.handle_create_cache()
+        elif self.path == '/route':
+            self.handle_route()
+        elif self.path in ('/admin/pin', '/admin/unpin'):
+            self.handle_pin()
         else:
             self.send_response(404)
             self.end_headers()
     
+    def run_admitted(self, handler):
+        """Run a llama.cpp job handler once the scheduler grants it a slot"""
+        try:
+            with job_scheduler.admit(self.path, lane=QUERY):
+                handler()
+        except QueueFullError as e:
+            logger.warning(f"Rejected {self.path} with {e.status}: {str(e)}")
+            metrics.FAILURES.inc(reason='queue_full' if e.status == 429 else 'queue_timeout')
+            self._send_rejection(e)
+    
+    def _send_rejection(self, error):
+        body = json.dumps({'success': False, 'error': str(error), 'retryAfter': error.retry_after}).encode('utf-8')
+        self.send_response(error.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Retry-After', str(error.retry_after))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
     def handle_query(self):
+        """Answer a query from the master cache version that is current when it arrives"""
+        with master_cache.reader() as kv_cache:
+            self._handle_query(kv_cache)
+    
+    def _handle_query(self, kv_cache):
+        start_time = time.time()
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length).decode('utf-8')
+        query = None
         
         try:
             # Parse JSON request
@@ -68,50 +459,499 @@ class CAGHandler(BaseHTTPRequestHandler):
             query = data.get('query', '')
             max_tokens = data.get('maxTokens', 1024)
             temperature = data.get('temperature', 0.7)
+            seed = data.get('seed')
+            # The registry row is kept under the path this version was promoted from
+            usage_recorder.record(master_cache.source(kv_cache))
             
-            # Format the query
-            formatted_query = f"Answer this question based on your knowledge:\n\nQuestion: {query}\n\nAnswer:"
-            
-            # Build command
-            temp_param = f"--temp {temperature}" if temperature is not None else ""
-            command = f"{QUERY_SCRIPT_PATH} \"{MODEL_PATH}\" \"{MASTER_KV_CACHE}\" \"{formatted_query}\" {max_tokens} {temp_param}"
+            # Format the query; on top of a snapshot of the cache + template prefix only the rest is evaluated
+            prompt_cache = prefix_snapshots.lookup(kv_cache)
+            if prompt_cache is not None:
+                formatted_query = prefix_snapshots.render_suffix(query)
+            else:
+                prompt_cache, formatted_query = kv_cache, prefix_snapshots.render(query)
             
-            logger.info(f"Executing query: {command}")
+            # Deterministic generations against the same cache and model can be replayed
+            memo_key = None
+            if response_cache is not None and response_cache.cacheable(temperature, seed):
+                try:
+                    memo_key = response_cache.key(query, kv_cache, model_fingerprint(), max_tokens,
+                                                  temperature, seed, top_p=0.9, repeat_penalty=1.1,
+                                                  template=prefix_snapshots.template)
+                except OSError:
+                    memo_key = None
             
-            # Execute command
-            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = process.communicate()
+            # Opt-in token streaming as Server-Sent Events
+            if data.get('stream', False) or 'text/event-stream' in self.headers.get('Accept', ''):
+                self._stream_query(query, kv_cache, formatted_query, max_tokens, temperature, seed, memo_key,
+                                   prompt_cache)
+                return
             
-            stdout_text = stdout.decode('utf-8')
-            stderr_text = stderr.decode('utf-8')
+            cached_response = response_cache.get(memo_key) if memo_key is not None else None
+            if cached_response is not None:
+                logger.info("Query answered from response cache")
+                self._answer_query({
+                    'success': True,
+                    'response': cached_response,
+                    'error': None,
+                    'query': query,
+                    'cached': True
+                }, kv_cache, start_time)
+                return
             
-            # Log completion
-            logger.info(f"Query completed with exit code: {process.returncode}")
-            if stderr_text:
-                logger.warning(f"Query stderr: {stderr_text}")
+            result = self._complete(kv_cache, formatted_query, max_tokens, temperature, seed, prompt_cache)
+            if result['success'] and memo_key is not None:
+                response_cache.put(memo_key, result['response'])
             
             # Send response
             response = {
-                'success': process.returncode == 0,
-                'response': stdout_text,
-                'error': stderr_text if process.returncode != 0 else None,
+                'success': result['success'],
+                'response': result['response'],
+                'error': result['error'],
                 'query': query
             }
+            if result['worker'] is not None:
+                response['worker'] = result['worker']
+            self._answer_query(response, kv_cache, start_time, result['timings'], prompt_cache != kv_cache)
+            
+        except Exception as e:
+            logger.error(f"Error processing query: {str(e)}", exc_info=True)
+            metrics.FAILURES.inc(reason='query_error')
+            self._send_json(500, {'success': False, 'error': str(e)})
+            log_query(query, None, False, str(e), failed_timings(start_time), kv_cache=kv_cache, stream=False)
+    
+    def handle_query_multi(self):
+        """Answer a query from several KV caches
+        
+        Every cache first answers the query on its own (the map stage, run
+        concurrently up to CAG_MULTI_QUERY_CONCURRENCY across requests), then
+        the extracts, in the order they finished, are combined into one
+        prompt answered against the first cache. With streaming, each
+        extract is sent as an `event: extract` as soon as it is ready.
+        Without kvCaches, the routing index picks the topK best matching
+        chunk caches.
+        """
+        start_time = time.time()
+        content_length = int(self.headers['Content-Length'])
+        post_data = self.rfile.read(content_length).decode('utf-8')
+        
+        try:
+            data = json.loads(post_data)
+            query = data.get('query', '')
+            kv_caches = data.get('kvCaches') or []
+            top_k = int(data.get('topK', ROUTING_TOP_K))
+            max_tokens = data.get('maxTokens', 1024)
+            extract_tokens = data.get('extractTokens', MULTI_QUERY_EXTRACT_TOKENS)
+            temperature = data.get('temperature', 0.7)
+            seed = data.get('seed')
+            stream = data.get('stream', False) or 'text/event-stream' in self.headers.get('Accept', '')
             
+            if not query:
+                raise ValueError("query is required")
+            routed = None
+            if not kv_caches:
+                # Let the routing index pick the chunk caches
+                routed = routing_index.search(query, top_k)
+                kv_caches = [match['kvCache'] for match in routed]
+                if not kv_caches:
+                    raise ValueError("kvCaches was not given and no indexed KV cache matches the query")
+        except Exception as e:
+            metrics.FAILURES.inc(reason='query_error')
+            self._send_json(400, {'success': False, 'error': str(e)})
+            return
+        
+        if stream:
             self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
             self.end_headers()
-            self.wfile.write(json.dumps(response).encode('utf-8'))
+        
+        sources = []
+        try:
+            existing = [c for c in kv_caches if tiered_storage.exists(c)]
+            for missing in [c for c in kv_caches if c not in existing]:
+                logger.warning(f"Cache file not found, skipping: {missing}")
+                source = dict(citation_for(missing), success=False, error='Cache file not found',
+                              extract=None, worker=None, timings=None)
+                rebuild = rebuild_evicted(missing)
+                if rebuild is not None:
+                    source.update(error='Cache was evicted and is being rebuilt', rebuildJobId=rebuild.id)
+                sources.append(source)
+            
+            # Map stage: extracts are handed on in the order they finish
+            map_start = time.time()
+            if existing:
+                with ThreadPoolExecutor(max_workers=min(len(existing), max(1, MULTI_QUERY_CONCURRENCY))) as pool:
+                    futures = [pool.submit(self._extract, c, query, extract_tokens, temperature, seed)
+                               for c in existing]
+                    for future in as_completed(futures):
+                        source = future.result()
+                        sources.append(source)
+                        if stream:
+                            self._send_event(source, event='extract')
+            map_ms = round((time.time() - map_start) * 1000, 1)
             
+            extracts = [s for s in sources if s['success']]
+            citations = [{'document': s['document'], 'section': s['section'], 'kvCache': s['kvCache']}
+                         for s in extracts]
+            synthesis_cache = existing[0] if existing else None
+            prompt = SYNTHESIS_TEMPLATE.format(query=query, extracts='\n'.join(
+                f"======= Information from {os.path.basename(s['kvCache'])} =======\n{s['extract']}\n"
+                for s in extracts))
+            
+            # Synthesis stage
+            synthesis_start = time.time()
+            if not extracts:
+                result = {'success': False, 'response': '', 'error': 'No cache produced an extract',
+                          'worker': None, 'timings': timings.empty()}
+            elif stream:
+                result = {'exitCode': None, 'error': None, 'worker': None}
+                generated = []
+                with job_scheduler.admit('/query-multi', lane=QUERY):
+                    for text in self._generate_tokens(synthesis_cache, prompt, max_tokens, temperature, seed, result):
+                        generated.append(text)
+                        self._send_event({'token': text})
+                result = {'success': result['exitCode'] == 0, 'response': ''.join(generated),
+                          'error': result['error'], 'worker': result['worker'],
+                          'timings': result.get('timings') or timings.empty()}
+            else:
+                with job_scheduler.admit('/query-multi', lane=QUERY):
+                    result = self._complete(synthesis_cache, prompt, max_tokens, temperature, seed)
+            synthesis_timings = dict(result['timings'])
+            synthesis_timings['total_ms'] = round((time.time() - synthesis_start) * 1000, 1)
+            
+            run_timings = {'map_ms': map_ms, 'synthesis': synthesis_timings,
+                           'total_ms': round((time.time() - start_time) * 1000, 1)}
+            response = {
+                'success': result['success'],
+                'response': result['response'],
+                'error': result['error'],
+                'query': query,
+                'synthesisCache': synthesis_cache,
+                'sources': sources,
+                'citations': citations,
+                'routed': routed,
+                'timings': run_timings
+            }
+            if stream:
+                response.pop('response')
+                self._send_event(response, event='done')
+            else:
+                self._send_json(200, response)
+            log_query(query, result['response'], result['success'], result['error'], run_timings,
+                      query_type='multi_cache', document_ids=[c['document'] for c in citations],
+                      kv_caches=kv_caches, stream=stream)
+        
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning("Client disconnected during multi-cache query")
+        except QueueFullError as e:
+            logger.warning(f"Rejected {self.path} with {e.status}: {str(e)}")
+            metrics.FAILURES.inc(reason='queue_full' if e.status == 429 else 'queue_timeout')
+            if stream:
+                self._send_event({'success': False, 'error': str(e), 'retryAfter': e.retry_after}, event='done')
+            else:
+                self._send_rejection(e)
         except Exception as e:
-            logger.error(f"Error processing query: {str(e)}", exc_info=True)
-            error_response = {'success': False, 'error': str(e)}
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
+            logger.error(f"Error processing multi-cache query: {str(e)}", exc_info=True)
+            metrics.FAILURES.inc(reason='query_error')
+            if stream:
+                self._send_event({'success': False, 'error': str(e)}, event='done')
+            else:
+                self._send_json(500, {'success': False, 'error': str(e)})
+            log_query(query, None, False, str(e), failed_timings(start_time), query_type='multi_cache',
+                      kv_caches=kv_caches, stream=stream)
+    
+    def _extract(self, kv_cache, query, max_tokens, temperature, seed):
+        """Map stage of /query-multi: answer the query from a single cache"""
+        start_time = time.time()
+        source = dict(citation_for(kv_cache), success=False, extract=None, error=None, worker=None, timings=None)
+        try:
+            usage_recorder.record(kv_cache)
+            with multi_query_slots:
+                with job_scheduler.admit('/query-multi', lane=QUERY):
+                    with tiered_storage.reader(kv_cache) as cache_file:
+                        prompt_cache = prefix_snapshots.lookup(cache_file)
+                        if prompt_cache is not None:
+                            prompt = prefix_snapshots.render_suffix(query)
+                        else:
+                            prompt_cache, prompt = cache_file, prefix_snapshots.render(query)
+                        result = self._complete(cache_file, prompt, max_tokens, temperature, seed, prompt_cache)
+            source.update(success=result['success'], extract=result['response'] if result['success'] else None,
+                          error=result['error'], worker=result['worker'], timings=dict(result['timings']))
+        except Exception as e:
+            logger.warning(f"Extraction from {kv_cache} failed: {str(e)}")
+            source.update(error=str(e), timings=timings.empty())
+        source['timings']['total_ms'] = round((time.time() - start_time) * 1000, 1)
+        return source
+    
+    def _complete(self, kv_cache, prompt, max_tokens, temperature, seed=None, prompt_cache=None):
+        """Generate a completion on a worker, or with the query script as a fallback
+        
+        `prompt_cache` is the KV cache (or prefix snapshot) generation runs on.
+        Returns a dict with success, response, error, worker (None when the
+        script ran) and llama.cpp timings.
+        """
+        prompt_cache = prompt_cache or kv_cache
+        if worker_pool is not None and worker_pool.available():
+            try:
+                result = worker_pool.run_query(prompt_cache, prompt, max_tokens, temperature, seed)
+                logger.info(f"Query served by worker {result['worker']} in {result['elapsed']:.2f}s "
+                            f"({'swapped' if result['swapped'] else 'reused'} KV state, "
+                            f"batch of {result['batch_size']})")
+                record_cache_load(kv_cache, result['timings'].get('load_ms') if result['swapped'] else None,
+                                  prompt_cache)
+                return {'success': True, 'response': result['response'], 'error': None,
+                        'worker': result['worker'], 'timings': result['timings']}
+            except WorkerError as e:
+                metrics.FAILURES.inc(reason='worker_error')
+                logger.warning(f"{str(e)}. Falling back to query script.")
+        
+        returncode, stdout_text, stderr_text, run_timings = self._run_query_script(prompt_cache, prompt, max_tokens,
+                                                                                   temperature, seed)
+        record_cache_load(kv_cache, prompt_cache=prompt_cache)
+        return {'success': returncode == 0, 'response': stdout_text,
+                'error': stderr_text if returncode != 0 else None, 'worker': None, 'timings': run_timings}
+    
+    def _answer_query(self, response, kv_cache, start_time, run_timings=None, prefix_snapshot=False):
+        """Send a /query response with its timing breakdown and log it"""
+        run_timings = dict(run_timings or timings.empty())
+        run_timings['total_ms'] = round((time.time() - start_time) * 1000, 1)
+        response['timings'] = run_timings
+        self._send_json(200, response)
+        log_query(response['query'], response['response'], response['success'], response['error'], run_timings,
+                  kv_cache=kv_cache, worker=response.get('worker'), cached=response.get('cached', False),
+                  stream=False, prefix_snapshot=prefix_snapshot)
+    
+    def _stream_query(self, query, kv_cache, formatted_query, max_tokens, temperature, seed=None, memo_key=None,
+                      prompt_cache=None):
+        """Forward tokens to the client as they are generated
+        
+        Each chunk of text is sent as a `data: {"token": ...}` event and the
+        stream ends with an `event: done` carrying the exit status and timings.
+        `prompt_cache` is the KV cache (or prefix snapshot) generation runs on.
+        """
+        prompt_cache = prompt_cache or kv_cache
+        start_time = time.time()
+        first_token_time = None
+        result = {'exitCode': None, 'error': None, 'worker': None}
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        
+        cached_response = response_cache.get(memo_key) if memo_key is not None else None
+        if cached_response is not None:
+            logger.info("Streamed query answered from response cache")
+            tokens = iter([cached_response])
+            result.update(exitCode=0, cached=True)
+        else:
+            tokens = self._generate_tokens(kv_cache, formatted_query, max_tokens, temperature, seed, result,
+                                           prompt_cache)
+        
+        generated = []
+        try:
+            for text in tokens:
+                if first_token_time is None:
+                    first_token_time = time.time()
+                generated.append(text)
+                self._send_event({'token': text})
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning("Client disconnected during streamed query")
+            return
+        except Exception as e:
+            logger.error(f"Error streaming query: {str(e)}", exc_info=True)
+            result['exitCode'] = result['exitCode'] if result['exitCode'] not in (None, 0) else 1
+            result['error'] = str(e)
+        finally:
+            if hasattr(tokens, 'close'):
+                tokens.close()
+        
+        if memo_key is not None and result['exitCode'] == 0 and not result.get('cached'):
+            response_cache.put(memo_key, ''.join(generated))
+        
+        end_time = time.time()
+        logger.info(f"Streamed query completed with exit code: {result['exitCode']}")
+        run_timings = dict(result.get('timings') or timings.empty())
+        run_timings['first_token_ms'] = round((first_token_time - start_time) * 1000, 1) if first_token_time else None
+        run_timings['total_ms'] = round((end_time - start_time) * 1000, 1)
+        try:
+            self._send_event({
+                'success': result['exitCode'] == 0,
+                'exitCode': result['exitCode'],
+                'error': result['error'],
+                'query': query,
+                'worker': result['worker'],
+                'cached': result.get('cached', False),
+                'timings': run_timings
+            }, event='done')
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning("Client disconnected before the final stream event")
+        log_query(query, ''.join(generated), result['exitCode'] == 0, result['error'], run_timings,
+                  kv_cache=kv_cache, worker=result['worker'], cached=result.get('cached', False), stream=True,
+                  prefix_snapshot=prompt_cache != kv_cache)
+    
+    def _generate_tokens(self, kv_cache, formatted_query, max_tokens, temperature, seed, result, prompt_cache=None):
+        """Yield generated text from a worker, or from the query script as a fallback
+        
+        `result` is filled in with the exit code, error, serving worker and
+        llama.cpp timings. `prompt_cache` is as for _complete().
+        """
+        prompt_cache = prompt_cache or kv_cache
+        if worker_pool is not None and worker_pool.available():
+            started = False
+            try:
+                for event in worker_pool.stream_query(prompt_cache, formatted_query, max_tokens, temperature, seed):
+                    result['worker'] = event.get('worker')
+                    if event.get('stop'):
+                        result['timings'] = event.get('timings')
+                        result['swapped'] = event.get('swapped')
+                    if event.get('content'):
+                        started = True
+                        yield event['content']
+                result['exitCode'] = 0
+                load_ms = (result.get('timings') or {}).get('load_ms')
+                record_cache_load(kv_cache, load_ms if result.get('swapped') else None, prompt_cache)
+                return
+            except WorkerError as e:
+                metrics.FAILURES.inc(reason='worker_error')
+                if started:
+                    result['exitCode'] = 1
+                    result['error'] = str(e)
+                    return
+                logger.warning(f"{str(e)}. Falling back to query script.")
+                result['worker'] = None
+        
+        command = self._query_command(prompt_cache, formatted_query, max_tokens, temperature, seed)
+        logger.info(f"Executing streamed query: {command}")
+        yield from self._script_output(command, result)
+        record_cache_load(kv_cache, prompt_cache=prompt_cache)
+    
+    def _script_output(self, command, result):
+        """Run the query script and yield its stdout as it is produced
+        
+        `result` is filled in with the exit code, the stderr text, the timings
+        llama.cpp reported there and, on a non-zero exit, the error.
+        """
+        start_time = time.time()
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        
+        # Drain stderr separately so a chatty process cannot block on a full pipe
+        stderr_chunks = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+        stderr_reader.start()
+        
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        first_byte = True
+        try:
+            while True:
+                chunk = os.read(process.stdout.fileno(), 4096)
+                if not chunk:
+                    break
+                if first_byte:
+                    first_byte = False
+                    metrics.FIRST_BYTE_SECONDS.observe(time.time() - start_time, source='script')
+                text = decoder.decode(chunk)
+                if text:
+                    yield text
+            text = decoder.decode(b'', final=True)
+            if text:
+                yield text
+            process.wait()
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            stderr_reader.join(timeout=5)
+        
+        stderr_text = b''.join(stderr_chunks).decode('utf-8', 'replace')
+        if process.returncode != 0:
+            metrics.FAILURES.inc(reason='query_script_error')
+            if stderr_text:
+                logger.warning(f"Query stderr: {stderr_text}")
+        result['timings'] = timings.parse_llama_timings(stderr_text)
+        timings.record(result['timings'], 'script')
+        result['exitCode'] = process.returncode
+        result['stderr'] = stderr_text
+        result['error'] = stderr_text if process.returncode != 0 else None
+    
+    def _send_event(self, payload, event=None):
+        message = f"event: {event}\n" if event else ""
+        message += f"data: {json.dumps(payload)}\n\n"
+        self.wfile.write(message.encode('utf-8'))
+        self.wfile.flush()
+    
+    def _query_command(self, kv_cache, formatted_query, max_tokens, temperature, seed=None):
+        """Build the query_kv_cache.sh command line for a KV cache
+        
+        The context is sized to the tokens in the cache plus this query
+        rather than the full MAX_CONTEXT.
+        """
+        temp_param = f"--temp {temperature}" if temperature is not None else ""
+        seed_param = str(int(seed)) if seed is not None else ""
+        ctx_size, cached_tokens = context_sizer.size_for(kv_cache, formatted_query, max_tokens)
+        logger.info(f"Query context: {ctx_size} tokens "
+                    f"({cached_tokens if cached_tokens is not None else 'unknown'} cached)")
+        # Quoted for the shell: prompts (and /query-multi extracts) may contain quotes or $
+        return shell_command(QUERY_SCRIPT_PATH, MODEL_PATH, kv_cache, formatted_query, max_tokens, temp_param,
+                             seed_param, ctx_size)
+    
+    def _run_query_script(self, kv_cache, formatted_query, max_tokens, temperature, seed=None):
+        """Run query_kv_cache.sh against a KV cache in a fresh llama.cpp process"""
+        command = self._query_command(kv_cache, formatted_query, max_tokens, temperature, seed)
+        
+        logger.info(f"Executing query: {command}")
+        
+        # Execute command
+        result = {}
+        stdout_text = ''.join(self._script_output(command, result))
+        
+        # Log completion
+        logger.info(f"Query completed with exit code: {result['exitCode']}")
+        
+        return result['exitCode'], stdout_text, result['stderr'], result['timings']
+    
+    def _send_json(self, status, payload):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(payload).encode('utf-8'))
+    
+    def handle_route(self):
+        """List the chunk caches that best match a query, best first"""
+        content_length = int(self.headers.get('Content-Length', 0))
+        post_data = self.rfile.read(content_length).decode('utf-8') if content_length else ''
+        
+        try:
+            data = json.loads(post_data) if post_data else {}
+            query = data.get('query', '')
+            if not query:
+                self._send_json(400, {'success': False, 'error': 'query is required'})
+                return
+            if not routing_index.enabled:
+                self._send_json(409, {'success': False, 'error': 'Routing is disabled (CAG_ROUTING_INDEX=false)'})
+                return
+            
+            matches = routing_index.search(query, int(data.get('topK', ROUTING_TOP_K)))
+            self._send_json(200, {'success': True, 'query': query, 'caches': matches})
+            
+        except Exception as e:
+            logger.error(f"Error routing query: {str(e)}", exc_info=True)
+            self._send_json(500, {'success': False, 'error': str(e)})
     
     def handle_create_cache(self):
+        """Queue a KV cache build and return its job id
+        
+        With "wait": true the request blocks until the build finishes and
+        returns the build result, as before; the build still runs in the
+        background and completes even if the client disconnects.
+        
+        A request for the same document, content and kvCachePath as a
+        queued or running build gets that build's job instead of a new one.
+        An Idempotency-Key header (or "idempotencyKey") makes retries return
+        the original job, even after its temp file has been cleaned up.
+        """
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length).decode('utf-8')
         
@@ -120,90 +960,98 @@ class CAGHandler(BaseHTTPRequestHandler):
             data = json.loads(post_data)
             document_id = data.get('documentId', '')
             temp_file_path = data.get('tempFilePath', '')
-            kv_cache_path = data.get('kvCachePath', '')
-            estimated_tokens = data.get('estimatedTokens', 0)
+            idempotency_key = self.headers.get('Idempotency-Key') or data.get('idempotencyKey')
             
             # Ensure the document ID is provided
             if not document_id:
                 raise ValueError("documentId is required")
             
-            # Ensure the temp file exists
-            if not os.path.exists(temp_file_path):
-                raise ValueError(f"Temp file not found at {temp_file_path}")
-            
-            # Make sure the KV cache directory exists
-            kv_cache_dir = os.path.dirname(kv_cache_path)
-            os.makedirs(kv_cache_dir, exist_ok=True)
-            
-            # Calculate context size based on estimated tokens (with some padding)
-            context_size = min(max(estimated_tokens + 1000, 2048), int(MAX_CONTEXT))
-            context_size = (context_size + 255) // 256 * 256  # Round to nearest 256
-            
-            # Build command to create KV cache
-            command = f"{CREATE_SCRIPT_PATH} \"{MODEL_PATH}\" \"{temp_file_path}\" \"{kv_cache_path}\" {context_size} {THREADS} {BATCH_SIZE}"
-            
-            logger.info(f"Creating KV cache: {command}")
-            
-            # Execute command
-            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-            
-            stdout_text = stdout.decode('utf-8')
-            stderr_text = stderr.decode('utf-8')
-            
-            # Log completion
-            logger.info(f"KV cache creation completed with exit code: {process.returncode}")
-            if stderr_text:
-                logger.warning(f"KV cache stderr: {stderr_text}")
-            
-            # Get the size of the KV cache file if it was created
-            kv_cache_size = None
-            if process.returncode == 0 and os.path.exists(kv_cache_path):
-                kv_cache_size = os.path.getsize(kv_cache_path)
+            # A retry whose first attempt already ran has no temp file any more
+            job = build_jobs.replay(idempotency_key)
+            if job is None:
+                # Ensure the temp file exists
+                if not os.path.exists(temp_file_path):
+                    raise ValueError(f"Temp file not found at {temp_file_path}")
                 
-                # If this is meant to be the master cache, create a symbolic link or copy
-                if 'master' in document_id.lower() or data.get('setAsMaster', False):
-                    try:
-                        # Copy the file to master_cache.bin
-                        master_dir = os.path.dirname(MASTER_KV_CACHE)
-                        os.makedirs(master_dir, exist_ok=True)
-                        shutil.copy2(kv_cache_path, MASTER_KV_CACHE)
-                        logger.info(f"Set {kv_cache_path} as master KV cache at {MASTER_KV_CACHE}")
-                    except Exception as e:
-                        logger.error(f"Failed to set as master KV cache: {str(e)}")
-            
-            # Clean up temp file
-            try:
-                if os.path.exists(temp_file_path):
+                data['contentHash'] = content_hash(temp_file_path)
+                dedupe_key = (document_id, data['contentHash'], os.path.abspath(data.get('kvCachePath', '')),
+                              bool(data.get('setAsMaster', False)))
+                job, created = build_jobs.submit('create-cache', data, dedupe_key, idempotency_key)
+                if not created and job.params.get('tempFilePath') != temp_file_path:
+                    # The duplicate's temp file is not needed; the running build cleans up its own
                     os.remove(temp_file_path)
-                    logger.info(f"Cleaned up temp file: {temp_file_path}")
-            except Exception as e:
-                logger.warning(f"Failed to clean up temp file: {str(e)}")
+            else:
+                created = False
             
-            # Send response
-            response = {
-                'success': process.returncode == 0,
-                'documentId': document_id,
-                'kvCachePath': kv_cache_path,
-                'kvCacheSize': kv_cache_size,
-                'contextSize': context_size,
-                'error': stderr_text if process.returncode != 0 else None,
-                'output': stdout_text
-            }
+            if data.get('wait', False):
+                job.wait()
+                response = dict(job.result or {'success': False, 'documentId': document_id, 'error': job.error})
+                response['jobId'] = job.id
+                response['deduplicated'] = not created
+                self._send_json(200, response)
+                return
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode('utf-8'))
+            self._send_json(202, {
+                'success': True,
+                'jobId': job.id,
+                'status': job.state,
+                'statusUrl': f"/jobs/{job.id}",
+                'documentId': document_id,
+                'deduplicated': not created
+            })
             
+        except QueueFullError as e:
+            logger.warning(f"Rejected {self.path} with {e.status}: {str(e)}")
+            metrics.FAILURES.inc(reason='build_queue_full')
+            self._send_rejection(e)
         except Exception as e:
             logger.error(f"Error creating KV cache: {str(e)}", exc_info=True)
-            error_response = {'success': False, 'error': str(e)}
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
+            metrics.FAILURES.inc(reason='build_request_error')
+            self._send_json(500, {'success': False, 'error': str(e)})
+    
+    def handle_job(self):
+        """GET /jobs/{id} reports a build job, DELETE /jobs/{id} cancels it"""
+        job_id = self.path[len('/jobs/'):]
+        if self.command == 'DELETE':
+            job = build_jobs.cancel(job_id)
+        else:
+            job = build_jobs.get(job_id)
+        
+        if job is None:
+            self._send_json(404, {'success': False, 'error': f"Unknown job: {job_id}"})
+        else:
+            self._send_json(200, job.describe())
+    
+    def handle_pin(self):
+        """Pin or unpin a KV cache (the master cache by default) in RAM"""
+        content_length = int(self.headers.get('Content-Length', 0))
+        post_data = self.rfile.read(content_length).decode('utf-8') if content_length else ''
+        
+        try:
+            if kv_residency is None:
+                self._send_json(409, {'success': False, 'error': 'KV residency requires the inference worker pool'})
+                return
+            
+            data = json.loads(post_data) if post_data else {}
+            cache_path = data.get('path') or MASTER_KV_CACHE
+            if not data.get('path'):
+                # Follow the master cache across promotions
+                master_pin['enabled'] = self.path == '/admin/pin'
             
+            if self.path == '/admin/pin':
+                real_path = pin_cache(cache_path)
+                logger.info(f"Pinned KV cache in RAM: {real_path}")
+            else:
+                real_path = unpin_cache(cache_path)
+                logger.info(f"Unpinned KV cache: {real_path}")
+            
+            self._send_json(200, {'success': True, 'path': real_path, 'residency': kv_residency.describe()})
+            
+        except Exception as e:
+            logger.error(f"Error updating KV cache pin: {str(e)}", exc_info=True)
+            self._send_json(500, {'success': False, 'error': str(e)})
+    
+    @instrumented
     def do_GET(self):
         if self.path == '/':
             self.send_response(200)
@@ -227,17 +1075,482 @@ class CAGHandler(BaseHTTPRequestHandler):
                     'create_script': CREATE_SCRIPT_PATH,
                     'max_context': MAX_CONTEXT,
                     'threads': THREADS,
-                    'batch_size': BATCH_SIZE
-                }
+                    'batch_size': BATCH_SIZE,
+                    'mmap': USE_MMAP
+                },
+                'workers': worker_pool.describe() if worker_pool is not None else None,
+                'jobs': job_scheduler.describe(),
+                'residency': kv_residency.describe() if kv_residency is not None else None,
+                'response_cache': response_cache.describe() if response_cache is not None else None,
+                'builds': build_jobs.describe(),
+                'master_cache': master_cache.describe(),
+                'context_sizing': context_sizer.describe(),
+                'prefix_snapshots': prefix_snapshots.describe(),
+                'routing': routing_index.describe(),
+                'cold_storage': cold_storage.describe(),
+                'tiers': tiered_storage.describe(),
+                'eviction': cache_evictor.describe(),
+                'prefetch': cache_prefetcher.describe(),
+                'usage_stats': usage_recorder.describe(),
+                'database': database.describe()
             }
             self.wfile.write(json.dumps(health_data).encode('utf-8'))
+        elif self.path == '/metrics':
+            update_job_gauges()
+            body = metrics.REGISTRY.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', metrics.CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path.startswith('/jobs/'):
+            self.handle_job()
+        elif self.path == '/admin/residency':
+            if kv_residency is None:
+                self._send_json(409, {'success': False, 'error': 'KV residency requires the inference worker pool'})
+            else:
+                self._send_json(200, kv_residency.describe())
+        else:
+            self.send_response(404)
+            self.end_headers()
+    
+    @instrumented
+    def do_DELETE(self):
+        if self.path.startswith('/jobs/'):
+            self.handle_job()
         else:
             self.send_response(404)
             self.end_headers()
 
+def find_reusable_cache(digest):
+    """An existing KV cache built from identical text with the current model, or None"""
+    fingerprint = model_fingerprint()
+    candidates = [reusable_builds.get((digest, fingerprint))] + database.reusable_caches(digest, fingerprint)
+    for candidate in candidates:
+        if candidate is None:
+            continue
+        try:
+            path = tiered_storage.locate(candidate['path'], promote=False)
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        # A size mismatch means the file has since been rebuilt from other text
+        if size == candidate['size']:
+            return dict(candidate, path=path)
+    return None
+
+def find_extendable_cache(document_id, temp_file_path):
+    """The document's previous cache if the new text starts with the exact text it was built from"""
+    fingerprint = model_fingerprint()
+    new_bytes = os.path.getsize(temp_file_path)
+    candidates = [document_builds.get(document_id)] + database.previous_builds(document_id, fingerprint)
+    for candidate in candidates:
+        if candidate is None or candidate.get('model') not in (None, fingerprint):
+            continue
+        if not candidate['content_bytes'] or candidate['content_bytes'] >= new_bytes:
+            continue
+        try:
+            path = tiered_storage.locate(candidate['path'], promote=False)
+            if os.path.getsize(path) != candidate['size']:
+                continue
+        except OSError:
+            continue
+        if content_hash(temp_file_path, candidate['content_bytes']) == candidate['content_hash']:
+            return dict(candidate, path=path)
+    return None
+
+def retain_source(temp_file_path, digest):
+    """Keep the text a chunk cache was built from, so the cache can be rebuilt after eviction"""
+    source_path = os.path.join(SOURCE_DIR, digest + '.txt')
+    if os.path.exists(source_path):
+        os.utime(source_path)
+        return
+    try:
+        os.makedirs(SOURCE_DIR, exist_ok=True)
+        materialize(temp_file_path, source_path + '.partial')
+        os.replace(source_path + '.partial', source_path)
+    except OSError as e:
+        logger.warning(f"Could not keep the source text of {digest}: {str(e)}")
+
+def rebuild_evicted(kv_cache):
+    """Queue a rebuild of an evicted chunk cache from its retained text; the job, or None if it cannot be rebuilt"""
+    aliases = tiered_storage.aliases(kv_cache)
+    info = next(({'document_id': b['document_id'], 'content_hash': b['content_hash'],
+                  'estimated_tokens': b['estimated_tokens']}
+                 for b in reversed(list(reusable_builds.values())) if os.path.abspath(b['path']) in aliases), None)
+    if info is None:
+        info = database.evicted_cache(aliases)
+    if info is None:
+        return None
+    source_path = os.path.join(SOURCE_DIR, info['content_hash'] + '.txt')
+    if not os.path.exists(source_path):
+        return None
+    
+    # The build deletes its input file when it finishes
+    temp_file_path = os.path.join(SOURCE_DIR, f"{info['content_hash']}.{uuid.uuid4().hex[:8]}.rebuild")
+    shutil.copyfile(source_path, temp_file_path)
+    home = tiered_storage.home(kv_cache)
+    data = {'documentId': info['document_id'], 'tempFilePath': temp_file_path, 'kvCachePath': home,
+            'estimatedTokens': info['estimated_tokens'] or 0, 'contentHash': info['content_hash']}
+    try:
+        job, created = build_jobs.submit('create-cache', data, (info['document_id'], info['content_hash'], home, False))
+    except QueueFullError:
+        os.remove(temp_file_path)
+        return None
+    if not created:
+        os.remove(temp_file_path)
+    else:
+        logger.info(f"Rebuilding evicted KV cache {home} for {info['document_id']}")
+    return job
+
+def write_suffix(temp_file_path, offset):
+    """Copy the text after the first `offset` bytes into a file of its own"""
+    suffix_path = temp_file_path + '.suffix'
+    with open(temp_file_path, 'rb') as src, open(suffix_path, 'wb') as dst:
+        src.seek(offset)
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    return suffix_path
+
+def run_create_script(job, command, estimated_tokens=0, name='create-cache'):
+    """Run create_kv_cache.sh in a build slot; returns (returncode, stdout, stderr, elapsed)
+    
+    `job` is the build job it runs for, or None for internal builds that
+    cannot be cancelled.
+    """
+    with job_scheduler.admit(name, lane=BUILD, block=True):
+        if job is not None and job.cancel_requested:
+            raise JobCancelled()
+        
+        logger.info(f"Creating KV cache: {command}")
+        if job is not None and build_rate['tokens_per_second'] and estimated_tokens:
+            job.estimated_seconds = round(estimated_tokens / build_rate['tokens_per_second'], 1)
+        
+        # Execute command in its own session so a cancel can stop llama.cpp too
+        start_time = time.time()
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=True)
+        if job is not None:
+            job.attach_process(process)
+        job_scheduler.register_build(process)
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            job_scheduler.unregister_build(process)
+        elapsed = time.time() - start_time
+    
+    if job is not None and job.cancel_requested:
+        raise JobCancelled()
+    
+    # Log completion
+    logger.info(f"KV cache creation completed with exit code: {process.returncode}")
+    return process.returncode, stdout.decode('utf-8'), stderr.decode('utf-8'), elapsed
+
+def run_cache_build(job):
+    """Build a KV cache with create_kv_cache.sh; runs on a build job thread
+    
+    If a cache built from the same text with the same model still exists, it
+    is linked to kvCachePath instead of running llama.cpp. If the text only
+    appends to the text the document's previous cache was built from, that
+    cache is loaded and just the appended part is prefilled. "force": true
+    rebuilds from scratch.
+    """
+    data = job.params
+    document_id = data.get('documentId', '')
+    temp_file_path = data.get('tempFilePath', '')
+    kv_cache_path = data.get('kvCachePath', '')
+    estimated_tokens = data.get('estimatedTokens', 0)
+    digest = data.get('contentHash')
+    suffix_path = None
+    # Build into a separate file and rename it into place, so a rebuild never rewrites a file
+    # that queries (or a hardlinked master cache version) are reading
+    partial_path = kv_cache_path + '.partial'
+    
+    try:
+        # Make sure the KV cache directory exists
+        kv_cache_dir = os.path.dirname(kv_cache_path)
+        os.makedirs(kv_cache_dir, exist_ok=True)
+        
+        # Calculate context size based on estimated tokens (with some padding)
+        context_size = min(max(estimated_tokens + 1000, 2048), int(MAX_CONTEXT))
+        context_size = (context_size + 255) // 256 * 256  # Round to nearest 256
+        
+        content_bytes = os.path.getsize(temp_file_path)
+        force = data.get('force', False)
+        reused = extended = None
+        if REUSE_UNCHANGED_BUILDS and digest and not force:
+            reused = find_reusable_cache(digest)
+        
+        builds_master_path = os.path.abspath(kv_cache_path) == os.path.abspath(MASTER_KV_CACHE)
+        if reused is not None and not builds_master_path and (
+                os.path.realpath(reused['path']) == os.path.realpath(kv_cache_path)):
+            # Rebuilding identical text into the same file; it is already in place
+            start_time = time.time()
+            method = 'in place'
+        elif reused is not None:
+            start_time = time.time()
+            try:
+                method = materialize(reused['path'], partial_path)
+            except OSError as e:
+                logger.warning(f"Could not reuse {reused['path']}, building instead: {str(e)}")
+                reused = None
+        
+        if reused is not None:
+            elapsed = time.time() - start_time
+            returncode, stdout_text, stderr_text = 0, '', ''
+            context_size = reused['context_size'] or context_size
+            build_timings = timings.empty()
+            logger.info(f"Reused unchanged KV cache {reused['path']} for {document_id} ({method})")
+        else:
+            if INCREMENTAL_BUILDS and not force:
+                extended = find_extendable_cache(document_id, temp_file_path)
+            source_path = temp_file_path
+            base_param = ()
+            if extended is not None:
+                # Only the appended text is prefilled, on top of the previous KV state
+                source_path = suffix_path = write_suffix(temp_file_path, extended['content_bytes'])
+                base_param = (extended['path'],)
+                base_tokens = context_sizer.cached_tokens(extended['path'])[0]
+                logger.info(f"Extending {extended['path']} with {content_bytes - extended['content_bytes']} "
+                            f"appended bytes of {document_id}")
+            
+            # Build command to create KV cache
+            # Quoted for the shell: document ids and paths come from requests
+            command = shell_command(CREATE_SCRIPT_PATH, MODEL_PATH, source_path, partial_path, context_size, THREADS,
+                                    BATCH_SIZE, *base_param)
+            returncode, stdout_text, stderr_text, elapsed = run_create_script(job, command, estimated_tokens)
+            # create_kv_cache.sh reports llama.cpp's timing summary on its output
+            build_timings = timings.parse_llama_timings(stdout_text + stderr_text)
+            if stderr_text:
+                logger.warning(f"KV cache stderr: {stderr_text}")
+        build_timings['total_ms'] = round(elapsed * 1000, 1)
+        # What building this text from scratch cost (roughly, for extensions), carried over to later reuses
+        build_ms = build_timings['total_ms']
+        if reused is not None:
+            build_ms = reused['build_ms']
+        elif extended is not None and extended['build_ms']:
+            build_ms += extended['build_ms']
+        cached_tokens = build_timings['prompt_tokens']
+        if extended is not None:
+            cached_tokens = base_tokens + cached_tokens if base_tokens and cached_tokens else None
+        
+        # Get the size of the KV cache file if it was created
+        kv_cache_size = None
+        if returncode != 0:
+            metrics.FAILURES.inc(reason='build_error')
+        is_master = 'master' in document_id.lower() or data.get('setAsMaster', False)
+        # The master path itself is a symlink managed by master_cache and must not be overwritten
+        built_path = partial_path if builds_master_path else kv_cache_path
+        if returncode == 0 and os.path.exists(partial_path) and not builds_master_path:
+            os.replace(partial_path, kv_cache_path)
+            # Copies of the previous version in the hot tier or compressed would shadow the new file
+            tiered_storage.discard(kv_cache_path)
+        if returncode == 0 and os.path.exists(built_path):
+            kv_cache_size = os.path.getsize(built_path)
+            # Queries size their context from the tokens actually prefilled (the estimate as a fallback)
+            context_sizer.remember(built_path, cached_tokens or context_size)
+            if reused is not None:
+                metrics.KV_CACHES_REUSED.inc()
+                if build_ms:
+                    metrics.BUILD_SECONDS_SAVED.inc(max(0.0, build_ms / 1000 - elapsed))
+            else:
+                metrics.KV_CACHES_BUILT.inc()
+                metrics.KV_BYTES_BUILT.inc(kv_cache_size)
+                
+                # Learn the prefill rate so later jobs can report progress
+                if estimated_tokens and elapsed > 0 and extended is None:
+                    rate = estimated_tokens / elapsed
+                    previous = build_rate['tokens_per_second']
+                    build_rate['tokens_per_second'] = rate if previous is None else 0.7 * previous + 0.3 * rate
+            
+            # If this is meant to be the master cache, promote it to a new master version
+            if is_master or builds_master_path:
+                try:
+                    promote_master(built_path, kv_cache_path)
+                except Exception as e:
+                    logger.error(f"Failed to set as master KV cache: {str(e)}")
+            
+            # Chunk caches become routable by their text; the master cache holds everything
+            if not (is_master or builds_master_path):
+                try:
+                    with open(temp_file_path, encoding='utf-8', errors='replace') as f:
+                        routing_index.add(kv_cache_path, document_id, f.read(), data.get('sectionTitle'))
+                except OSError as e:
+                    logger.warning(f"Could not index {kv_cache_path} for routing: {str(e)}")
+                if digest:
+                    retain_source(temp_file_path, digest)
+            
+            if digest:
+                build = {
+                    'path': kv_cache_path, 'context_size': context_size, 'size': kv_cache_size, 'build_ms': build_ms,
+                    'content_hash': digest, 'content_bytes': content_bytes, 'model': model_fingerprint(),
+                    'document_id': document_id, 'estimated_tokens': estimated_tokens,
+                }
+                reusable_builds[(digest, build['model'])] = build
+                document_builds[document_id] = build
+        
+        error = stderr_text if returncode != 0 else None
+        database.record_build(document_id, os.path.basename(temp_file_path), kv_cache_path, context_size,
+                              estimated_tokens, returncode == 0, error, {
+                                  'timings': build_timings,
+                                  'model_fingerprint': model_fingerprint(),
+                                  'kv_cache_size': kv_cache_size,
+                                  'build_ms': build_ms,
+                                  'reused_from': reused['path'] if reused is not None else None,
+                                  'extended_from': extended['path'] if extended is not None else None,
+                                  'content_bytes': content_bytes,
+                                  'job_id': job.id,
+                              }, content_hash=digest)
+        
+        result = {
+            'success': returncode == 0,
+            'documentId': document_id,
+            'kvCachePath': kv_cache_path,
+            'kvCacheSize': kv_cache_size,
+            'contextSize': context_size,
+            'timings': build_timings,
+            'reused': reused is not None,
+            'extended': extended is not None,
+            'error': error,
+            'output': stdout_text
+        }
+        if reused is not None:
+            result['reusedFrom'] = reused['path']
+            result['timeSavedMs'] = round(max(0.0, build_ms - build_timings['total_ms']), 1) if build_ms else None
+        if extended is not None:
+            result['extendedFrom'] = extended['path']
+            result['prefillBytes'] = content_bytes - extended['content_bytes']
+        return result
+    
+    except JobCancelled:
+        metrics.FAILURES.inc(reason='build_cancelled')
+        raise
+    except Exception:
+        metrics.FAILURES.inc(reason='build_error')
+        raise
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        if suffix_path is not None and os.path.exists(suffix_path):
+            os.remove(suffix_path)
+        
+        # Clean up temp file
+        try:
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+                logger.info(f"Cleaned up temp file: {temp_file_path}")
+        except Exception as e:
+            logger.warning(f"Failed to clean up temp file: {str(e)}")
+
+def build_prefix_snapshot(base_path, prefix, target):
+    """Prefill the query template prefix on top of a KV cache; runs on a snapshot thread"""
+    prefix_file = target + '.txt'
+    with open(prefix_file, 'w') as f:
+        f.write(prefix)
+    base_tokens = context_sizer.cached_tokens(base_path)[0]
+    context_size = int(MAX_CONTEXT)
+    if base_tokens:
+        context_size = min((base_tokens + len(prefix) + 256 + 255) // 256 * 256, context_size)
+    command = shell_command(CREATE_SCRIPT_PATH, MODEL_PATH, prefix_file, target, context_size, THREADS, BATCH_SIZE,
+                            base_path)
+    try:
+        returncode, stdout_text, stderr_text, _ = run_create_script(None, command, name='prefix-snapshot')
+    finally:
+        os.remove(prefix_file)
+    if returncode != 0:
+        logger.warning(f"Prompt prefix snapshot build failed: {stderr_text or stdout_text}")
+        return False
+    prefix_tokens = timings.parse_llama_timings(stdout_text + stderr_text)['prompt_tokens']
+    if base_tokens and prefix_tokens:
+        context_sizer.remember(target, base_tokens + prefix_tokens, source='snapshot')
+    return True
+
+def pin_cache(cache_path):
+    """Keep a KV cache resident, with the prefix snapshot that queries actually load"""
+    real_path = kv_residency.pin(cache_path)
+    snapshot = prefix_snapshots.existing(real_path)
+    if snapshot is not None:
+        kv_residency.pin(snapshot)
+    return real_path
+
+def unpin_cache(cache_path):
+    real_path = kv_residency.unpin(cache_path)
+    snapshot = prefix_snapshots.existing(real_path) if os.path.exists(real_path) else None
+    if snapshot is not None:
+        kv_residency.unpin(snapshot)
+    return real_path
+
+def pin_snapshot(base_path, snapshot):
+    """A new snapshot of a pinned cache replaces it for queries, so it is pinned too"""
+    if kv_residency is not None and kv_residency.pinned(base_path):
+        kv_residency.pin(snapshot)
+
+prefix_snapshots = PrefixSnapshots(PREFIX_SNAPSHOT_DIR, QUERY_TEMPLATE, build_prefix_snapshot,
+                                   model_fingerprint=model_fingerprint, enabled=PREFIX_SNAPSHOTS,
+                                   on_removed=forget_kv_file, budget_bytes=PREFIX_SNAPSHOT_BUDGET_MB * 1024 * 1024,
+                                   on_built=pin_snapshot, hot_cache_dir=HOT_TIER_DIR,
+                                   hot_snapshot_dir=HOT_SNAPSHOT_DIR)
+
+def promote_master(source, registered=None):
+    """Make a built cache the master cache without copying it"""
+    previous, current = master_cache.promote(source, registered)
+    logger.info(f"Set {source} as master KV cache at {MASTER_KV_CACHE}")
+    if previous is not None and response_cache is not None:
+        dropped = response_cache.invalidate(previous)
+        logger.info(f"Invalidated {dropped} cached responses for the replaced master cache")
+    if kv_residency is not None and master_pin['enabled']:
+        if previous is not None:
+            unpin_cache(previous)
+        pin_cache(current)
+    prefix_snapshots.prepare(current)
+
+def discard_build(job):
+    """Delete the temp file of a build cancelled before it started"""
+    temp_file_path = job.params.get('tempFilePath', '')
+    if temp_file_path and os.path.exists(temp_file_path):
+        os.remove(temp_file_path)
+        logger.info(f"Cleaned up temp file of cancelled job {job.id}: {temp_file_path}")
+
+build_jobs = JobRegistry(run_cache_build, BUILD_WORKERS, MAX_QUEUED_BUILDS, JOB_RETENTION, discard=discard_build)
+
+def start_worker_pool():
+    """Load the model into the persistent inference workers, if enabled"""
+    global worker_pool, kv_residency
+    
+    if WORKER_POOL_SIZE <= 0:
+        logger.info("Inference worker pool disabled; queries will run the query script")
+        return
+    
+    if not os.path.exists(LLAMACPP_SERVER_BIN):
+        logger.warning(f"llama.cpp server not found at: {LLAMACPP_SERVER_BIN}. Queries will run the query script.")
+        return
+    
+    kv_residency = KVResidencyCache(WORKER_SLOT_DIR, KV_RESIDENT_BUDGET_MB * 1024 * 1024)
+    worker_pool = WorkerPool(
+        WORKER_POOL_SIZE,
+        LLAMACPP_SERVER_BIN,
+        MODEL_PATH,
+        WORKER_SLOT_DIR,
+        base_port=WORKER_BASE_PORT,
+        threads=WORKER_THREADS,
+        ctx_size=MAX_CONTEXT,
+        batch_size=BATCH_SIZE,
+        restart_on_crash=WORKER_RESTART_ON_CRASH,
+        residency=kv_residency,
+        max_batch=QUERY_BATCH_MAX,
+        batch_window=QUERY_BATCH_WINDOW_MS / 1000.0,
+        use_mmap=USE_MMAP
+    )
+    worker_pool.start()
+    
+    if master_pin['enabled']:
+        pin_cache(MASTER_KV_CACHE)
+        logger.info(f"Pinned master KV cache in RAM: {MASTER_KV_CACHE}")
+    logger.info(f"Inference workers ready: {worker_pool.describe()['ready']}/{WORKER_POOL_SIZE}")
+
 def run_server(port=8000):
     server_address = ('', port)
-    httpd = HTTPServer(server_address, CAGHandler)
+    httpd = ThreadingHTTPServer(server_address, CAGHandler)
+    httpd.daemon_threads = True
     
     # Check file existence at startup
     issues = check_files()
@@ -246,6 +1559,22 @@ def run_server(port=8000):
             logger.warning(issue)
         logger.warning("Bridge started with issues. The service may not work correctly.")
     
+    database.start()
+    context_sizer.start()
+    master_cache.start()
+    prefix_snapshots.start()
+    routing_index.load()
+    cold_storage.start()
+    tiered_storage.start()
+    cache_evictor.start()
+    cache_prefetcher.start()
+    usage_recorder.start()
+    start_worker_pool()
+    job_scheduler.start()
+    build_jobs.start()
+    if os.path.exists(MASTER_KV_CACHE):
+        prefix_snapshots.prepare(MASTER_KV_CACHE)
+    
     logger.info(f"Starting CAG Bridge Server on port {port}")
     logger.info(f"Using model: {MODEL_PATH}")
     logger.info(f"Using query script: {QUERY_SCRIPT_PATH}")
@@ -254,6 +1583,8 @@ def run_server(port=8000):
     logger.info(f"Context size: {MAX_CONTEXT}")
     logger.info(f"Threads: {THREADS}")
     logger.info(f"Batch size: {BATCH_SIZE}")
+    logger.info(f"Model loading: {'mmap (shared page cache)' if USE_MMAP else 'private copy (--no-mmap)'}")
+    logger.info(f"Max in-flight jobs: {MAX_INFLIGHT_JOBS}, max queued jobs: {MAX_QUEUED_JOBS}")
     logger.info("Bridge server is ready to accept requests")
     
     try:
@@ -262,6 +1593,10 @@ def run_server(port=8000):
         logger.info("Server shutting down...")
     finally:
         httpd.server_close()
+        usage_recorder.close()
+        database.close()
+        if worker_pool is not None:
+            worker_pool.shutdown()
         logger.info("Server closed")
 
 if __name__ == '__main__':
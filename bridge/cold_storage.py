@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Compressed storage for KV caches that have not been used for a while
+
+A background scan compresses chunk caches whose last use (from the registry,
+this process or the file's mtime) is older than a threshold into a framed
+zstd or lz4 file next to the original, `<name>.bin.zst` or `<name>.bin.lz4`,
+and deletes the original. Loading a cache that only exists compressed
+streams it back to its original path first, so the query scripts, workers
+and registry keep using the same path and never see the compressed file.
+The compressed file carries the original's mtime, and the restored file gets
+it back, so a round trip does not look like a new version of the cache.
+
+zstandard and lz4 are optional: without the configured codec, nothing is
+compressed, and caches compressed with a codec that is not installed cannot
+be loaded.
+"""
+
+import os
+import time
+import shutil
+import logging
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+logger = logging.getLogger("CAG-Bridge")
+
+EXTENSIONS = {'zstd': '.zst', 'lz4': '.lz4'}
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def codec_available(codec):
+    return {'zstd': zstandard, 'lz4': lz4_frame}.get(codec) is not None
+
+
+def compress_file(source, target, codec='zstd', level=3):
+    """Stream `source` into a compressed frame at `target`; returns the compressed size"""
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        if codec == 'zstd':
+            zstandard.ZstdCompressor(level=level).copy_stream(src, dst, read_size=BLOCK_SIZE)
+        elif codec == 'lz4':
+            with lz4_frame.LZ4FrameFile(dst, 'wb', compression_level=level) as out:
+                shutil.copyfileobj(src, out, BLOCK_SIZE)
+        else:
+            raise ValueError(f"Unknown codec: {codec}")
+    return os.path.getsize(target)
+
+
+def decompress_file(source, target):
+    """Stream a .zst or .lz4 file back into `target`"""
+    codec = next((c for c, ext in EXTENSIONS.items() if source.endswith(ext)), None)
+    if codec is None or not codec_available(codec):
+        raise RuntimeError(f"Cannot decompress {source}: {codec or 'unknown'} codec is not installed")
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        if codec == 'zstd':
+            zstandard.ZstdDecompressor().copy_stream(src, dst, read_size=BLOCK_SIZE, write_size=BLOCK_SIZE)
+        else:
+            with lz4_frame.LZ4FrameFile(src, 'rb') as compressed:
+                shutil.copyfileobj(compressed, dst, BLOCK_SIZE)
+
+
+class ColdStorage:
+    """Compresses idle KV caches in a directory and restores them on load
+
+    `last_used()` returns {cache path: epoch seconds} from the registry (or
+    None); paths under `exclude` directories (master versions, snapshots)
+    are never compressed. `on_compressed(path)` is called just before the
+    original of a compressed cache is deleted and returns the bytes it freed
+    besides (e.g. by deleting the cache's snapshots).
+    """
+
+    def __init__(self, cache_dir, codec='zstd', level=3, compress_after_days=0, scan_interval=3600,
+                 last_used=None, exclude=(), on_compressed=None):
+        self.cache_dir = cache_dir
+        self.codec = codec
+        self.level = level
+        self.compress_after = compress_after_days * 86400
+        self.scan_interval = scan_interval
+        self.last_used = last_used or (lambda: None)
+        self.on_compressed = on_compressed
+        self.exclude = tuple(os.path.realpath(p) + os.sep for p in exclude)
+        self.enabled = compress_after_days > 0 and codec_available(codec)
+
+        self._lock = threading.Lock()
+        self._path_locks = {}
+        self._touched = {}  # cache path -> time this process last loaded it
+        self._incompressible = set()  # (path, mtime) of caches that did not shrink
+
+        self.compressed = 0
+        self.restored = 0
+        self.bytes_saved = 0
+        self.restore_seconds = 0.0
+        self.failures = 0
+
+    def start(self):
+        if self.compress_after > 0 and not codec_available(self.codec):
+            logger.warning(f"Cold cache compression disabled: the {self.codec} codec is not installed")
+        if self.enabled:
+            threading.Thread(target=self._run, name='cold-storage', daemon=True).start()
+
+    def path_lock(self, path):
+        """Held while a cache file is compressed, restored or moved between tiers"""
+        with self._lock:
+            return self._path_locks.setdefault(path, threading.Lock())
+
+    def compressed_path(self, path):
+        """The compressed file holding a cache, or None"""
+        for ext in EXTENSIONS.values():
+            if os.path.exists(path + ext):
+                return path + ext
+        return None
+
+    def last_loaded(self, path):
+        """When this process last loaded a cache, or 0"""
+        with self._lock:
+            return self._touched.get(os.path.abspath(path), 0)
+
+    def exists(self, path):
+        return os.path.exists(path) or self.compressed_path(path) is not None
+
+    def ensure(self, path):
+        """Make sure a cache is stored uncompressed at `path` before it is loaded"""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._touched[path] = time.time()
+        if os.path.exists(path):
+            return path
+        with self.path_lock(path):
+            compressed = self.compressed_path(path)
+            if os.path.exists(path) or compressed is None:
+                return path
+            start = time.time()
+            partial_path = path + '.partial'
+            try:
+                stat = os.stat(compressed)
+                decompress_file(compressed, partial_path)
+                os.utime(partial_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                os.replace(partial_path, path)
+                os.remove(compressed)
+            except Exception as e:
+                logger.error(f"Failed to restore compressed KV cache {compressed}: {str(e)}")
+                with self._lock:
+                    self.failures += 1
+                return path
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+            elapsed = time.time() - start
+            with self._lock:
+                self.restored += 1
+                self.restore_seconds += elapsed
+            logger.info(f"Restored compressed KV cache {path} in {elapsed:.2f}s")
+            return path
+
+    def _run(self):
+        while True:
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error(f"Cold cache scan failed: {str(e)}", exc_info=True)
+            time.sleep(self.scan_interval)
+
+    def _candidates(self):
+        """Plain, single-linked .bin files outside the excluded directories"""
+        for root, dirs, files in os.walk(self.cache_dir):
+            real_root = os.path.realpath(root) + os.sep
+            if real_root.startswith(self.exclude):
+                dirs[:] = []
+                continue
+            for name in files:
+                path = os.path.join(root, name)
+                if not name.endswith('.bin') or os.path.islink(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # Hardlinked copies (reused builds) share the space; compressing one would add to it
+                if stat.st_nlink == 1:
+                    yield os.path.abspath(path), stat
+
+    def scan(self):
+        """Compress every cache that has not been used within the threshold"""
+        registry = self.last_used() or {}
+        cutoff = time.time() - self.compress_after
+        for path, stat in list(self._candidates()):
+            with self._lock:
+                touched = self._touched.get(path, 0)
+            if (path, stat.st_mtime) in self._incompressible:
+                continue
+            if max(stat.st_mtime, registry.get(path) or 0, touched) < cutoff:
+                self.compress(path)
+
+    def compress(self, path):
+        with self.path_lock(path):
+            target = path + EXTENSIONS[self.codec]
+            partial_path = target + '.partial'
+            start = time.time()
+            freed = 0
+            try:
+                stat = os.stat(path)
+                size = stat.st_size
+                compressed_size = compress_file(path, partial_path, self.codec, self.level)
+                with self._lock:
+                    used_meanwhile = self._touched.get(path, 0) >= start
+                if compressed_size >= size:
+                    self._incompressible.add((path, stat.st_mtime))
+                if used_meanwhile or compressed_size >= size:
+                    return False
+                os.utime(partial_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                os.replace(partial_path, target)
+                if self.on_compressed is not None:
+                    freed = self.on_compressed(path) or 0
+                os.remove(path)
+            except Exception as e:
+                logger.error(f"Failed to compress KV cache {path}: {str(e)}")
+                with self._lock:
+                    self.failures += 1
+                return False
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+        with self._lock:
+            self.compressed += 1
+            self.bytes_saved += size - compressed_size + freed
+        logger.info(f"Compressed idle KV cache {path}: {size} -> {compressed_size} bytes "
+                    f"in {time.time() - start:.1f}s" + (f", {freed} bytes of snapshots deleted" if freed else ""))
+        return True
+
+    def describe(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'codec': self.codec,
+                'compress_after_days': self.compress_after / 86400,
+                'compressed': self.compressed,
+                'restored': self.restored,
+                'bytes_saved': self.bytes_saved,
+                'avg_restore_seconds': round(self.restore_seconds / self.restored, 3) if self.restored else None,
+                'failures': self.failures,
+            }
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Per-query context sizing from the tokens held in a KV cache
+
+A query only needs room for the tokens already in its KV cache, the prompt
+and the tokens it may generate. Allocating the full LLAMACPP_MAX_CONTEXT for
+a small chunk cache wastes seconds and gigabytes on every query, so the
+context is sized from the cache's real token count instead: read from the
+llama.cpp state file header, reported by the build that wrote the file, or
+looked up in cag_document_registry.
+"""
+
+import os
+import time
+import struct
+import logging
+import threading
+
+logger = logging.getLogger("CAG-Bridge")
+
+# llama_state_save_file() and llama_state_seq_save_file() (used by llama-server slot saves)
+# both start with magic, version and the number of tokens as little-endian uint32s
+STATE_MAGICS = (0x6767736e, 0x67677371)  # 'ggsn', 'ggsq'
+HEADER = struct.Struct('<III')
+MAX_PLAUSIBLE_TOKENS = 1 << 24
+
+PROMPT_CHARS_PER_TOKEN = 3  # Deliberately pessimistic; builds estimate 4
+
+REGISTRY_REFRESH_INTERVAL = 300  # Seconds between bulk loads of the registry's token counts
+MISS_TTL = 60  # Seconds a cache with no known token count is not looked for again
+MIN_REFRESH_GAP = 5  # Seconds between registry loads asked for by unknown caches
+
+
+def read_header_tokens(cache_path):
+    """Token count from a llama.cpp state file header, or None if it has none"""
+    try:
+        with open(cache_path, 'rb') as f:
+            header = f.read(HEADER.size)
+    except OSError:
+        return None
+    if len(header) < HEADER.size:
+        return None
+    magic, _version, n_tokens = HEADER.unpack(header)
+    if magic not in STATE_MAGICS or n_tokens > MAX_PLAUSIBLE_TOKENS:
+        return None
+    return n_tokens
+
+
+def read_state_tokens(cache_path):
+    """Token ids stored after a llama.cpp state file header, or None if it has none
+
+    llama-server only keeps the part of a restored slot that the next prompt
+    starts with, so queries on a worker resend these tokens ahead of the
+    question.
+    """
+    try:
+        with open(cache_path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return None
+            magic, _version, n_tokens = HEADER.unpack(header)
+            if magic not in STATE_MAGICS or n_tokens > MAX_PLAUSIBLE_TOKENS:
+                return None
+            data = f.read(n_tokens * 4)
+    except OSError:
+        return None
+    if len(data) < n_tokens * 4:
+        return None
+    return list(struct.unpack(f'<{n_tokens}i', data))
+
+
+def file_identity(cache_path):
+    """Identify file content across hardlinks (promoted master versions share an inode)"""
+    stat = os.stat(cache_path)
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class ContextSizer:
+    """Chooses the smallest safe --ctx-size for a query against a KV cache
+
+    `lookup()` may return {cache path: token bound} recorded elsewhere (the
+    registry), or None. It is only loaded in bulk on a background thread and
+    consulted when the file header has no count, so a query never waits on
+    it; a cache it does not know is sized to the full context until the next
+    load that finds it.
+    """
+
+    def __init__(self, max_context, margin=256, lookup=None):
+        self.max_context = int(max_context)
+        self.margin = margin
+        self.lookup = lookup
+
+        self._lock = threading.Lock()
+        self._tokens = {}  # file_identity() -> (tokens, source)
+        self._registry = {}  # absolute cache path -> tokens, from the last lookup
+        self._misses = {}  # file_identity() -> when no count was found
+        self._refresh = threading.Event()
+
+        self.registry_loads = 0
+        self.last_registry_load = None
+
+        self.sized = 0
+        self.unknown = 0
+        self.tokens_saved = 0
+
+    def start(self):
+        if self.lookup is not None:
+            threading.Thread(target=self._run, name='context-sizing', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.load_registry()
+            except Exception as e:
+                logger.error(f"Loading registry token counts failed: {str(e)}", exc_info=True)
+            time.sleep(MIN_REFRESH_GAP)
+            self._refresh.wait(REGISTRY_REFRESH_INTERVAL - MIN_REFRESH_GAP)
+            self._refresh.clear()
+
+    def load_registry(self):
+        """Replace the registry token counts with a fresh bulk lookup; keeps the old ones if it fails"""
+        registry = self.lookup()
+        if registry is None:
+            return
+        with self._lock:
+            self._registry = registry
+            # Caches that were unknown may be registered now
+            self._misses.clear()
+            self.registry_loads += 1
+            self.last_registry_load = time.time()
+
+    def remember(self, cache_path, tokens, source='build'):
+        """Record the token count a build reported for the file it wrote"""
+        if not tokens:
+            return
+        try:
+            identity = file_identity(cache_path)
+        except OSError:
+            return
+        with self._lock:
+            self._tokens[identity] = (int(tokens), source)
+
+    def cached_tokens(self, cache_path):
+        """(tokens, source) for a KV cache; tokens is None if it cannot be determined"""
+        try:
+            identity = file_identity(cache_path)
+        except OSError:
+            return None, None
+        with self._lock:
+            known = self._tokens.get(identity)
+        if known is not None:
+            return known
+
+        tokens, source = read_header_tokens(cache_path), 'header'
+        with self._lock:
+            if tokens is None:
+                tokens, source = self._registry.get(os.path.abspath(cache_path)), 'registry'
+            if tokens is None:
+                tokens = self._registry.get(os.path.realpath(cache_path))
+            if tokens is None:
+                missed = self._misses.get(identity)
+                if self.lookup is not None and (missed is None or time.time() - missed > MISS_TTL):
+                    # Have the background thread look again instead of querying from the request
+                    self._misses[identity] = time.time()
+                    self._refresh.set()
+                return None, None
+            self._tokens[identity] = (tokens, source)
+        return tokens, source
+
+    def size_for(self, cache_path, prompt, max_tokens):
+        """Context size for answering `prompt` with up to `max_tokens` on top of a cache"""
+        tokens, source = self.cached_tokens(cache_path)
+        if tokens is None:
+            with self._lock:
+                self.unknown += 1
+            return self.max_context, None
+
+        prompt_tokens = len(prompt) // PROMPT_CHARS_PER_TOKEN + 1
+        needed = tokens + prompt_tokens + int(max_tokens) + self.margin
+        ctx_size = min((needed + 255) // 256 * 256, self.max_context)
+        with self._lock:
+            self.sized += 1
+            self.tokens_saved += self.max_context - ctx_size
+        if needed > self.max_context:
+            logger.warning(f"Query needs about {needed} tokens of context but only {self.max_context} are allowed")
+        logger.debug(f"Sized query context to {ctx_size} for {tokens} cached tokens ({source})")
+        return ctx_size, tokens
+
+    def describe(self):
+        with self._lock:
+            return {
+                'max_context': self.max_context,
+                'margin': self.margin,
+                'known_caches': len(self._tokens),
+                'registry_caches': len(self._registry),
+                'registry_loads': self.registry_loads,
+                'last_registry_load': self.last_registry_load,
+                'sized': self.sized,
+                'unknown': self.unknown,
+                'avg_tokens_saved': round(self.tokens_saved / self.sized) if self.sized else 0,
+            }
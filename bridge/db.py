@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+PostgreSQL bookkeeping for the CAG bridge
+
+Records finished cache builds in cag_document_registry and answered queries
+in query_log (see database/schema.sql) so slow paths can be found with SQL.
+Writes go through a background thread and never fail a request. Query rows
+are buffered in memory and inserted in multi-row batches; when the buffer is
+full because the database is slow or down, new rows are dropped and counted
+instead of holding up requests. Lookups use a separate connection and
+return None on any error. psycopg2 is optional: without it, or without a
+configured host, nothing is written or read.
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+from collections import deque
+
+import metrics
+
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+logger = logging.getLogger("CAG-Bridge")
+
+RECORD_DOCUMENT_SQL = """
+INSERT INTO documents (document_id, file_name, status, processed_at, error_message, content_hash)
+VALUES (%s, %s, %s, NOW(), %s, %s)
+ON CONFLICT (document_id) DO UPDATE SET
+    status = EXCLUDED.status,
+    content_hash = EXCLUDED.content_hash,
+    processed_at = EXCLUDED.processed_at,
+    error_message = EXCLUDED.error_message,
+    updated_at = NOW()
+"""
+
+RECORD_BUILD_SQL = """
+INSERT INTO cag_document_registry (
+    document_id, chunk_id, file_name, chunk_index, total_chunks, estimated_tokens,
+    processed_at, kv_cache_path, context_size, cag_status, error_message, processing_meta, content_hash
+)
+VALUES (%s, %s, %s, 0, 1, %s, NOW(), %s, %s, %s, %s, %s::jsonb, %s)
+ON CONFLICT (chunk_id) DO UPDATE SET
+    estimated_tokens = EXCLUDED.estimated_tokens,
+    content_hash = EXCLUDED.content_hash,
+    processed_at = EXCLUDED.processed_at,
+    kv_cache_path = EXCLUDED.kv_cache_path,
+    context_size = EXCLUDED.context_size,
+    cag_status = EXCLUDED.cag_status,
+    error_message = EXCLUDED.error_message,
+    processing_meta = COALESCE(cag_document_registry.processing_meta, '{}'::jsonb) || EXCLUDED.processing_meta
+"""
+
+# Filled in by execute_values with one row per query; processed_at is when the query was answered
+LOG_QUERIES_SQL = """
+INSERT INTO query_log (
+    query_id, query_text, response_text, query_type, document_ids, chunks_used,
+    processing_time, success, error_message, metadata, processed_at
+)
+VALUES %s
+"""
+LOG_QUERY_ROW = ("(%s, %s, %s, %s, %s::text[], %s::text[], %s, %s, %s, %s::jsonb, "
+                 "to_timestamp(%s) AT TIME ZONE current_setting('TimeZone'))")
+
+CACHE_TOKENS_SQL = """
+SELECT DISTINCT ON (kv_cache_path) kv_cache_path, COALESCE(context_size, estimated_tokens)
+FROM cag_document_registry
+WHERE kv_cache_path IS NOT NULL AND cag_status = 'cached'
+ORDER BY kv_cache_path, processed_at DESC NULLS LAST
+"""
+
+REUSABLE_CACHES_SQL = """
+SELECT kv_cache_path, context_size, (processing_meta->>'kv_cache_size')::bigint,
+       COALESCE(processing_meta->>'build_ms', processing_meta->'timings'->>'total_ms')::float
+FROM cag_document_registry
+WHERE content_hash = %s AND cag_status = 'cached' AND processing_meta->>'model_fingerprint' = %s
+ORDER BY processed_at DESC NULLS LAST
+LIMIT 5
+"""
+
+PREVIOUS_BUILDS_SQL = """
+SELECT kv_cache_path, context_size, (processing_meta->>'kv_cache_size')::bigint,
+       COALESCE(processing_meta->>'build_ms', processing_meta->'timings'->>'total_ms')::float,
+       content_hash, (processing_meta->>'content_bytes')::bigint
+FROM cag_document_registry
+WHERE chunk_id = %s AND cag_status = 'cached' AND content_hash IS NOT NULL
+  AND processing_meta->>'model_fingerprint' = %s
+"""
+
+CACHE_USAGE_SQL = """
+SELECT kv_cache_path, EXTRACT(EPOCH FROM last_used AT TIME ZONE current_setting('TimeZone')), usage_count,
+       COALESCE(processing_meta->>'build_ms', processing_meta->'timings'->>'total_ms')::float,
+       cag_status, document_id, content_hash, estimated_tokens
+FROM cag_document_registry
+WHERE kv_cache_path IS NOT NULL AND cag_status IN ('cached', 'evicted')
+"""
+
+MARK_EVICTED_SQL = """
+UPDATE cag_document_registry
+SET cag_status = 'evicted', processing_meta = COALESCE(processing_meta, '{}'::jsonb) || %s::jsonb
+WHERE kv_cache_path = %s AND cag_status = 'cached'
+"""
+
+EVICTED_CACHE_SQL = """
+SELECT document_id, content_hash, estimated_tokens
+FROM cag_document_registry
+WHERE kv_cache_path = ANY(%s) AND cag_status = 'evicted' AND content_hash IS NOT NULL
+ORDER BY processed_at DESC NULLS LAST
+LIMIT 1
+"""
+
+QUERY_HISTORY_SQL = """
+SELECT kv_cache, FLOOR(EXTRACT(EPOCH FROM processed_at AT TIME ZONE current_setting('TimeZone')) / 3600)::bigint,
+       COUNT(*)
+FROM (
+    SELECT processed_at, metadata->>'kv_cache' AS kv_cache
+    FROM query_log
+    WHERE processed_at > NOW() - %s * INTERVAL '1 day' AND metadata ? 'kv_cache'
+    UNION ALL
+    SELECT processed_at, jsonb_array_elements_text(metadata->'kv_caches')
+    FROM query_log
+    WHERE processed_at > NOW() - %s * INTERVAL '1 day' AND jsonb_typeof(metadata->'kv_caches') = 'array'
+) uses
+WHERE kv_cache IS NOT NULL
+GROUP BY 1, 2
+"""
+
+RECORD_CACHE_SIZE_SQL = """
+INSERT INTO processing_stats (record_date, total_cache_size_bytes)
+VALUES (CURRENT_DATE, %s)
+ON CONFLICT (record_date) DO UPDATE SET total_cache_size_bytes = EXCLUDED.total_cache_size_bytes
+"""
+
+# Filled in by execute_values with one (kv_cache_path, uses, last use) row per used cache
+UPDATE_USAGE_SQL = """
+UPDATE cag_document_registry AS r
+SET usage_count = COALESCE(r.usage_count, 0) + v.uses,
+    last_used = GREATEST(r.last_used, v.last_used)
+FROM (VALUES %s) AS v(kv_cache_path, uses, last_used)
+WHERE r.kv_cache_path = v.kv_cache_path AND r.cag_status = 'cached'
+"""
+UPDATE_USAGE_ROW = "(%s, %s::integer, to_timestamp(%s) AT TIME ZONE current_setting('TimeZone'))"
+
+RELOCATE_CACHE_SQL = """
+UPDATE cag_document_registry SET kv_cache_path = %s WHERE kv_cache_path = %s
+"""
+
+
+class Database:
+    """Single-connection writer for bridge records"""
+
+    def __init__(self, host, port=5432, name='llamacag', user='llamacag', password='',
+                 query_log_buffer=10000, query_log_batch=500, query_log_interval=1.0):
+        self.params = {'host': host, 'port': port, 'dbname': name, 'user': user, 'password': password}
+        self.enabled = bool(host) and psycopg2 is not None
+        self.query_log_buffer = max(1, query_log_buffer)
+        self.query_log_batch = max(1, query_log_batch)
+        self.query_log_interval = query_log_interval
+
+        self._queue = queue.Queue()
+        self._conn = None
+        self._thread = None
+        self._read_lock = threading.Lock()
+        self._read_conn = None
+
+        self._query_lock = threading.Lock()
+        self._query_rows = deque()  # query_log rows waiting to be inserted
+        self._query_batch_ready = threading.Event()
+        self._query_in_flight = None  # threading.Event of the batch being inserted
+
+        self.written = 0
+        self.failed = 0
+        self.last_error = None
+        self.queries_logged = 0
+        self.queries_dropped = 0
+        self.query_batches = 0
+        self.last_query_batch_ms = None
+
+    def start(self):
+        if not self.enabled:
+            reason = 'psycopg2 is not installed' if psycopg2 is None else 'DB_HOST is not set'
+            logger.info(f"Database logging disabled ({reason})")
+            return
+        self._thread = threading.Thread(target=self._work, name='db-writer', daemon=True)
+        self._thread.start()
+        threading.Thread(target=self._flush_query_log, name='query-log', daemon=True).start()
+
+    def _submit(self, statements, on_done=None):
+        """Queue statements for the writer; `on_done(error)` is called once they are committed or failed"""
+        if self.enabled:
+            self._queue.put((statements, on_done))
+        elif on_done is not None:
+            on_done(RuntimeError('database is disabled'))
+
+    def _work(self):
+        while True:
+            statements, on_done = self._queue.get()
+            error = None
+            try:
+                self._execute(statements)
+                self.written += 1
+            except Exception as e:
+                error = e
+                self.failed += 1
+                self.last_error = str(e)
+                logger.warning(f"Database write failed: {str(e)}")
+                self._close()
+            if on_done is not None:
+                on_done(error)
+
+    def _execute(self, statements):
+        """Run statements in one transaction, reconnecting if needed
+
+        A statement with a third element is a bulk statement: its params are
+        a list of rows expanded into `VALUES %s` with that row template.
+        """
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(connect_timeout=5, **self.params)
+        with self._conn:
+            with self._conn.cursor() as cursor:
+                for statement in statements:
+                    if len(statement) > 2:
+                        sql, rows, template = statement
+                        psycopg2.extras.execute_values(cursor, sql, rows, template=template, page_size=1000)
+                    else:
+                        cursor.execute(*statement)
+
+    def _close(self):
+        try:
+            if self._conn is not None:
+                self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+    def _fetch_all(self, sql, params):
+        """Run a read-only query on the lookup connection; None if it fails"""
+        if not self.enabled:
+            return None
+        with self._read_lock:
+            try:
+                if self._read_conn is None or self._read_conn.closed:
+                    self._read_conn = psycopg2.connect(connect_timeout=5, **self.params)
+                    self._read_conn.autocommit = True
+                with self._read_conn.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    return cursor.fetchall()
+            except Exception as e:
+                self.last_error = str(e)
+                logger.warning(f"Database lookup failed: {str(e)}")
+                try:
+                    self._read_conn.close()
+                except Exception:
+                    pass
+                self._read_conn = None
+                return None
+
+    def cache_tokens(self):
+        """{kv_cache_path: upper bound on its tokens (its build context size)} for cached caches, or None"""
+        rows = self._fetch_all(CACHE_TOKENS_SQL, None)
+        if rows is None:
+            return None
+        return {os.path.abspath(path): tokens for path, tokens in rows if tokens}
+
+    def reusable_caches(self, content_hash, model_fingerprint):
+        """Cached builds of identical text with the same model, newest first"""
+        rows = self._fetch_all(REUSABLE_CACHES_SQL, (content_hash, model_fingerprint)) or []
+        return [{'path': path, 'context_size': context_size, 'size': size, 'build_ms': build_ms}
+                for path, context_size, size, build_ms in rows]
+
+    def previous_builds(self, document_id, model_fingerprint):
+        """The registered cache of a document, with the size and hash of the text it was built from"""
+        rows = self._fetch_all(PREVIOUS_BUILDS_SQL, (document_id, model_fingerprint)) or []
+        return [{'path': path, 'context_size': context_size, 'size': size, 'build_ms': build_ms,
+                 'content_hash': digest, 'content_bytes': content_bytes}
+                for path, context_size, size, build_ms, digest, content_bytes in rows]
+
+    def cache_usage(self):
+        """{kv_cache_path: registry row} for cached and evicted caches, or None
+
+        Rows hold last_used (epoch seconds), usage_count, build_ms, status,
+        document_id, content_hash and estimated_tokens.
+        """
+        rows = self._fetch_all(CACHE_USAGE_SQL, None)
+        if rows is None:
+            return None
+        return {os.path.abspath(path): {'last_used': float(last_used) if last_used is not None else None,
+                                        'usage_count': usage_count or 0, 'build_ms': build_ms, 'status': status,
+                                        'document_id': document_id, 'content_hash': digest,
+                                        'estimated_tokens': estimated_tokens}
+                for path, last_used, usage_count, build_ms, status, document_id, digest, estimated_tokens in rows}
+
+    def cache_last_used(self):
+        """{kv_cache_path: last use as epoch seconds} for cached caches, or None"""
+        usage = self.cache_usage()
+        if usage is None:
+            return None
+        return {path: row['last_used'] for path, row in usage.items()
+                if row['last_used'] is not None and row['status'] == 'cached'}
+
+    def mark_evicted(self, kv_cache_path, size):
+        """Flag the registry rows of a deleted cache so it can be rebuilt on demand"""
+        meta = {'evicted_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'evicted_bytes': size}
+        self._submit([(MARK_EVICTED_SQL, (json.dumps(meta), kv_cache_path))])
+
+    def evicted_cache(self, kv_cache_paths):
+        """document_id, content_hash and estimated_tokens of an evicted cache, or None"""
+        rows = self._fetch_all(EVICTED_CACHE_SQL, (sorted(kv_cache_paths),))
+        if not rows:
+            return None
+        document_id, digest, estimated_tokens = rows[0]
+        return {'document_id': document_id, 'content_hash': digest, 'estimated_tokens': estimated_tokens}
+
+    def query_history(self, days):
+        """(kv_cache_path, hour bucket as epoch seconds // 3600, queries) from the last `days` of query_log"""
+        return self._fetch_all(QUERY_HISTORY_SQL, (days, days))
+
+    def record_cache_size(self, total_bytes):
+        """Set today's processing_stats.total_cache_size_bytes"""
+        self._submit([(RECORD_CACHE_SIZE_SQL, (total_bytes,))])
+
+    def update_usage(self, rows, on_done=None):
+        """Add (kv_cache_path, uses, last use as epoch seconds) rows to the registry's usage counts"""
+        self._submit([(UPDATE_USAGE_SQL, rows, UPDATE_USAGE_ROW)], on_done)
+
+    def relocate_cache(self, old_path, new_path):
+        """Point registry rows at a cache file's new location"""
+        self._submit([(RELOCATE_CACHE_SQL, (new_path, old_path))])
+
+    def record_build(self, document_id, file_name, kv_cache_path, context_size, estimated_tokens,
+                     success, error, processing_meta, content_hash=None):
+        """Upsert the document and its registry row after a cache build"""
+        status = 'cached' if success else 'failed'
+        self._submit([
+            (RECORD_DOCUMENT_SQL, (document_id, file_name, status, error, content_hash)),
+            (RECORD_BUILD_SQL, (document_id, document_id, file_name, estimated_tokens or None,
+                                kv_cache_path, context_size, status, error, json.dumps(processing_meta),
+                                content_hash)),
+        ])
+
+    def log_query(self, query_text, response_text, query_type, processing_ms, success, error,
+                  metadata, document_ids=None, chunks_used=None):
+        """Buffer a row for query_log; dropped (and counted) when the buffer is full"""
+        if not self.enabled:
+            return
+        row = (uuid.uuid4().hex, query_text, response_text, query_type, document_ids, chunks_used,
+               int(processing_ms), success, error, json.dumps(metadata), time.time())
+        with self._query_lock:
+            if len(self._query_rows) >= self.query_log_buffer:
+                self.queries_dropped += 1
+                metrics.QUERY_LOG_DROPPED.inc()
+                return
+            self._query_rows.append(row)
+            if len(self._query_rows) >= self.query_log_batch:
+                self._query_batch_ready.set()
+
+    def _flush_query_log(self):
+        while True:
+            self._query_batch_ready.wait(self.query_log_interval)
+            self._query_batch_ready.clear()
+            try:
+                self.flush_query_log()
+            except Exception as e:
+                logger.error(f"Query log flush failed: {str(e)}", exc_info=True)
+
+    def flush_query_log(self):
+        """Hand the buffered query rows to the writer as one insert; returns an Event set when done, or None"""
+        with self._query_lock:
+            if not self._query_rows:
+                return None
+            if self._query_in_flight is not None and not self._query_in_flight.is_set():
+                # Only one batch is queued at a time, so a slow database fills the buffer instead of the queue
+                return None
+            rows = list(self._query_rows)
+            self._query_rows.clear()
+            done = self._query_in_flight = threading.Event()
+        start = time.time()
+
+        def on_done(error):
+            elapsed = time.time() - start
+            with self._query_lock:
+                if error is None:
+                    self.queries_logged += len(rows)
+                    self.query_batches += 1
+                    self.last_query_batch_ms = round(elapsed * 1000, 1)
+                else:
+                    # Retried with the next batch, oldest first, as far as the buffer has room
+                    room = max(0, self.query_log_buffer - len(self._query_rows))
+                    self._query_rows.extendleft(reversed(rows[-room:] if room else []))
+                    lost = len(rows) - min(room, len(rows))
+                    self.queries_dropped += lost
+                    metrics.QUERY_LOG_DROPPED.inc(lost)
+            if error is None:
+                metrics.QUERY_LOG_FLUSH_SECONDS.observe(elapsed)
+            done.set()
+
+        self._submit([(LOG_QUERIES_SQL, rows, LOG_QUERY_ROW)], on_done)
+        return done
+
+    def close(self, timeout=5.0):
+        """Insert the buffered query rows before shutdown"""
+        if not self.enabled:
+            return
+        deadline = time.time() + timeout
+        with self._query_lock:
+            in_flight = self._query_in_flight
+        if in_flight is not None:
+            in_flight.wait(timeout)
+        done = self.flush_query_log()
+        if done is not None and not done.wait(max(0.0, deadline - time.time())):
+            logger.warning("Buffered query log rows were not written before shutdown")
+
+    def describe(self):
+        return {
+            'enabled': self.enabled,
+            'host': self.params['host'] or None,
+            'pending': self._queue.qsize(),
+            'query_log': {
+                'buffered': len(self._query_rows),
+                'logged': self.queries_logged,
+                'dropped': self.queries_dropped,
+                'batches': self.query_batches,
+                'last_batch_ms': self.last_query_batch_ms,
+            },
+            'written': self.written,
+            'failed': self.failed,
+            'last_error': self.last_error,
+        }
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Disk budget for KV cache storage
+
+A periodic scan adds up the bytes under the cache directories (kv_caches and
+the hot tier). Once they pass the high watermark of the budget, chunk caches
+are deleted, least valuable per byte first, until usage is back under the
+low watermark. A cache's value grows with how often it has been used and
+how long it took to build, and decays with the time since its last use, so
+large, rarely used caches that are quick to rebuild go first.
+
+Evicted caches are reported through `on_evicted(path, size)`, which marks
+their registry rows 'evicted' so they can be rebuilt on demand from the
+retained chunk text. Prompt prefix snapshots compete with the caches: they
+are rebuilt by a single prefill, so an idle snapshot goes before an idle
+cache of the same size.
+"""
+
+import os
+import time
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger("CAG-Bridge")
+
+RECENT_USE = 600  # Caches loaded within this many seconds are never evicted
+DEFAULT_BUILD_SECONDS = 60  # Assumed rebuild cost of caches without a recorded build time
+
+
+def eviction_priority(size, usage_count, idle_seconds, build_seconds):
+    """Value kept per byte; the lowest is evicted first"""
+    if build_seconds is None:
+        build_seconds = DEFAULT_BUILD_SECONDS
+    value = (1 + (usage_count or 0)) * (1 + build_seconds) / (1 + max(0.0, idle_seconds) / 86400)
+    return value / max(1, size)
+
+
+class CacheEvictor:
+    """Keeps the bytes under `cache_dirs` within a budget by deleting chunk caches
+
+    `usage()` returns {cache path: registry row} with last_used, usage_count
+    and build_ms (or None); `last_loaded(path)` returns when this process
+    last loaded a cache, and `lock(path)` guards it against concurrent
+    moves. Files under `exclude` (master versions, snapshots) are counted but
+    never evicted as caches. `on_evicted(path, size)` returns the bytes it
+    freed besides the cache itself (e.g. its snapshots).
+
+    `snapshots()` lists (path, size, last use) of prompt prefix snapshots and
+    `remove_snapshot(path)` deletes one, returning the bytes freed.
+    """
+
+    def __init__(self, cache_dirs, budget_bytes, high_watermark=0.9, low_watermark=0.75, interval=300,
+                 usage=None, last_loaded=None, lock=None, on_evicted=None, on_scanned=None, exclude=(),
+                 snapshots=None, remove_snapshot=None):
+        self.cache_dirs = [os.path.abspath(d) for d in cache_dirs if d]
+        self.budget_bytes = budget_bytes
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.interval = interval
+        self.usage = usage or (lambda: None)
+        self.last_loaded = last_loaded or (lambda path: 0)
+        self.lock = lock or (lambda path: contextlib.nullcontext())
+        self.on_evicted = on_evicted
+        self.on_scanned = on_scanned  # Called with the total bytes after every scan
+        self.exclude = tuple(os.path.realpath(p) + os.sep for p in exclude)
+        self.snapshots = snapshots or (lambda: [])
+        self.remove_snapshot = remove_snapshot
+        self.enabled = budget_bytes > 0
+
+        self._lock = threading.Lock()
+        self.used_bytes = None
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.last_scan = None
+
+    def start(self):
+        # Usage is measured (and reported to on_scanned) even without a budget
+        threading.Thread(target=self._run, name='cache-evictor', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error(f"Cache eviction scan failed: {str(e)}", exc_info=True)
+            time.sleep(self.interval)
+
+    def _files(self):
+        """(path, size, mtime, evictable) of every file, hardlinks counted once"""
+        seen = set()
+        for cache_dir in self.cache_dirs:
+            for root, _dirs, files in os.walk(cache_dir):
+                excluded = (os.path.realpath(root) + os.sep).startswith(self.exclude)
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.lstat(path)
+                    except OSError:
+                        continue
+                    if (stat.st_dev, stat.st_ino) in seen:
+                        continue
+                    seen.add((stat.st_dev, stat.st_ino))
+                    # Chunk caches, plain or compressed by cold_storage; deleting one name of a
+                    # hardlinked (reused) cache would free nothing
+                    evictable = (not excluded and not os.path.islink(path) and stat.st_nlink == 1
+                                 and name.endswith(('.bin', '.bin.zst', '.bin.lz4')))
+                    yield path, stat.st_size, stat.st_mtime, evictable
+
+    def scan(self):
+        """Measure usage and evict down to the low watermark once it passes the high one"""
+        files = list(self._files())
+        used = sum(size for _path, size, _mtime, _evictable in files)
+        if self.enabled and used > self.budget_bytes * self.high_watermark:
+            used = self._evict(files, used, self.budget_bytes * self.low_watermark)
+        with self._lock:
+            self.used_bytes = used
+            self.last_scan = time.time()
+        if self.on_scanned is not None:
+            self.on_scanned(used)
+        return used
+
+    def _evict(self, files, used, target):
+        usage = self.usage() or {}
+        now = time.time()
+        candidates = []
+        for path, size, mtime, evictable in files:
+            if not evictable:
+                continue
+            cache_path = path[:-4] if path.endswith(('.zst', '.lz4')) else path
+            row = usage.get(os.path.abspath(cache_path)) or {}
+            last_use = max(mtime, row.get('last_used') or 0, self.last_loaded(cache_path) or 0)
+            if last_use > now - RECENT_USE:
+                continue
+            build_ms = row.get('build_ms')
+            priority = eviction_priority(size, row.get('usage_count'), now - last_use,
+                                         build_ms / 1000 if build_ms else None)
+            candidates.append((priority, path, cache_path, size))
+        if self.remove_snapshot is not None:
+            counted = tuple(os.path.realpath(d) + os.sep for d in self.cache_dirs)
+            for path, size, last_use in self.snapshots():
+                # Snapshots stored outside the cache directories do not count towards the budget
+                if last_use > now - RECENT_USE or not os.path.realpath(path).startswith(counted):
+                    continue
+                candidates.append((eviction_priority(size, 0, now - last_use, 0), path, None, size))
+
+        logger.info(f"KV cache storage at {used} of {self.budget_bytes} budget bytes; evicting down to {int(target)}")
+        for _priority, path, cache_path, size in sorted(candidates):
+            if used <= target:
+                break
+            if cache_path is None:
+                freed = self.remove_snapshot(path)
+                used -= freed
+                if freed:
+                    with self._lock:
+                        self.evicted_bytes += freed
+                    logger.info(f"Evicted prompt prefix snapshot {path} ({freed} bytes)")
+                continue
+            try:
+                with self.lock(cache_path):
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.error(f"Failed to evict KV cache {path}: {str(e)}")
+                continue
+            freed = size
+            if self.on_evicted is not None:
+                freed += self.on_evicted(cache_path, size) or 0
+            used -= freed
+            with self._lock:
+                self.evictions += 1
+                self.evicted_bytes += freed
+            logger.info(f"Evicted KV cache {path} ({size} bytes)")
+        if used > target:
+            logger.warning(f"KV cache storage still at {used} bytes after eviction; "
+                           f"the rest is recently used or not evictable")
+        return used
+
+    def describe(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'budget_bytes': self.budget_bytes,
+                'high_watermark': self.high_watermark,
+                'low_watermark': self.low_watermark,
+                'used_bytes': self.used_bytes,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+                'last_scan': self.last_scan,
+            }
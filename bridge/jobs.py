@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Background job registry for KV cache builds
+
+/create-cache submits a build and returns a job id straight away; builds run
+on background threads so they survive the HTTP client disconnecting, and can
+be polled with GET /jobs/{id} or cancelled with DELETE /jobs/{id}.
+
+Builds are single-flight: a request identical to a queued or running one
+(same document, content and target) attaches to that job instead of
+starting another prefill, and a retried request carrying the same
+idempotency key gets the original job back.
+"""
+
+import os
+import time
+import uuid
+import signal
+import logging
+import threading
+from collections import deque, OrderedDict
+
+from scheduler import QueueFullError
+
+logger = logging.getLogger("CAG-Bridge")
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """Raised inside a runner when its job was cancelled"""
+    pass
+
+
+class Job:
+    """State of a single background build"""
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.params = params
+        self.state = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.estimated_seconds = None  # Set by the runner when it can predict the duration
+        self.dedupe_key = None
+        self.attached = 0  # Duplicate requests answered by this job
+
+        self._process = None
+        self._cancel_requested = False
+        self._finished = threading.Event()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_requested
+
+    def attach_process(self, process):
+        """Register the subprocess doing the work so it can be cancelled"""
+        self._process = process
+        if self._cancel_requested:
+            self._kill_process()
+
+    def _kill_process(self):
+        process = self._process
+        if process is None or process.poll() is not None:
+            return
+        try:
+            # Builds run in their own session so the whole llama.cpp process group goes
+            os.killpg(process.pid, signal.SIGTERM)
+            # A build paused for queries only acts on SIGTERM once continued
+            os.killpg(process.pid, signal.SIGCONT)
+        except (ProcessLookupError, PermissionError):
+            process.terminate()
+
+    def wait(self, timeout=None):
+        return self._finished.wait(timeout)
+
+    def progress(self):
+        """Best-effort progress report for the current state"""
+        if self.state == QUEUED:
+            return {'phase': 'queued', 'percent': 0}
+        if self.state in FINISHED_STATES:
+            return {'phase': self.state, 'percent': 100 if self.state == DONE else None}
+
+        elapsed = time.time() - self.started_at
+        percent = None
+        if self.estimated_seconds:
+            # Never claim completion before the process has actually exited
+            percent = min(99, int(elapsed / self.estimated_seconds * 100))
+        return {'phase': 'prefill', 'percent': percent, 'estimated_seconds': self.estimated_seconds}
+
+    def describe(self):
+        now = time.time()
+        end = self.finished_at or now
+        return {
+            'jobId': self.id,
+            'kind': self.kind,
+            'status': self.state,
+            'cancelRequested': self._cancel_requested,
+            'progress': self.progress(),
+            'createdAt': self.created_at,
+            'queuedSeconds': round((self.started_at or end) - self.created_at, 2),
+            'elapsedSeconds': round(end - self.started_at, 2) if self.started_at else None,
+            'documentId': self.params.get('documentId'),
+            'attachedRequests': self.attached,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class JobRegistry:
+    """Bounded FIFO of background jobs executed by a fixed set of threads
+
+    `runner(job)` does the work and returns the job's result dict; raising
+    marks the job failed, raising JobCancelled marks it cancelled.
+    `discard(job)` releases what a job that is cancelled before it runs
+    holds (e.g. its temp document file).
+    """
+
+    def __init__(self, runner, workers=1, max_queued=16, retention=3600, discard=None):
+        self.runner = runner
+        self.discard = discard
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.retention = retention
+
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._jobs = OrderedDict()
+        self._threads = []
+        self._inflight = {}  # dedupe key -> queued or running job
+        self._idempotency = {}  # idempotency key -> job
+
+        self.avg_job_seconds = 60.0  # Seed for Retry-After until jobs complete
+        self.deduplicated = 0
+        self.idempotent_replays = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'build-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, kind, params, dedupe_key=None, idempotency_key=None):
+        """Queue a job, or find the one that already answers this request
+
+        Returns (job, created). A job submitted earlier with the same
+        `idempotency_key` is returned unless it failed or was cancelled; a
+        queued or running job with the same `dedupe_key` is attached to.
+        """
+        with self._cond:
+            self._prune()
+            job = self._replay(idempotency_key)
+            if job is not None:
+                return job, False
+
+            job = self._inflight.get(dedupe_key) if dedupe_key else None
+            if job is not None:
+                job.attached += 1
+                self.deduplicated += 1
+                if idempotency_key:
+                    self._idempotency[idempotency_key] = job
+                logger.info(f"Attached duplicate {kind} request for {params.get('documentId')} to job {job.id}")
+                return job, False
+
+            if len(self._queue) >= self.max_queued:
+                raise QueueFullError(f"Too many queued builds ({len(self._queue)} waiting)", 429,
+                                     self._retry_after())
+            job = Job(kind, params)
+            job.dedupe_key = dedupe_key
+            self._jobs[job.id] = job
+            self._queue.append(job)
+            if dedupe_key:
+                self._inflight[dedupe_key] = job
+            if idempotency_key:
+                self._idempotency[idempotency_key] = job
+            self._cond.notify()
+        logger.info(f"Queued {kind} job {job.id} for {params.get('documentId')}")
+        return job, True
+
+    def _retry_after(self):
+        """Estimate seconds until a queued job would start; called with the lock held"""
+        estimate = self.avg_job_seconds * (len(self._queue) + 1) / self.workers
+        return max(1, int(round(estimate)))
+
+    def replay(self, idempotency_key):
+        """The job an earlier request with this idempotency key started, if it can be reused"""
+        with self._cond:
+            self._prune()
+            return self._replay(idempotency_key)
+
+    def _replay(self, idempotency_key):
+        job = self._idempotency.get(idempotency_key) if idempotency_key else None
+        if job is None or job.state in (FAILED, CANCELLED):
+            return None
+        job.attached += 1
+        self.idempotent_replays += 1
+        logger.info(f"Idempotency key {idempotency_key} matched {job.kind} job {job.id}")
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns the job or None if unknown"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.state in FINISHED_STATES:
+                return job
+            job._cancel_requested = True
+            queued = job.state == QUEUED
+            if queued:
+                self._queue.remove(job)
+                self._finish(job, CANCELLED, error='Cancelled before start')
+        if queued:
+            # The runner never saw this job, so nothing else releases what it holds
+            if self.discard is not None:
+                try:
+                    self.discard(job)
+                except Exception as e:
+                    logger.warning(f"Could not clean up cancelled job {job_id}: {str(e)}")
+            return job
+        job._kill_process()
+        logger.info(f"Cancellation requested for running job {job_id}")
+        return job
+
+    def _finish(self, job, state, result=None, error=None):
+        if job.dedupe_key and self._inflight.get(job.dedupe_key) is job:
+            del self._inflight[job.dedupe_key]
+        job.state = state
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        job._finished.set()
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        for job_id in [j.id for j in self._jobs.values()
+                       if j.state in FINISHED_STATES and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+        for key in [k for k, j in self._idempotency.items() if j.id not in self._jobs]:
+            del self._idempotency[key]
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job = self._queue.popleft()
+                job.state = RUNNING
+                job.started_at = time.time()
+
+            logger.info(f"Starting {job.kind} job {job.id}")
+            try:
+                result = self.runner(job)
+                if job.cancel_requested:
+                    raise JobCancelled()
+            except JobCancelled:
+                state, result, error = CANCELLED, None, 'Cancelled'
+            except Exception as e:
+                logger.error(f"Job {job.id} failed: {str(e)}", exc_info=True)
+                state, result, error = FAILED, None, str(e)
+            else:
+                if result.get('success'):
+                    state, error = DONE, None
+                else:
+                    state, error = FAILED, result.get('error')
+
+            with self._cond:
+                self._finish(job, state, result, error)
+                if state == DONE:
+                    self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * (job.finished_at - job.started_at)
+            logger.info(f"Job {job.id} {state} after {job.finished_at - job.started_at:.1f}s")
+
+    def describe(self):
+        with self._cond:
+            states = [j.state for j in self._jobs.values()]
+            return {
+                'workers': self.workers,
+                'queued': states.count(QUEUED),
+                'running': states.count(RUNNING),
+                'done': states.count(DONE),
+                'failed': states.count(FAILED),
+                'cancelled': states.count(CANCELLED),
+                'max_queued': self.max_queued,
+                'avg_job_seconds': round(self.avg_job_seconds, 1),
+                'deduplicated': self.deduplicated,
+                'idempotent_replays': self.idempotent_replays,
+            }
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+RAM residency for KV cache files used by the inference workers
+
+Workers restore KV states from their slot directory. Keeping that directory
+on a RAM-backed filesystem (e.g. /dev/shm) and copying recently used caches
+into it means a swap reads from memory instead of disk. Copies are evicted
+least-recently-used first once a byte budget is exceeded; pinned caches are
+never evicted. Caches that do not fit are linked in and read from disk.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("CAG-Bridge")
+
+
+def cache_key(cache_path):
+    """Identify a KV cache file by its real path, mtime and size"""
+    real_path = os.path.realpath(cache_path)
+    stat = os.stat(real_path)
+    return (real_path, stat.st_mtime_ns, stat.st_size)
+
+
+def slot_file_name(key):
+    """Name under which a cache version is exposed in the slot directory"""
+    digest = hashlib.sha1(f"{key[0]}:{key[1]}:{key[2]}".encode('utf-8')).hexdigest()[:16]
+    return digest + '.bin'
+
+
+class KVResidencyCache:
+    """Byte-budgeted LRU of KV cache copies kept in a RAM-backed directory"""
+
+    def __init__(self, slot_dir, budget_bytes=0):
+        self.slot_dir = slot_dir
+        self.budget_bytes = max(0, budget_bytes)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size, least recently used first
+        self._loading = {}  # key -> threading.Event while a copy is in progress
+        self._pinned = set()  # real paths that must stay resident
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.linked = 0
+
+    @property
+    def resident_bytes(self):
+        return sum(self._entries.values())
+
+    def start(self):
+        """Create the slot directory and clear copies left by a previous run"""
+        os.makedirs(self.slot_dir, exist_ok=True)
+        for name in os.listdir(self.slot_dir):
+            path = os.path.join(self.slot_dir, name)
+            if os.path.isfile(path) or os.path.islink(path):
+                os.remove(path)
+
+    def stage(self, cache_path):
+        """Return the slot file name under which a worker can restore the cache"""
+        key = cache_key(cache_path)
+        name = slot_file_name(key)
+
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return name
+                loading = self._loading.get(key)
+                if loading is None:
+                    self.misses += 1
+                    self._drop_stale(key[0])
+                    if not self._make_room(key):
+                        self.linked += 1
+                        self._link(key, name)
+                        return name
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # Another request is already copying this cache in
+            loading.wait()
+
+        try:
+            self._copy(key, name)
+            with self._lock:
+                self._entries[key] = key[2]
+        except OSError as e:
+            logger.warning(f"Could not make {key[0]} resident, reading from disk: {str(e)}")
+            with self._lock:
+                self.linked += 1
+            self._link(key, name)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+        return name
+
+    def _drop_stale(self, real_path):
+        """Evict versions of a cache that has since been rewritten on disk"""
+        for key in [k for k in self._entries if k[0] == real_path]:
+            self._evict(key)
+
+    def _make_room(self, key):
+        """Evict unpinned entries until `key` fits the budget; False if it cannot"""
+        size = key[2]
+        reserved = sum(k[2] for k in self._loading)
+        if size + reserved > self.budget_bytes:
+            return False
+
+        while self.resident_bytes + reserved + size > self.budget_bytes:
+            victim = next((k for k in self._entries if k[0] not in self._pinned), None)
+            if victim is None:
+                return False
+            self._evict(victim)
+        return True
+
+    def _evict(self, key):
+        del self._entries[key]
+        self.evictions += 1
+        try:
+            os.remove(os.path.join(self.slot_dir, slot_file_name(key)))
+        except FileNotFoundError:
+            pass
+        logger.info(f"Evicted resident KV cache {key[0]} ({key[2] / (1024 * 1024):.1f}MB)")
+
+    def _copy(self, key, name):
+        start_time = time.time()
+        target = os.path.join(self.slot_dir, name)
+        tmp_path = target + '.tmp'
+        shutil.copyfile(key[0], tmp_path)
+        os.replace(tmp_path, target)
+        logger.info(f"Loaded KV cache {key[0]} into RAM ({key[2] / (1024 * 1024):.1f}MB "
+                    f"in {time.time() - start_time:.2f}s)")
+
+    def _link(self, key, name):
+        target = os.path.join(self.slot_dir, name)
+        if os.path.lexists(target):
+            return
+        tmp_path = target + '.tmp'
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.symlink(key[0], tmp_path)
+        os.replace(tmp_path, target)
+
+    def pin(self, cache_path):
+        """Keep a cache (every version written to this path) resident"""
+        real_path = os.path.realpath(cache_path)
+        with self._lock:
+            self._pinned.add(real_path)
+        if os.path.exists(real_path):
+            self.stage(real_path)
+        return real_path
+
+    def unpin(self, cache_path):
+        real_path = os.path.realpath(cache_path)
+        with self._lock:
+            self._pinned.discard(real_path)
+        return real_path
+
+    def pinned(self, cache_path):
+        with self._lock:
+            return os.path.realpath(cache_path) in self._pinned
+
+    def discard(self, cache_path):
+        """Forget a cache file that has been deleted, including any pin on it"""
+        real_path = os.path.realpath(cache_path)
+        with self._lock:
+            self._drop_stale(real_path)
+            self._pinned.discard(real_path)
+
+    def describe(self):
+        with self._lock:
+            return {
+                'slot_dir': self.slot_dir,
+                'budget_bytes': self.budget_bytes,
+                'resident_bytes': self.resident_bytes,
+                'entries': [
+                    {'path': k[0], 'size': k[2], 'pinned': k[0] in self._pinned}
+                    for k in reversed(self._entries)
+                ],
+                'pinned': sorted(self._pinned),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'linked': self.linked,
+            }
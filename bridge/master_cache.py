@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Versioned master KV cache
+
+The master cache path is a symlink into a versions directory. Promoting a
+new build links (or, failing that, reflinks or copies) it in as a new
+version and swaps the symlink atomically, so readers never see a
+half-written file. Queries resolve the symlink once and hold a reference to
+that version until they finish; versions that are no longer current are
+deleted once nobody holds them. The path each version was promoted from,
+which is the path its registry row is kept under, is saved next to the
+master path so usage is recorded against that row.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+
+logger = logging.getLogger("CAG-Bridge")
+
+
+def materialize(source, target):
+    """Make `target` hold the content of `source` without copying if possible
+
+    Returns the method used: 'hardlink', 'reflink' or 'copy'.
+    """
+    try:
+        os.link(source, target)
+        return 'hardlink'
+    except OSError:
+        pass
+
+    tmp_path = target + '.tmp'
+    try:
+        subprocess.run(['cp', '--reflink=always', source, tmp_path], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        method = 'reflink'
+    except (OSError, subprocess.CalledProcessError):
+        shutil.copy2(source, tmp_path)
+        method = 'copy'
+    os.replace(tmp_path, target)
+    return method
+
+
+class MasterCache:
+    """Atomic, reference-counted versions behind the master cache path"""
+
+    def __init__(self, path, keep_versions=0, on_removed=None):
+        self.path = path
+        self.versions_dir = path + '.versions'
+        self.sources_path = path + '.sources.json'
+        self.keep_versions = max(0, keep_versions)  # Previous versions kept for rollback
+        self.on_removed = on_removed  # Called with the real path of each deleted version
+
+        self._lock = threading.Lock()
+        self._readers = {}  # real path -> number of queries using it
+        self._sources = {}  # real path of a version -> path it was promoted from
+        self._last_stamp_ns = 0  # Stamp of the last version name, so names only ever increase
+
+        self.promotions = 0
+        self.removed = 0
+        self.last_method = None
+
+    def start(self):
+        """Move a plain master cache file left by older versions under version control"""
+        os.makedirs(self.versions_dir, exist_ok=True)
+        try:
+            with open(self.sources_path) as f:
+                self._sources = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read master KV cache sources from {self.sources_path}: {str(e)}")
+        if os.path.isfile(self.path) and not os.path.islink(self.path):
+            version = self._version_path()
+            os.rename(self.path, version)
+            self._swap(version)
+            logger.info(f"Moved existing master KV cache to {version}")
+
+    def current(self):
+        return os.path.realpath(self.path)
+
+    def source(self, real_path):
+        """The path a version was promoted from (the master path itself if unknown)"""
+        with self._lock:
+            return self._sources.get(real_path, self.path)
+
+    def _save_sources(self):
+        """Write the version sources atomically; called with the lock held"""
+        partial_path = self.sources_path + '.partial'
+        try:
+            with open(partial_path, 'w') as f:
+                json.dump(self._sources, f)
+            os.replace(partial_path, self.sources_path)
+        except OSError as e:
+            logger.warning(f"Could not save master KV cache sources to {self.sources_path}: {str(e)}")
+
+    @contextmanager
+    def reader(self):
+        """Resolve the current version and keep it on disk until the block exits"""
+        with self._lock:
+            real_path = self.current()
+            self._readers[real_path] = self._readers.get(real_path, 0) + 1
+        try:
+            yield real_path
+        finally:
+            with self._lock:
+                self._readers[real_path] -= 1
+                if not self._readers[real_path]:
+                    del self._readers[real_path]
+                    if real_path != self.current():
+                        self._collect()
+
+    def _version_path(self):
+        """A new version's path; fixed-width UTC stamps make name order creation order"""
+        stem, ext = os.path.splitext(os.path.basename(self.path))
+        stamp_ns = max(time.time_ns(), self._last_stamp_ns + 1)
+        while True:
+            seconds, fraction = divmod(stamp_ns, 1_000_000_000)
+            stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(seconds)) + f"{fraction:09d}"
+            candidate = os.path.join(self.versions_dir, f"{stem}.{stamp}{ext}")
+            if not os.path.lexists(candidate):
+                break
+            stamp_ns += 1
+        self._last_stamp_ns = stamp_ns
+        return candidate
+
+    def _swap(self, version):
+        """Point the master path at `version` with a single rename"""
+        tmp_link = self.path + '.tmp'
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(version, os.path.dirname(self.path)), tmp_link)
+        os.replace(tmp_link, self.path)
+
+    def promote(self, source, registered=None):
+        """Make `source` the master cache; returns (previous, new) real paths
+
+        `registered` is the path the build is recorded under in the registry,
+        if `source` is a temporary file.
+        """
+        os.makedirs(self.versions_dir, exist_ok=True)
+        with self._lock:
+            version = self._version_path()
+        method = materialize(source, version)
+        with self._lock:
+            previous = self.current() if os.path.exists(self.path) else None
+            self._sources[os.path.realpath(version)] = os.path.abspath(registered or source)
+            self._save_sources()
+            self._swap(version)
+            self.promotions += 1
+            self.last_method = method
+            self._collect()
+        logger.info(f"Promoted {source} to master KV cache version {version} ({method})")
+        return previous, os.path.realpath(version)
+
+    def _collect(self):
+        """Delete unreferenced versions beyond the newest `keep_versions` old ones"""
+        current = self.current()
+        try:
+            names = os.listdir(self.versions_dir)
+        except FileNotFoundError:
+            return
+        # Version names sort by creation time (mtimes are shared with hardlinked sources)
+        versions_dir = os.path.realpath(self.versions_dir)
+        versions = [os.path.join(versions_dir, n) for n in sorted(names, reverse=True)
+                    if not n.endswith('.tmp')]
+        old = [p for p in versions if p != current]
+        for real_path in old[self.keep_versions:]:
+            if self._readers.get(real_path):
+                continue
+            try:
+                os.remove(real_path)
+            except FileNotFoundError:
+                continue
+            self.removed += 1
+            if self._sources.pop(real_path, None) is not None:
+                self._save_sources()
+            logger.info(f"Removed old master KV cache version {real_path}")
+            if self.on_removed is not None:
+                self.on_removed(real_path)
+
+    def describe(self):
+        with self._lock:
+            try:
+                versions = sorted(os.listdir(self.versions_dir))
+            except FileNotFoundError:
+                versions = []
+            return {
+                'path': self.path,
+                'current': self.current() if os.path.exists(self.path) else None,
+                'source': self._sources.get(self.current()),
+                'versions': versions,
+                'readers': dict(self._readers),
+                'keep_versions': self.keep_versions,
+                'promotions': self.promotions,
+                'removed': self.removed,
+                'last_method': self.last_method,
+            }
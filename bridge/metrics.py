@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Prometheus-style metrics for the CAG bridge
+
+A minimal in-process registry of counters, gauges and histograms rendered in
+the Prometheus text exposition format by GET /metrics, so latency and
+saturation can be scraped without any external library or service.
+"""
+
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Base class: a named family of samples keyed by label values"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        if not self.labels:
+            # Unlabelled metrics are exported from the start, not only once touched
+            self._values[()] = self._initial()
+
+    def _initial(self):
+        return 0
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in sorted(self._values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, documentation, labels)
+
+    def _initial(self):
+        return [0] * len(self.buckets), 0.0
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or self._initial()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total) in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                labels = _format_labels(self.labels, key, ('le', _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    """Ordered collection of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'cag_http_requests_total', 'HTTP requests handled by the bridge', ('route', 'method', 'status')))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'cag_http_request_duration_seconds', 'Time to handle an HTTP request', ('route',)))
+
+JOBS_IN_FLIGHT = REGISTRY.register(Gauge(
+    'cag_jobs_in_flight', 'llama.cpp jobs currently holding a scheduler slot', ('lane',)))
+JOBS_QUEUED = REGISTRY.register(Gauge(
+    'cag_jobs_queued', 'Requests waiting for a scheduler slot', ('lane',)))
+BUILD_JOBS = REGISTRY.register(Gauge(
+    'cag_build_jobs', 'Background cache build jobs by state', ('state',)))
+
+FIRST_BYTE_SECONDS = REGISTRY.register(Histogram(
+    'cag_first_byte_seconds', 'Time from starting a query process or worker request to its first output',
+    ('source',)))
+KV_LOAD_SECONDS = REGISTRY.register(Histogram(
+    'cag_kv_cache_load_seconds', 'Time to stage and restore a KV cache into an inference worker'))
+PROMPT_EVAL_RATE = REGISTRY.register(Histogram(
+    'cag_prompt_eval_tokens_per_second', 'Prompt evaluation throughput of a query', ('source',),
+    buckets=RATE_BUCKETS))
+GENERATION_RATE = REGISTRY.register(Histogram(
+    'cag_generation_tokens_per_second', 'Token generation throughput of a query', ('source',),
+    buckets=RATE_BUCKETS))
+
+KV_CACHES_BUILT = REGISTRY.register(Counter(
+    'cag_kv_caches_built_total', 'KV caches built successfully'))
+KV_BYTES_BUILT = REGISTRY.register(Counter(
+    'cag_kv_cache_built_bytes_total', 'Bytes of KV cache files built'))
+KV_CACHES_REUSED = REGISTRY.register(Counter(
+    'cag_kv_caches_reused_total', 'Cache builds skipped because a cache of identical text already existed'))
+BUILD_SECONDS_SAVED = REGISTRY.register(Counter(
+    'cag_kv_cache_build_seconds_saved_total', 'Prefill time avoided by reusing unchanged KV caches'))
+TIER_MOVES = REGISTRY.register(Counter(
+    'cag_kv_cache_tier_moves_total', 'KV caches moved between the hot and cold storage tiers', ('direction',)))
+CACHE_STORAGE_BYTES = REGISTRY.register(Gauge(
+    'cag_kv_cache_storage_bytes', 'Bytes stored under the KV cache directories at the last scan'))
+KV_CACHES_EVICTED = REGISTRY.register(Counter(
+    'cag_kv_caches_evicted_total', 'Chunk caches deleted to stay within the disk budget'))
+KV_BYTES_EVICTED = REGISTRY.register(Counter(
+    'cag_kv_cache_evicted_bytes_total',
+    'Bytes of chunk caches and their prefix snapshots deleted to stay within the disk budget'))
+KV_CACHES_PREFETCHED = REGISTRY.register(Counter(
+    'cag_kv_caches_prefetched_total', 'KV caches advised into the page cache ahead of expected queries'))
+PREFETCH_LOAD_SECONDS = REGISTRY.register(Histogram(
+    'cag_kv_cache_query_load_seconds', 'KV cache restore time of a worker query by whether the prefetcher had warmed it',
+    ('page_cache',)))
+USAGE_FLUSH_SECONDS = REGISTRY.register(Histogram(
+    'cag_usage_flush_seconds', 'Time from queueing a batch of cache usage counts to its commit'))
+USAGE_DROPPED = REGISTRY.register(Counter(
+    'cag_usage_dropped_total', 'Cache uses not recorded because too many caches were waiting to be flushed'))
+QUERY_LOG_FLUSH_SECONDS = REGISTRY.register(Histogram(
+    'cag_query_log_flush_seconds', 'Time from queueing a batch of query_log rows to its commit'))
+QUERY_LOG_DROPPED = REGISTRY.register(Counter(
+    'cag_query_log_dropped_total', 'query_log rows dropped because the buffer was full'))
+
+FAILURES = REGISTRY.register(Counter(
+    'cag_failures_total', 'Failed or rejected work by reason', ('reason',)))
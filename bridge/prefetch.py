@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Predictive page-cache prefetch of KV caches
+
+Loading a cache that is not in the OS page cache reads it from disk first,
+which is the slow part of the first query of the day against each cache. A
+periodic pass ranks caches by how often they were queried recently and in
+the hours of the day that are about to start (from query_log, the registry's
+usage counts and the loads seen by this process), then asks the kernel to
+read the best ones ahead with posix_fadvise(WILLNEED) until a memory budget
+is used up. Since the upcoming hours include the next `lookahead_hours`, the
+caches of a busy hour are warmed before its first query.
+
+The time workers take to restore a cache file is reported separately for
+caches the last pass warmed and for all others, so the effect can be read
+from /health and /metrics. Script runs count towards the ranking only, as
+their load time is mostly spent loading the model.
+"""
+
+import os
+import time
+import math
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger("CAG-Bridge")
+
+RECENT_HALF_LIFE = 24 * 3600  # Uses this old count half as much towards the recent score
+HOUR_OF_DAY_WEIGHT = 2.0  # A use in an upcoming hour of the day counts this much more than a recent one
+
+
+def cache_key(path):
+    """Identify a cache file version by its real path, mtime and size"""
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def advise_willneed(path):
+    """Ask the kernel to read a whole file into the page cache in the background; returns its size"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+        return size
+    finally:
+        os.close(fd)
+
+
+class CachePrefetcher:
+    """Warms the page cache with the KV caches most likely to be queried next
+
+    `history(days)` returns (cache path, hour bucket, uses) rows from
+    query_log, where an hour bucket is epoch seconds // 3600 (or None);
+    `usage()` returns the registry rows used by tiered_storage. `resolve(path)`
+    gives the file queries against a cache currently restore (where it is
+    stored, or its prompt prefix snapshot) without loading it, or None (e.g.
+    while it only exists compressed).
+    """
+
+    def __init__(self, budget_bytes, interval=900, lookahead_hours=1, history_days=14, top_n=20,
+                 history=None, usage=None, resolve=None):
+        self.budget_bytes = budget_bytes
+        self.interval = interval
+        self.lookahead_hours = lookahead_hours
+        self.history_days = history_days
+        self.top_n = top_n
+        self.history = history or (lambda days: None)
+        self.usage = usage or (lambda: None)
+        self.resolve = resolve or (lambda path: path if os.path.exists(path) else None)
+        self.enabled = budget_bytes > 0 and hasattr(os, 'posix_fadvise')
+
+        self._lock = threading.Lock()
+        self._loads = {}  # (path, hour bucket) -> loads seen by this process
+        self._warmed = set()  # cache_key() of every file the last pass advised
+        self._load_ms = {'warm': [0, 0.0], 'cold': [0, 0.0]}  # state -> [loads, total ms]
+
+        self.passes = 0
+        self.prefetched = 0
+        self.prefetched_bytes = 0
+        self.last_pass = None
+        self.last_plan = []
+        self.busy_hours = []
+
+    def start(self):
+        if self.budget_bytes > 0 and not self.enabled:
+            logger.warning("Cache prefetch disabled: posix_fadvise is not available on this platform")
+        if self.enabled:
+            threading.Thread(target=self._run, name='cache-prefetch', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.prefetch()
+            except Exception as e:
+                logger.error(f"Cache prefetch failed: {str(e)}", exc_info=True)
+            time.sleep(self.interval)
+
+    def record_load(self, path, load_ms=None, loaded=None):
+        """Count a query's load of a cache and its restore time; returns whether the last pass had warmed it
+
+        Uses are counted under the cache's path, while warmth is that of
+        `loaded`, the file actually restored (its prefix snapshot, if any).
+        """
+        try:
+            key = cache_key(path)
+            warm = (cache_key(loaded) if loaded not in (None, path) else key) in self._warmed
+        except OSError:
+            return False
+        state = 'warm' if warm else 'cold'
+        bucket = int(time.time() // 3600)
+        with self._lock:
+            self._loads[(key[0], bucket)] = self._loads.get((key[0], bucket), 0) + 1
+            if load_ms is not None:
+                self._load_ms[state][0] += 1
+                self._load_ms[state][1] += load_ms
+        return state == 'warm'
+
+    def _uses(self, now):
+        """(path, hour bucket, uses) from query_log and this process, within the history window"""
+        oldest = int(now // 3600) - self.history_days * 24
+        rows = list(self.history(self.history_days) or [])
+        with self._lock:
+            for (path, bucket), uses in list(self._loads.items()):
+                if bucket < oldest:
+                    del self._loads[(path, bucket)]
+            if not rows:
+                # Without query_log, the loads seen since startup are the only history
+                rows = [(path, bucket, uses) for (path, bucket), uses in self._loads.items()]
+        return rows
+
+    def rank(self, now=None):
+        """Caches by expected use over the next `lookahead_hours`, best first, as (score, path)"""
+        now = now or time.time()
+        current = int(now // 3600)
+        upcoming = {time.localtime((current + h) * 3600).tm_hour for h in range(self.lookahead_hours + 1)}
+        scores = {}
+        hours = [0] * 24
+        for path, bucket, uses in self._uses(now):
+            if not path or bucket is None:
+                continue
+            path = os.path.abspath(path)
+            bucket = int(bucket)
+            hour = time.localtime(bucket * 3600).tm_hour
+            hours[hour] += uses
+            score = uses * 0.5 ** ((now - bucket * 3600) / RECENT_HALF_LIFE)
+            if hour in upcoming:
+                score += HOUR_OF_DAY_WEIGHT * uses / max(1, self.history_days)
+            scores[path] = scores.get(path, 0.0) + score
+        for path, row in (self.usage() or {}).items():
+            if row.get('status', 'cached') != 'cached' or not row.get('last_used'):
+                continue
+            # Registry counts cover caches queried before query_log was kept
+            idle = max(0.0, now - row['last_used'])
+            scores[path] = scores.get(path, 0.0) + math.log1p(row.get('usage_count') or 0) * 0.5 ** (
+                idle / RECENT_HALF_LIFE) / max(1, self.history_days)
+
+        average = sum(hours) / 24
+        with self._lock:
+            self.busy_hours = [hour for hour, uses in enumerate(hours) if uses and uses > 2 * average]
+        return sorted(((score, path) for path, score in scores.items() if score > 0), reverse=True)
+
+    def prefetch(self):
+        """Advise the best ranked caches into the page cache within the budget"""
+        start = time.time()
+        plan, warmed, used = [], set(), 0
+        for score, path in self.rank(start):
+            if len(plan) >= self.top_n:
+                break
+            current = self.resolve(path)
+            if current is None:
+                continue
+            try:
+                key = cache_key(current)
+            except OSError:
+                continue
+            if key in warmed:
+                continue
+            if used + key[2] > self.budget_bytes:
+                continue
+            try:
+                advise_willneed(current)
+            except OSError as e:
+                logger.warning(f"Could not prefetch KV cache {current}: {str(e)}")
+                continue
+            used += key[2]
+            warmed.add(key)
+            metrics.KV_CACHES_PREFETCHED.inc()
+            plan.append({'path': current, 'size': key[2], 'score': round(score, 4)})
+
+        with self._lock:
+            self._warmed = warmed
+            self.passes += 1
+            self.prefetched += len(plan)
+            self.prefetched_bytes += used
+            self.last_pass = start
+            self.last_plan = plan
+        if plan:
+            logger.info(f"Prefetched {len(plan)} KV caches ({used / (1024 * 1024):.1f}MB) into the page cache "
+                        f"in {time.time() - start:.2f}s")
+        return plan
+
+    def describe(self):
+        with self._lock:
+            load_ms = {state: round(total / count, 1) if count else None
+                       for state, (count, total) in self._load_ms.items()}
+            return {
+                'enabled': self.enabled,
+                'budget_bytes': self.budget_bytes,
+                'lookahead_hours': self.lookahead_hours,
+                'busy_hours': self.busy_hours,
+                'passes': self.passes,
+                'prefetched': self.prefetched,
+                'prefetched_bytes': self.prefetched_bytes,
+                'last_pass': self.last_pass,
+                'warm': self.last_plan,
+                'avg_load_ms': load_ms,
+                'loads': {state: count for state, (count, _total) in self._load_ms.items()},
+            }
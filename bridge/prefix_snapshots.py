@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Prefilled prompt-template snapshots of KV caches
+
+Every query wraps the question in the same template, so the instruction text
+before the question is evaluated again on top of the document for every
+request. A snapshot is the document's KV cache extended with that fixed
+prefix; queries against it only evaluate the question and what follows it.
+
+Snapshots are built in the background the first time a cache is queried, one
+at a time from a bounded queue, and named after the cache's content (the
+tokens in its state file header), the prefix and the model. Renaming,
+moving or restoring a cache therefore keeps its snapshot, while rebuilding
+it from other text or changing the template leads to a fresh one. Together
+they are kept within a byte budget, least recently used first.
+
+With a hot storage tier, the snapshots of hot caches are kept in the hot
+tier too and follow their cache when it is moved between tiers.
+"""
+
+import os
+import time
+import queue
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from context_size import HEADER, STATE_MAGICS, MAX_PLAUSIBLE_TOKENS, file_identity
+from tiered_storage import move_file
+
+logger = logging.getLogger("CAG-Bridge")
+
+PLACEHOLDER = '{query}'
+DEFAULT_TEMPLATE = "Answer this question based on your knowledge:\n\nQuestion: {query}\n\nAnswer:"
+
+MAX_QUEUED = 16  # Snapshot builds waiting; further misses are not queued until the next query
+DIGEST_CACHE = 4096  # Cache file versions whose content digest is remembered
+FALLBACK_DIGEST_BYTES = 1024 * 1024  # Bytes hashed of files without a llama.cpp state header
+RECENT_USE = 60  # Seconds after a hit during which a snapshot is not deleted to stay in budget
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def content_digest(cache_path):
+    """Identify a KV cache by the tokens it holds (or its leading bytes) and its size"""
+    digest = hashlib.sha1()
+    with open(cache_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        header = f.read(HEADER.size)
+        digest.update(header)
+        if len(header) == HEADER.size:
+            magic, _version, n_tokens = HEADER.unpack(header)
+            if magic in STATE_MAGICS and n_tokens <= MAX_PLAUSIBLE_TOKENS:
+                digest.update(f.read(n_tokens * 4))
+            else:
+                digest.update(f.read(FALLBACK_DIGEST_BYTES))
+    digest.update(str(size).encode('ascii'))
+    return digest.hexdigest()[:20]
+
+
+class PrefixSnapshots:
+    """Per-cache snapshots of the template text that precedes the query
+
+    `build(base_path, prefix, target)` prefills `prefix` on top of the KV
+    cache at `base_path`, writes the result to `target` and returns True on
+    success. It runs on the snapshot thread. `on_built(base_path, snapshot)`
+    is called after each build, `on_removed(snapshot)` after each deletion
+    (and for the old path of a moved snapshot). Snapshots of caches under
+    `hot_cache_dir` are kept in `hot_snapshot_dir`.
+    """
+
+    def __init__(self, snapshot_dir, template, build, model_fingerprint=None, enabled=True, on_removed=None,
+                 budget_bytes=0, on_built=None, hot_cache_dir=None, hot_snapshot_dir=None):
+        if template.count(PLACEHOLDER) != 1:
+            logger.error(f"Query template must contain {PLACEHOLDER} exactly once; using the default")
+            template = DEFAULT_TEMPLATE
+        self.template = template
+        self.prefix, self.suffix = template.split(PLACEHOLDER)
+        self.snapshot_dir = snapshot_dir
+        self.hot_cache_dir = os.path.abspath(hot_cache_dir) if hot_cache_dir and hot_snapshot_dir else None
+        self.hot_snapshot_dir = hot_snapshot_dir if self.hot_cache_dir else None
+        self.build = build
+        self.model_fingerprint = model_fingerprint or (lambda: None)
+        self.on_removed = on_removed
+        self.on_built = on_built
+        self.budget_bytes = budget_bytes  # 0 means no limit
+        # Nothing to snapshot when the question comes first
+        self.enabled = enabled and bool(self.prefix)
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(MAX_QUEUED)
+        self._digests = OrderedDict()  # file_identity() -> content_digest()
+        self._bases = {}  # snapshot path -> real paths of the caches it was found for
+        self._last_used = {}  # snapshot path -> time of its last hit
+        self._building = set()  # snapshot names queued or being built
+        self._failed = set()  # snapshot names whose build failed; not retried until the cache changes
+
+        self.hits = 0
+        self.misses = 0
+        self.built = 0
+        self.failures = 0
+        self.dropped = 0
+        self.removed = 0
+
+    def render(self, query):
+        """The full prompt, for caches without a snapshot"""
+        return self.prefix + query + self.suffix
+
+    def render_suffix(self, query):
+        """The part of the prompt evaluated on top of a snapshot"""
+        return query + self.suffix
+
+    def start(self):
+        if self.enabled:
+            for snapshot_dir in self._dirs():
+                os.makedirs(snapshot_dir, exist_ok=True)
+            threading.Thread(target=self._run, name='prefix-snapshots', daemon=True).start()
+
+    def _name(self, cache_path):
+        """Snapshot file name for the content of a cache, the prefix and the model"""
+        identity = file_identity(cache_path)
+        with self._lock:
+            digest = self._digests.get(identity)
+            if digest is not None:
+                self._digests.move_to_end(identity)
+        if digest is None:
+            digest = content_digest(cache_path)
+            with self._lock:
+                self._digests[identity] = digest
+                while len(self._digests) > DIGEST_CACHE:
+                    self._digests.popitem(last=False)
+        version = _digest(f"{self.prefix}:{self.model_fingerprint()}")
+        return f"{digest}-{version}.bin"
+
+    def _dirs(self):
+        return [self.snapshot_dir] + ([self.hot_snapshot_dir] if self.hot_snapshot_dir else [])
+
+    def _find(self, name):
+        return next((p for p in (os.path.join(d, name) for d in self._dirs()) if os.path.exists(p)), None)
+
+    def existing(self, cache_path):
+        """The snapshot of a cache if it has one, without counting a use or building it"""
+        if not self.enabled:
+            return None
+        try:
+            return self._find(self._name(cache_path))
+        except OSError:
+            return None
+
+    def lookup(self, cache_path):
+        """The snapshot for a cache, or None (and queue building it) if there is none yet"""
+        if not self.enabled:
+            return None
+        real_path = os.path.realpath(cache_path)
+        try:
+            name = self._name(real_path)
+        except OSError:
+            return None
+        snapshot = self._find(name)
+        with self._lock:
+            if snapshot is not None:
+                self.hits += 1
+                self._last_used[snapshot] = time.time()
+                self._bases.setdefault(snapshot, set()).add(real_path)
+                return snapshot
+            self.misses += 1
+        self._schedule(real_path, name)
+        return None
+
+    def prepare(self, cache_path):
+        """Build the snapshot for a cache ahead of its first query"""
+        if not self.enabled:
+            return
+        real_path = os.path.realpath(cache_path)
+        try:
+            name = self._name(real_path)
+        except OSError:
+            return
+        if self._find(name) is None:
+            self._schedule(real_path, name)
+
+    def _schedule(self, real_path, name):
+        if self.budget_bytes > 0:
+            try:
+                # A snapshot is about as large as its cache
+                if os.path.getsize(real_path) > self.budget_bytes:
+                    return
+            except OSError:
+                return
+        with self._lock:
+            if name in self._building or name in self._failed:
+                return
+            try:
+                self._queue.put_nowait((real_path, name))
+            except queue.Full:
+                self.dropped += 1
+                return
+            self._building.add(name)
+
+    def _run(self):
+        while True:
+            real_path, name = self._queue.get()
+            try:
+                self._build(real_path, name)
+            except Exception as e:
+                logger.error(f"Prompt prefix snapshot for {real_path} failed: {str(e)}", exc_info=True)
+
+    def _target_dir(self, real_path):
+        """The snapshot directory in the same storage tier as a cache"""
+        if self.hot_cache_dir and real_path.startswith(self.hot_cache_dir + os.sep):
+            return self.hot_snapshot_dir
+        return self.snapshot_dir
+
+    def _build(self, real_path, name):
+        snapshot = os.path.join(self._target_dir(real_path), name)
+        partial_path = snapshot + '.partial'
+        try:
+            ok = self.build(real_path, self.prefix, partial_path) and os.path.exists(partial_path)
+            if ok:
+                os.replace(partial_path, snapshot)
+                logger.info(f"Built prompt prefix snapshot {snapshot} for {real_path}")
+        except Exception as e:
+            logger.error(f"Prompt prefix snapshot for {real_path} failed: {str(e)}")
+            ok = False
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        with self._lock:
+            self._building.discard(name)
+            if ok:
+                self.built += 1
+                self._last_used[snapshot] = time.time()
+                stale = [p for p, bases in self._bases.items() if real_path in bases and p != snapshot]
+                self._bases[snapshot] = {real_path}
+            else:
+                self.failures += 1
+                self._failed.add(name)
+        if not ok:
+            return
+        # Snapshots of what this path held before were only reachable through it
+        for path in stale:
+            self._release(path, real_path)
+        self._enforce_budget(keep=snapshot)
+        if self.on_built is not None:
+            self.on_built(real_path, snapshot)
+
+    def snapshots(self):
+        """(path, size, last use) of every snapshot file"""
+        found = []
+        for snapshot_dir in self._dirs():
+            try:
+                names = os.listdir(snapshot_dir)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                path = os.path.join(snapshot_dir, name)
+                if not name.endswith('.bin'):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                with self._lock:
+                    last_use = max(stat.st_mtime, self._last_used.get(path, 0))
+                found.append((path, stat.st_size, last_use))
+        return found
+
+    def _enforce_budget(self, keep=None):
+        """Delete the least recently used snapshots until they fit the budget"""
+        if self.budget_bytes <= 0:
+            return
+        snapshots = self.snapshots()
+        used = sum(size for _path, size, _last in snapshots)
+        for path, size, last_use in sorted(snapshots, key=lambda s: s[2]):
+            if used <= self.budget_bytes:
+                break
+            # A query may be about to load a snapshot it has just been handed
+            if path != keep and last_use < time.time() - RECENT_USE and self.remove(path):
+                used -= size
+
+    def remove(self, path):
+        """Delete a snapshot file; returns its size, or 0 if it was already gone"""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            size = 0
+        with self._lock:
+            self._bases.pop(path, None)
+            self._last_used.pop(path, None)
+            if size:
+                self.removed += 1
+        if size:
+            logger.info(f"Removed prompt prefix snapshot {path}")
+        if self.on_removed is not None:
+            self.on_removed(path)
+        return size
+
+    def _release(self, snapshot, real_path):
+        """Stop using a snapshot for a cache; delete it once no existing cache uses it; returns bytes freed"""
+        with self._lock:
+            bases = self._bases.get(snapshot, set())
+            bases.discard(real_path)
+            shared = any(os.path.exists(p) for p in bases)
+        return 0 if shared else self.remove(snapshot)
+
+    def _of_content(self, real_path):
+        """Snapshots of a cache's current content for any prefix or model, including ones not yet looked up"""
+        try:
+            stem = self._name(real_path).split('-')[0] + '-'
+        except OSError:
+            return set()
+        found = set()
+        for snapshot_dir in self._dirs():
+            try:
+                names = os.listdir(snapshot_dir)
+            except FileNotFoundError:
+                continue
+            found.update(os.path.join(snapshot_dir, n) for n in names if n.startswith(stem) and n.endswith('.bin'))
+        return found
+
+    def discard(self, cache_path):
+        """Delete the snapshots of a cache that is deleted or replaced; returns the bytes freed"""
+        if not self.enabled:
+            return 0
+        real_path = os.path.realpath(cache_path)
+        with self._lock:
+            snapshots = {p for p, bases in self._bases.items() if real_path in bases}
+        if os.path.exists(real_path):
+            snapshots |= self._of_content(real_path)
+        return sum(self._release(snapshot, real_path) for snapshot in snapshots)
+
+    def move(self, old_path, new_path):
+        """Follow a cache that has been moved to `new_path`, moving its snapshots into its new tier"""
+        if not self.enabled:
+            return
+        old_path, new_path = os.path.realpath(old_path), os.path.realpath(new_path)
+        target_dir = self._target_dir(new_path)
+        with self._lock:
+            for bases in self._bases.values():
+                if old_path in bases:
+                    bases.discard(old_path)
+                    bases.add(new_path)
+        for snapshot in self._of_content(new_path):
+            if os.path.dirname(snapshot) == target_dir:
+                continue
+            target = os.path.join(target_dir, os.path.basename(snapshot))
+            try:
+                move_file(snapshot, target)
+            except OSError as e:
+                logger.error(f"Failed to move prompt prefix snapshot {snapshot}: {str(e)}")
+                continue
+            with self._lock:
+                self._bases[target] = self._bases.pop(snapshot, set()) | {new_path}
+                self._last_used[target] = self._last_used.pop(snapshot, 0)
+            if self.on_removed is not None:
+                self.on_removed(snapshot)
+
+    def describe(self):
+        snapshots = self.snapshots() if self.enabled else []
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'snapshot_dir': self.snapshot_dir,
+                'prefix_chars': len(self.prefix),
+                'snapshots': len(snapshots),
+                'snapshot_bytes': sum(size for _path, size, _last in snapshots),
+                'budget_bytes': self.budget_bytes,
+                'queued': len(self._building),
+                'hits': self.hits,
+                'misses': self.misses,
+                'built': self.built,
+                'failures': self.failures,
+                'dropped': self.dropped,
+                'removed': self.removed,
+            }
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Memoization of deterministic query responses
+
+A response can only be reused when generation is deterministic, i.e. the
+temperature is 0 or a fixed seed was given. Entries are keyed by the
+normalized query text, the identity of the KV cache and model, and every
+sampling parameter, and expire after a TTL or when the cache is full.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from kv_residency import cache_key
+
+
+def normalize_query(query):
+    """Collapse whitespace and case so trivially different queries share an entry"""
+    return ' '.join(query.split()).casefold()
+
+
+class ResponseCache:
+    """TTL + LRU bounded store of query responses"""
+
+    def __init__(self, max_entries=512, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, kv_cache_path, response)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def cacheable(temperature, seed):
+        """Only deterministic generations can be replayed"""
+        try:
+            greedy = temperature is not None and float(temperature) == 0
+        except (TypeError, ValueError):
+            greedy = False
+        return greedy or seed is not None
+
+    def key(self, query, kv_cache_path, model_fingerprint, max_tokens, temperature, seed, **sampling):
+        """Build the memo key; raises OSError if the KV cache does not exist"""
+        real_path, mtime_ns, size = cache_key(kv_cache_path)
+        material = {
+            'query': normalize_query(query),
+            'kv_cache': [real_path, mtime_ns, size],
+            'model': model_fingerprint,
+            'max_tokens': int(max_tokens),
+            'temperature': float(temperature) if temperature is not None else None,
+            'seed': seed,
+            'sampling': sampling,
+        }
+        digest = hashlib.sha256(json.dumps(material, sort_keys=True).encode('utf-8')).hexdigest()
+        return digest, real_path
+
+    def get(self, key):
+        digest, _ = key
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[digest]
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, response):
+        digest, real_path = key
+        with self._lock:
+            self._entries[digest] = (time.time() + self.ttl, real_path, response)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, kv_cache_path):
+        """Drop every response produced from a KV cache that has been replaced"""
+        kv_cache_path = os.path.realpath(kv_cache_path)
+        with self._lock:
+            stale = [d for d, entry in self._entries.items() if entry[1] == kv_cache_path]
+            for digest in stale:
+                del self._entries[digest]
+            self.invalidations += len(stale)
+        return len(stale)
+
+    def describe(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
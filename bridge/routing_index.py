@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Lexical routing of queries to chunk KV caches
+
+Each chunk cache is indexed from the text it was built from and its section
+title when the build finishes, replacing the entry for the same cache path,
+so the index follows the caches without ever being rebuilt as a whole. A
+query is scored against every indexed chunk with BM25 and the best few
+caches are returned, so a multi-cache query only loads the chunks that
+mention its terms instead of every cache or the whole master cache.
+
+The index is kept in memory and saved as JSON next to the caches, so it
+survives restarts; caches built before it existed are indexed on their next
+build. Caches deleted by the eviction daemon stay in the index, flagged as
+evicted, so a query that needs one has it rebuilt.
+"""
+
+import os
+import re
+import json
+import math
+import logging
+import threading
+
+logger = logging.getLogger("CAG-Bridge")
+
+TITLE_WEIGHT = 3  # A term in the section title counts as this many occurrences in the text
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i if in into is it its of on or
+so than that the their then there these they this to was were what when where which who why will
+with you your
+""".split())
+
+
+def tokenize(text):
+    """Lowercase word terms without stopwords, with plural endings folded"""
+    terms = []
+    for word in re.findall(r'\w+', text.lower()):
+        if len(word) < 2 or word in STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith('ies'):
+            word = word[:-3] + 'y'
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+def section_title(text):
+    """The first heading of a chunk (or its first line) when the build did not name its section"""
+    for line in text.splitlines():
+        line = line.strip()
+        if line:
+            return line.lstrip('#').strip()[:255]
+    return ''
+
+
+class RoutingIndex:
+    """BM25 index of chunk caches, keyed by KV cache path"""
+
+    def __init__(self, index_path, k1=1.2, b=0.75, enabled=True, exists=os.path.exists):
+        self.index_path = index_path
+        self.exists = exists  # Whether a cache can still be loaded
+        self.k1 = k1
+        self.b = b
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._docs = {}  # cache path -> {'document_id', 'section', 'length', 'terms': {term: tf}, 'evicted'}
+        self._postings = {}  # term -> {cache path: tf}
+        self._total_length = 0
+
+        self.searches = 0
+        self.misses = 0
+
+    def load(self):
+        """Read the saved index, if any"""
+        if not self.enabled or not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path) as f:
+                docs = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load routing index {self.index_path}, starting empty: {str(e)}")
+            return
+        with self._lock:
+            for path, doc in docs.items():
+                self._add(path, doc)
+        logger.info(f"Loaded routing index with {len(docs)} KV caches from {self.index_path}")
+
+    def _add(self, path, doc):
+        self._remove(path)
+        self._docs[path] = doc
+        self._total_length += doc['length']
+        for term, tf in doc['terms'].items():
+            self._postings.setdefault(term, {})[path] = tf
+
+    def _remove(self, path):
+        doc = self._docs.pop(path, None)
+        if doc is None:
+            return False
+        self._total_length -= doc['length']
+        for term in doc['terms']:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(path, None)
+                if not postings:
+                    del self._postings[term]
+        return True
+
+    def add(self, cache_path, document_id, text, section=None):
+        """Index (or re-index) the text a chunk cache was built from"""
+        if not self.enabled:
+            return
+        section = section or section_title(text)
+        terms = {}
+        for term in tokenize(text):
+            terms[term] = terms.get(term, 0) + 1
+        for term in tokenize(section):
+            terms[term] = terms.get(term, 0) + TITLE_WEIGHT
+        doc = {'document_id': document_id, 'section': section, 'length': sum(terms.values()), 'terms': terms}
+        with self._lock:
+            self._add(os.path.abspath(cache_path), doc)
+            self._save()
+
+    def remove(self, cache_path):
+        """Drop a cache that has been deleted"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._remove(os.path.abspath(cache_path)):
+                self._save()
+
+    def mark_evicted(self, cache_path):
+        """Keep routing to a cache deleted to free disk, so it is rebuilt when needed; add() clears this"""
+        if not self.enabled:
+            return
+        with self._lock:
+            doc = self._docs.get(os.path.abspath(cache_path))
+            if doc is not None and not doc.get('evicted'):
+                doc['evicted'] = True
+                self._save()
+
+    def _save(self):
+        """Write the index atomically; called with the lock held"""
+        partial_path = self.index_path + '.partial'
+        try:
+            os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+            with open(partial_path, 'w') as f:
+                json.dump(self._docs, f, separators=(',', ':'))
+            os.replace(partial_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Could not save routing index {self.index_path}: {str(e)}")
+
+    def search(self, query, k=3):
+        """The k best matching caches as dicts with kvCache, documentId, section, score and evicted
+
+        Caches whose file no longer exists are skipped unless they were evicted.
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            self.searches += 1
+            count = len(self._docs)
+            if not count or not terms:
+                self.misses += 1
+                return []
+            avg_length = self._total_length / count or 1
+            scores = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for path, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._docs[path]['length'] / avg_length)
+                    scores[path] = scores.get(path, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            docs = {path: self._docs[path] for path, _ in ranked}
+
+        matches = []
+        for path, score in ranked:
+            if len(matches) >= k:
+                break
+            evicted = bool(docs[path].get('evicted')) and not self.exists(path)
+            if not evicted and not self.exists(path):
+                continue
+            matches.append({'kvCache': path, 'documentId': docs[path]['document_id'],
+                            'section': docs[path]['section'], 'score': round(score, 4), 'evicted': evicted})
+        if not matches:
+            with self._lock:
+                self.misses += 1
+        return matches
+
+    def describe(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'index_path': self.index_path,
+                'caches': len(self._docs),
+                'terms': len(self._postings),
+                'searches': self.searches,
+                'misses': self.misses,
+            }
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Admission control for llama.cpp jobs run by the CAG bridge
+
+Caps how many llama.cpp jobs run at once and how many requests may wait for
+a slot. Requests beyond that are rejected immediately with a Retry-After
+hint so callers back off instead of holding connections open.
+
+Interactive queries and background cache builds are scheduled in separate
+lanes. Queries always win a free slot over builds, some slots are reserved
+for queries only, and running builds can be paused (SIGSTOP/SIGCONT) while
+queries are active so a build does not starve them of CPU.
+"""
+
+import os
+import time
+import signal
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger("CAG-Bridge")
+
+QUERY = 'query'
+BUILD = 'build'
+LANES = (QUERY, BUILD)
+
+
+class QueueFullError(Exception):
+    """Raised when a job cannot be admitted
+
+    `status` is the HTTP status to answer with (429 when the wait queue is
+    full, 503 when the job waited too long) and `retry_after` the number of
+    seconds the caller should wait before retrying.
+    """
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Lane:
+    """Per-class queue and statistics"""
+
+    def __init__(self, name):
+        self.name = name
+        self.waiting = deque()
+        self.in_flight = 0
+        self.avg_job_seconds = 30.0  # Seed for Retry-After until jobs complete
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds):
+        self.admitted += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def describe(self):
+        return {
+            'in_flight': self.in_flight,
+            'queued': len(self.waiting),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'avg_wait_ms': round(self.wait_total / self.admitted * 1000, 1) if self.admitted else 0,
+            'max_wait_ms': round(self.wait_max * 1000, 1),
+        }
+
+
+class JobScheduler:
+    """Two-lane FIFO admission queue in front of a fixed number of job slots"""
+
+    def __init__(self, max_in_flight=2, max_queue=8, queue_timeout=120,
+                 reserved_query_slots=1, pause_builds=True, max_build_pause=60):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        # Builds may never take the slots reserved for queries (but always get at least one)
+        self.build_slots = max(1, self.max_in_flight - max(0, reserved_query_slots))
+        self.pause_builds = pause_builds
+        self.max_build_pause = max_build_pause
+
+        self._cond = threading.Condition()
+        self._lanes = {name: Lane(name) for name in LANES}
+
+        self._builds = {}  # pid -> time the build was paused, or None while running
+        self._resume_until = 0  # Anti-starvation window during which builds are not paused
+        self.build_pauses = 0
+        self.build_paused_seconds = 0.0
+        self._monitor = None
+
+    @property
+    def _in_flight(self):
+        return sum(lane.in_flight for lane in self._lanes.values())
+
+    def start(self):
+        """Start the thread that bounds how long builds stay paused"""
+        if self.pause_builds and self._monitor is None:
+            self._monitor = threading.Thread(target=self._watch, name='build-preemption', daemon=True)
+            self._monitor.start()
+
+    def retry_after(self, lane=QUERY):
+        """Estimate seconds until a new request could be admitted"""
+        lane = self._lanes[lane]
+        backlog = len(lane.waiting) + 1
+        slots = self.max_in_flight if lane.name == QUERY else self.build_slots
+        estimate = lane.avg_job_seconds * backlog / slots
+        return max(1, int(round(estimate)))
+
+    def _can_start(self, lane, ticket):
+        if lane.waiting[0] is not ticket or self._in_flight >= self.max_in_flight:
+            return False
+        if lane.name == BUILD:
+            # Queries waiting for a slot always go first
+            if self._lanes[QUERY].waiting or lane.in_flight >= self.build_slots:
+                return False
+        return True
+
+    @contextmanager
+    def admit(self, name='job', lane=QUERY, block=False):
+        """Hold a job slot in `lane` for the duration of the block
+
+        With `block` set (background work with no client waiting on it) the
+        queue length and wait timeout limits do not apply.
+        """
+        ticket = object()
+        lane = self._lanes[lane]
+        queued_at = time.time()
+        with self._cond:
+            if not block and len(lane.waiting) >= self.max_queue:
+                lane.rejected += 1
+                raise QueueFullError(
+                    f"Too many queued {lane.name} jobs ({len(lane.waiting)} waiting, "
+                    f"{self._in_flight} running)", 429, self.retry_after(lane.name))
+
+            lane.waiting.append(ticket)
+            self._update_preemption()
+            deadline = queued_at + self.queue_timeout
+            try:
+                while not self._can_start(lane, ticket):
+                    remaining = None if block else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        lane.timed_out += 1
+                        raise QueueFullError(
+                            f"Timed out after {self.queue_timeout}s waiting for a job slot",
+                            503, self.retry_after(lane.name))
+                    self._cond.wait(remaining)
+            finally:
+                lane.waiting.remove(ticket)
+                self._cond.notify_all()
+
+            lane.in_flight += 1
+            lane.record_wait(time.time() - queued_at)
+            self._update_preemption()
+
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            with self._cond:
+                lane.in_flight -= 1
+                lane.avg_job_seconds = 0.8 * lane.avg_job_seconds + 0.2 * elapsed
+                self._update_preemption()
+                self._cond.notify_all()
+            logger.debug(f"{name} released its {lane.name} slot after {elapsed:.2f}s")
+
+    def register_build(self, process):
+        """Track a running build process (started in its own session) for preemption"""
+        with self._cond:
+            self._builds[process.pid] = None
+            self._update_preemption()
+
+    def unregister_build(self, process):
+        with self._cond:
+            paused_at = self._builds.pop(process.pid, None)
+            if paused_at is not None:
+                self.build_paused_seconds += time.time() - paused_at
+                self._signal(process.pid, signal.SIGCONT)
+
+    def _queries_active(self):
+        query_lane = self._lanes[QUERY]
+        return query_lane.in_flight > 0 or len(query_lane.waiting) > 0
+
+    def _update_preemption(self):
+        """Pause builds while queries are active, resume them once queries drain"""
+        if not self.pause_builds:
+            return
+        pause = self._queries_active() and time.time() >= self._resume_until
+        now = time.time()
+        for pid, paused_at in list(self._builds.items()):
+            if pause and paused_at is None:
+                if self._signal(pid, signal.SIGSTOP):
+                    self._builds[pid] = now
+                    self.build_pauses += 1
+                    logger.info(f"Paused build {pid} while queries are active")
+            elif not pause and paused_at is not None:
+                self._signal(pid, signal.SIGCONT)
+                self._builds[pid] = None
+                self.build_paused_seconds += now - paused_at
+                logger.info(f"Resumed build {pid} after {now - paused_at:.1f}s")
+
+    def _watch(self):
+        """Let builds run for a while if queries have kept them paused too long"""
+        while True:
+            time.sleep(1)
+            with self._cond:
+                now = time.time()
+                starved = any(paused_at is not None and now - paused_at >= self.max_build_pause
+                              for paused_at in self._builds.values())
+                if starved:
+                    logger.info(f"Builds paused for {self.max_build_pause}s; resuming them for "
+                                f"{self.max_build_pause / 2:.0f}s")
+                    self._resume_until = now + self.max_build_pause / 2
+                self._update_preemption()
+
+    @staticmethod
+    def _signal(pid, sig):
+        try:
+            os.killpg(pid, sig)
+            return True
+        except (ProcessLookupError, PermissionError):
+            return False
+
+    def describe(self):
+        with self._cond:
+            now = time.time()
+            paused = [p for p in self._builds.values() if p is not None]
+            return {
+                'in_flight': self._in_flight,
+                'queued': sum(len(lane.waiting) for lane in self._lanes.values()),
+                'max_in_flight': self.max_in_flight,
+                'build_slots': self.build_slots,
+                'max_queue': self.max_queue,
+                'queue_timeout': self.queue_timeout,
+                'lanes': {name: lane.describe() for name, lane in self._lanes.items()},
+                'preemption': {
+                    'enabled': self.pause_builds,
+                    'running_builds': len(self._builds) - len(paused),
+                    'paused_builds': len(paused),
+                    'pauses': self.build_pauses,
+                    'paused_seconds': round(self.build_paused_seconds + sum(now - p for p in paused), 1),
+                },
+            }
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Hot and cold storage tiers for chunk KV caches
+
+Caches are built into the cold tier (the kv_caches volume, where idle caches
+may also be compressed by cold_storage). A cache that is queried is copied
+to the hot tier (local NVMe or tmpfs) in the background and served from
+there; caches that have not been used for a while, or the least recently
+used ones when the hot tier is over its budget, are moved back.
+
+Both tiers use the same relative layout, so a cache path in either tier
+names the same cache and callers never have to know where it currently is.
+Each move is reported through `on_moved(old_path, new_path, direction)`,
+which updates the registry's kv_cache_path in a single statement and moves
+the cache's prompt prefix snapshots along. A cache is never moved while a
+query loads it through `reader()`; a promotion that finds readers is
+retried once the last one is done, and readers that arrive during a move
+wait until it and `on_moved` are done.
+"""
+
+import os
+import time
+import errno
+import queue
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger("CAG-Bridge")
+
+RECENT_USE = 60  # Seconds after a load during which a hot cache is never moved out
+
+
+def move_file(source, target):
+    """Rename, or copy and delete across filesystems, never leaving a partial target"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.rename(source, target)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    partial_path = target + '.partial'
+    try:
+        shutil.copy2(source, partial_path)
+        os.replace(partial_path, target)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    os.remove(source)
+
+
+class TieredStorage:
+    """Moves chunk caches between a hot and a cold directory by use
+
+    `usage()` returns {cache path: {'last_used': epoch seconds or None,
+    'usage_count': int}} from the registry (or None). Caches used at least
+    `min_uses` times within `idle_seconds` are promoted by the periodic scan
+    as well as on load.
+    """
+
+    def __init__(self, hot_dir, cold_dir, cold_storage, budget_bytes, idle_seconds=86400, min_uses=2,
+                 scan_interval=300, usage=None, on_moved=None, exclude=()):
+        self.hot_dir = os.path.abspath(hot_dir) if hot_dir else None
+        self.cold_dir = os.path.abspath(cold_dir)
+        self.cold_storage = cold_storage
+        self.budget_bytes = budget_bytes
+        self.idle_seconds = idle_seconds
+        self.min_uses = min_uses
+        self.scan_interval = scan_interval
+        self.usage = usage or (lambda: None)
+        self.on_moved = on_moved
+        self.exclude = tuple(os.path.realpath(p) + os.sep for p in exclude)
+        self.enabled = self.hot_dir is not None
+
+        self._lock = threading.Lock()
+        self._moved = threading.Condition(self._lock)
+        self._touched = {}  # relative path -> time of the last load
+        self._pending = set()  # relative paths queued for promotion
+        self._readers = {}  # relative path -> number of queries loading it
+        self._moving = set()  # relative paths being moved between tiers
+        self._deferred = set()  # relative paths whose promotion waits for their readers
+        self._queue = queue.Queue()
+
+        self.promotions = 0
+        self.demotions = 0
+        self.failures = 0
+
+    def start(self):
+        if self.enabled:
+            os.makedirs(self.hot_dir, exist_ok=True)
+            threading.Thread(target=self._run, name='tiered-storage', daemon=True).start()
+
+    def _relative(self, path):
+        """The tier-independent name of a cache, or None for files outside both tiers"""
+        path = os.path.abspath(path)
+        if not path.endswith('.bin') or os.path.realpath(path).startswith(self.exclude):
+            return None
+        # The hot tier is checked first in case it lives inside the cold one
+        for tier_dir in (self.hot_dir, self.cold_dir):
+            if path.startswith(tier_dir + os.sep):
+                return os.path.relpath(path, tier_dir)
+        return None
+
+    def _paths(self, rel):
+        return os.path.join(self.hot_dir, rel), os.path.join(self.cold_dir, rel)
+
+    def exists(self, path):
+        rel = self._relative(path) if self.enabled else None
+        if rel is None:
+            return self.cold_storage.exists(path)
+        hot, cold = self._paths(rel)
+        return os.path.exists(hot) or self.cold_storage.exists(cold)
+
+    def home(self, path):
+        """A cache's path in the cold tier, where it is built"""
+        return self.aliases(path)[-1]
+
+    def aliases(self, path):
+        """Every path a cache may be registered under: its hot and cold tier paths"""
+        rel = self._relative(path) if self.enabled else None
+        return [os.path.abspath(path)] if rel is None else list(self._paths(rel))
+
+    def stored_path(self, path):
+        """The uncompressed file a cache is stored in right now, or None; unlike locate() this is not a use"""
+        rel = self._relative(path) if self.enabled else None
+        candidates = [path] if rel is None else self._paths(rel)
+        return next((p for p in candidates if os.path.exists(p)), None)
+
+    def last_loaded(self, path):
+        """When this process last loaded a cache from either tier, or 0"""
+        rel = self._relative(path) if self.enabled else None
+        if rel is None:
+            return self.cold_storage.last_loaded(path)
+        with self._lock:
+            return self._touched.get(rel, 0)
+
+    def locate(self, path, promote=True):
+        """Where to load a cache from right now; a cache in the cold tier is promoted in the background"""
+        rel = self._relative(path) if self.enabled else None
+        if rel is None:
+            return self.cold_storage.ensure(path)
+        hot, cold = self._paths(rel)
+        with self._lock:
+            self._touched[rel] = time.time()
+        if os.path.exists(hot):
+            return hot
+        cold = self.cold_storage.ensure(cold)
+        if promote and os.path.exists(cold):
+            with self._lock:
+                if rel in self._pending:
+                    return cold
+                self._pending.add(rel)
+            self._queue.put(rel)
+        return cold
+
+    @contextmanager
+    def reader(self, path):
+        """Locate a cache and keep it in that tier until the block exits"""
+        rel = self._relative(path) if self.enabled else None
+        if rel is None:
+            yield self.locate(path)
+            return
+        with self._moved:
+            self._readers[rel] = self._readers.get(rel, 0) + 1
+            # A move that has started is finished first, so the path located below stays valid
+            while rel in self._moving:
+                self._moved.wait()
+        try:
+            yield self.locate(path)
+        finally:
+            with self._lock:
+                self._readers[rel] -= 1
+                retry = not self._readers[rel] and rel in self._deferred
+                if not self._readers[rel]:
+                    del self._readers[rel]
+                if retry:
+                    self._deferred.discard(rel)
+                    retry = rel not in self._pending
+                    self._pending.add(rel)
+            if retry:
+                self._queue.put(rel)
+
+    def discard(self, path):
+        """Drop the hot and compressed copies of a cache that has just been rebuilt in the cold tier"""
+        rel = self._relative(path) if self.enabled else None
+        if rel is None:
+            stale_copies = [self.cold_storage.compressed_path(path)]
+            cold = path
+        else:
+            hot, cold = self._paths(rel)
+            stale_copies = [hot if os.path.exists(hot) else None, self.cold_storage.compressed_path(cold)]
+        with self.cold_storage.path_lock(os.path.abspath(cold)):
+            for stale in stale_copies:
+                if stale is not None and os.path.exists(stale):
+                    os.remove(stale)
+                    logger.info(f"Removed outdated copy {stale} of rebuilt KV cache {cold}")
+
+    def _run(self):
+        next_scan = time.time()
+        while True:
+            try:
+                rel = self._queue.get(timeout=max(0.0, next_scan - time.time()))
+            except queue.Empty:
+                rel = None
+            try:
+                if rel is not None:
+                    self._promote(rel)
+                    with self._lock:
+                        self._pending.discard(rel)
+                else:
+                    self.scan()
+                    next_scan = time.time() + self.scan_interval
+            except Exception as e:
+                logger.error(f"Tiered storage {'promotion' if rel else 'scan'} failed: {str(e)}", exc_info=True)
+
+    def _hot_caches(self, usage):
+        """(rel, size, last use) of every cache in the hot tier"""
+        caches = []
+        for root, _dirs, files in os.walk(self.hot_dir):
+            # Snapshots follow their caches instead of being moved on their own
+            if (os.path.realpath(root) + os.sep).startswith(self.exclude):
+                continue
+            for name in files:
+                path = os.path.join(root, name)
+                if not name.endswith('.bin'):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                rel = os.path.relpath(path, self.hot_dir)
+                caches.append((rel, stat.st_size, self._last_use(rel, stat.st_mtime, usage)))
+        return caches
+
+    def _last_use(self, rel, mtime, usage):
+        hot, cold = self._paths(rel)
+        recorded = [(usage.get(p) or {}).get('last_used') or 0 for p in (hot, cold)]
+        with self._lock:
+            touched = self._touched.get(rel, 0)
+        return max([mtime, touched] + recorded)
+
+    def scan(self):
+        """Demote idle hot caches, promote frequently used cold ones, and keep the hot tier in budget"""
+        usage = self.usage() or {}
+        now = time.time()
+        for rel, _size, last_use in self._hot_caches(usage):
+            if last_use < now - self.idle_seconds:
+                self._demote(rel)
+        if self.min_uses > 0:
+            for path, row in usage.items():
+                rel = self._relative(path)
+                if rel is None or not row.get('last_used') or row['last_used'] < now - self.idle_seconds:
+                    continue
+                if (row.get('usage_count') or 0) >= self.min_uses and os.path.exists(self._paths(rel)[1]):
+                    self._promote(rel)
+        self._make_room(0, usage)
+
+    def _make_room(self, needed, usage=None):
+        """Demote least recently used hot caches until `needed` more bytes fit; False if they cannot"""
+        if self.budget_bytes <= 0:
+            return True
+        caches = self._hot_caches(usage if usage is not None else self.usage() or {})
+        used = sum(size for _rel, size, _last in caches)
+        for rel, size, last_use in sorted(caches, key=lambda c: c[2]):
+            if used + needed <= self.budget_bytes:
+                break
+            if last_use > time.time() - RECENT_USE:
+                continue
+            if self._demote(rel):
+                used -= size
+        return used + needed <= self.budget_bytes
+
+    def _promote(self, rel):
+        hot, cold = self._paths(rel)
+        if os.path.exists(hot) or not os.path.exists(cold):
+            return False
+        size = os.path.getsize(cold)
+        if self.budget_bytes > 0 and size > self.budget_bytes:
+            return False
+        if not self._make_room(size):
+            logger.info(f"No room in the hot tier for {rel}")
+            return False
+        return self._move(cold, hot, cold, 'promote')
+
+    def _demote(self, rel):
+        hot, cold = self._paths(rel)
+        if not os.path.exists(hot):
+            return False
+        return self._move(hot, cold, cold, 'demote')
+
+    def _move(self, source, target, cold, direction):
+        rel = self._relative(cold)
+        with self._lock:
+            if self._readers.get(rel):
+                # Moving would pull the file away from a query that has just located it
+                if direction == 'promote':
+                    self._deferred.add(rel)
+                return False
+            self._moving.add(rel)
+        start = time.time()
+        try:
+            if not self._move_file(source, target, cold, direction):
+                return False
+            with self._lock:
+                if direction == 'promote':
+                    self.promotions += 1
+                else:
+                    self.demotions += 1
+            logger.info(f"{direction.capitalize()}d KV cache {source} -> {target} in {time.time() - start:.2f}s")
+            # Still within the move, so no query loads the files on_moved relocates
+            if self.on_moved is not None:
+                self.on_moved(source, target, direction)
+            return True
+        finally:
+            with self._moved:
+                self._moving.discard(rel)
+                self._moved.notify_all()
+
+    def _move_file(self, source, target, cold, direction):
+        # Not while cold_storage compresses or restores the cold copy
+        with self.cold_storage.path_lock(cold):
+            try:
+                if not os.path.exists(source):
+                    return False
+                if direction == 'demote':
+                    # A compressed copy of an older version must not shadow the demoted file
+                    stale = self.cold_storage.compressed_path(cold)
+                    if stale is not None:
+                        os.remove(stale)
+                move_file(source, target)
+                if direction == 'promote':
+                    # The hot copy's mtime is its last promotion, so idle time survives restarts
+                    os.utime(target)
+            except Exception as e:
+                logger.error(f"Failed to {direction} KV cache {source}: {str(e)}")
+                with self._lock:
+                    self.failures += 1
+                return False
+        return True
+
+    def describe(self):
+        if not self.enabled:
+            return {'enabled': False}
+        try:
+            hot_bytes = sum(size for _rel, size, _last in self._hot_caches({}))
+        except OSError:
+            hot_bytes = None
+        with self._lock:
+            return {
+                'enabled': True,
+                'hot_dir': self.hot_dir,
+                'cold_dir': self.cold_dir,
+                'budget_bytes': self.budget_bytes,
+                'hot_bytes': hot_bytes,
+                'pending_promotions': len(self._pending),
+                'readers': sum(self._readers.values()),
+                'promotions': self.promotions,
+                'demotions': self.demotions,
+                'failures': self.failures,
+            }
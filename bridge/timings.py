@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Timing breakdowns for llama.cpp runs
+
+Turns the summary llama.cpp prints on exit (llama_print_timings or, in newer
+builds, llama_perf_context_print) and the `timings` object returned by
+llama-server into the same structured fields, so script and worker runs can
+be compared directly.
+"""
+
+import re
+
+import metrics
+
+# e.g. "llama_print_timings: prompt eval time =  2345.67 ms /   100 tokens (...)"
+TIMING_LINE = re.compile(r'\b(load|sample|prompt eval|eval|total) time\s*=\s*([\d.]+) ms'
+                         r'(?:\s*/\s*(\d+)\s*(?:tokens|runs))?')
+
+FIELDS = ('load_ms', 'prompt_eval_ms', 'prompt_tokens', 'prompt_eval_tps',
+          'eval_ms', 'tokens_generated', 'eval_tps')
+
+
+def _rate(tokens, ms):
+    if tokens and ms:
+        return round(tokens / ms * 1000, 2)
+    return None
+
+
+def empty():
+    return dict.fromkeys(FIELDS)
+
+
+def parse_llama_timings(text):
+    """Extract the timing summary from llama.cpp output; fields not found are None"""
+    timings = empty()
+    for name, ms, count in TIMING_LINE.findall(text or ''):
+        ms = float(ms)
+        count = int(count) if count else None
+        if name == 'load':
+            timings['load_ms'] = ms
+        elif name == 'prompt eval':
+            timings['prompt_eval_ms'] = ms
+            timings['prompt_tokens'] = count
+        elif name == 'eval':
+            timings['eval_ms'] = ms
+            timings['tokens_generated'] = count
+    timings['prompt_eval_tps'] = _rate(timings['prompt_tokens'], timings['prompt_eval_ms'])
+    timings['eval_tps'] = _rate(timings['tokens_generated'], timings['eval_ms'])
+    return timings
+
+
+def from_server_timings(server_timings, load_ms=None):
+    """Convert llama-server's `timings` object; `load_ms` is the KV cache restore time"""
+    server_timings = server_timings or {}
+    timings = empty()
+    timings['load_ms'] = round(load_ms, 1) if load_ms is not None else None
+    timings['prompt_eval_ms'] = server_timings.get('prompt_ms')
+    timings['prompt_tokens'] = server_timings.get('prompt_n')
+    timings['eval_ms'] = server_timings.get('predicted_ms')
+    timings['tokens_generated'] = server_timings.get('predicted_n')
+    timings['prompt_eval_tps'] = _rate(timings['prompt_tokens'], timings['prompt_eval_ms'])
+    timings['eval_tps'] = _rate(timings['tokens_generated'], timings['eval_ms'])
+    return timings
+
+
+def record(timings, source):
+    """Feed the throughput of a finished run into the /metrics histograms"""
+    if timings.get('prompt_eval_tps'):
+        metrics.PROMPT_EVAL_RATE.observe(timings['prompt_eval_tps'], source=source)
+    if timings.get('eval_tps'):
+        metrics.GENERATION_RATE.observe(timings['eval_tps'], source=source)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Batched cache usage statistics for the registry
+
+Every query counts a use of the caches it loads in memory. A background
+thread hands the counts to the database writer every `interval` seconds as a
+single bulk UPDATE of last_used and usage_count, so a query never waits on
+Postgres and a crash loses at most one interval of uses. A batch that fails
+is merged back and retried with the next one; only when more than
+`max_pending` caches are waiting are the uses of new ones dropped.
+"""
+
+import time
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger("CAG-Bridge")
+
+
+class UsageRecorder:
+    """Accumulates cache uses and flushes them in batches through `write(rows, on_done)`
+
+    `rows` are (cache path, uses, last use as epoch seconds); `on_done(error)`
+    is called by the writer once the batch is committed (error is None) or
+    has failed. `aliases(path)` gives every path a cache may be registered
+    under; each gets the same counts, and a registry row matches only one.
+    """
+
+    def __init__(self, write, interval=5.0, max_pending=10000, enabled=True, aliases=None):
+        self.write = write
+        self.interval = interval
+        self.max_pending = max_pending
+        self.enabled = enabled
+        self.aliases = aliases or (lambda path: [path])
+
+        self._lock = threading.Lock()
+        self._pending = {}  # cache path -> [uses, last use]
+        self._in_flight = None  # threading.Event of the batch being written
+
+        self.flushes = 0
+        self.flushed_uses = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_flush_ms = None
+        self.flush_seconds = 0.0
+
+    def start(self):
+        if self.enabled:
+            threading.Thread(target=self._run, name='usage-stats', daemon=True).start()
+
+    def record(self, path, uses=1, when=None):
+        """Count a use of a cache; never blocks on the database"""
+        if not self.enabled:
+            return
+        when = when or time.time()
+        with self._lock:
+            self._merge(path, uses, when)
+
+    def _merge(self, path, uses, when):
+        """Add uses to a pending entry; called with the lock held"""
+        entry = self._pending.get(path)
+        if entry is None:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += uses
+                metrics.USAGE_DROPPED.inc(uses)
+                return
+            entry = self._pending[path] = [0, when]
+        entry[0] += uses
+        entry[1] = max(entry[1], when)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Usage statistics flush failed: {str(e)}", exc_info=True)
+
+    def flush(self):
+        """Hand the pending counts to the writer; returns an Event set when they are written, or None"""
+        with self._lock:
+            if not self._pending:
+                return None
+            if self._in_flight is not None and not self._in_flight.is_set():
+                # The previous batch is still queued; keep accumulating rather than piling up batches
+                return None
+            batch, self._pending = self._pending, {}
+            done = self._in_flight = threading.Event()
+
+        rows = [(alias, uses, last_used) for path, (uses, last_used) in batch.items()
+                for alias in dict.fromkeys(self.aliases(path))]
+        start = time.time()
+
+        def on_done(error):
+            elapsed = time.time() - start
+            with self._lock:
+                if error is None:
+                    self.flushes += 1
+                    self.flushed_uses += sum(uses for uses, _last in batch.values())
+                    self.last_flush_ms = round(elapsed * 1000, 1)
+                    self.flush_seconds += elapsed
+                else:
+                    self.failures += 1
+                    for path, (uses, last_used) in batch.items():
+                        self._merge(path, uses, last_used)
+            if error is None:
+                metrics.USAGE_FLUSH_SECONDS.observe(elapsed)
+            done.set()
+
+        self.write(rows, on_done)
+        return done
+
+    def close(self, timeout=5.0):
+        """Write what is pending before shutdown"""
+        if not self.enabled:
+            return
+        deadline = time.time() + timeout
+        with self._lock:
+            in_flight = self._in_flight
+        if in_flight is not None:
+            in_flight.wait(timeout)
+        done = self.flush()
+        if done is not None and not done.wait(max(0.0, deadline - time.time())):
+            logger.warning("Usage statistics were not written before shutdown")
+
+    def describe(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'interval': self.interval,
+                'pending': len(self._pending),
+                'flushes': self.flushes,
+                'flushed_uses': self.flushed_uses,
+                'failures': self.failures,
+                'dropped': self.dropped,
+                'last_flush_ms': self.last_flush_ms,
+                'avg_flush_ms': round(self.flush_seconds * 1000 / self.flushes, 1) if self.flushes else None,
+            }
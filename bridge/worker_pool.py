@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+"""
+Persistent inference workers for the CAG bridge
+
+Each worker is a long-lived llama.cpp server process that loads the model
+once at bridge startup. Queries are routed to an idle worker, which only
+restores a KV cache into its slot when it holds a different one.
+
+llama-server only reuses the part of a slot's KV state that the next prompt
+starts with, so every completion sends the cache's token ids (read from the
+state file header) ahead of the question. A completion that still evaluates
+more than the question's tokens did not reuse the cache and is reported as
+a worker error, so the caller falls back to the query script.
+
+Workers can run several slots. Concurrent queries against the same KV cache
+that arrive within a short batching window are then coalesced onto a single
+worker and decoded together, one sequence per slot, instead of queueing for
+a worker each.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import subprocess
+import http.client
+from collections import OrderedDict
+
+import metrics
+import timings
+from kv_residency import KVResidencyCache, cache_key
+from context_size import read_state_tokens
+
+logger = logging.getLogger("CAG-Bridge")
+
+PREFIX_TOKEN_CACHE = 16  # Token id lists of this many recently used caches are kept in memory
+PROMPT_TOKEN_SLACK = 16  # Prompt tokens beyond one per question byte that still count as a reused cache
+
+
+def cache_reused(server_timings, prompt):
+    """False if llama-server evaluated more tokens than the question can have"""
+    evaluated = (server_timings or {}).get('prompt_n')
+    if evaluated is not None and evaluated > len(prompt.encode('utf-8')) + PROMPT_TOKEN_SLACK:
+        metrics.FAILURES.inc(reason='kv_cache_not_reused')
+        return False
+    return True
+
+
+class WorkerError(Exception):
+    """Raised when an inference worker cannot serve a request"""
+    pass
+
+
+class InferenceWorker:
+    """A single model-resident llama.cpp server process"""
+
+    def __init__(self, worker_id, server_bin, model_path, port, slot_dir,
+                 threads, ctx_size, batch_size, slots=1, use_mmap=True):
+        self.worker_id = worker_id
+        self.server_bin = server_bin
+        self.model_path = model_path
+        self.port = port
+        self.slot_dir = slot_dir
+        self.threads = threads
+        self.ctx_size = ctx_size
+        self.batch_size = batch_size
+        self.slots = max(1, slots)
+        self.use_mmap = use_mmap
+
+        self.process = None
+        self.state = 'stopped'  # stopped, starting, idle, busy, crashed
+        self.loaded_caches = [None] * self.slots  # cache_key() of the KV state in each slot
+        self.started_at = None
+        self.last_start_attempt = 0
+        self.restarts = 0
+        self.requests_served = 0
+        self.last_error = None
+        self.log_file = f"/tmp/cag_worker_{worker_id}.log"
+
+    def start(self, timeout=600):
+        """Spawn the server process and wait until the model is loaded"""
+        command = [
+            self.server_bin,
+            '-m', self.model_path,
+            '--host', '127.0.0.1',
+            '--port', str(self.port),
+            # llama-server splits the context between slots; give each the full size
+            '--ctx-size', str(int(self.ctx_size) * self.slots),
+            '--threads', str(self.threads),
+            '--batch-size', str(self.batch_size),
+            '--parallel', str(self.slots),
+            '--slot-save-path', self.slot_dir,
+        ]
+        if not self.use_mmap:
+            command.append('--no-mmap')
+
+        logger.info(f"Starting inference worker {self.worker_id}: {' '.join(command)}")
+        self.state = 'starting'
+        self.loaded_caches = [None] * self.slots
+        self.last_start_attempt = time.time()
+        with open(self.log_file, 'ab') as log:
+            self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=log)
+        self.started_at = time.time()
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self.is_alive():
+                self.state = 'crashed'
+                self.last_error = f"Exited with code {self.process.returncode} during startup (see {self.log_file})"
+                raise WorkerError(self.last_error)
+            try:
+                status, _ = self._request('GET', '/health', timeout=5)
+                if status == 200:
+                    self.state = 'idle'
+                    logger.info(f"Inference worker {self.worker_id} ready on port {self.port} "
+                                f"after {time.time() - self.started_at:.1f}s")
+                    return
+            except (OSError, http.client.HTTPException):
+                pass
+            time.sleep(1)
+
+        self.stop()
+        self.state = 'crashed'
+        self.last_error = f"Model did not load within {timeout}s"
+        raise WorkerError(self.last_error)
+
+    def stop(self):
+        """Terminate the server process"""
+        if self.process and self.is_alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.state = 'stopped'
+        self.loaded_caches = [None] * self.slots
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _request(self, method, path, body=None, timeout=None):
+        """Send a JSON request to the server process and decode the reply"""
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+        try:
+            payload = json.dumps(body).encode('utf-8') if body is not None else None
+            headers = {'Content-Type': 'application/json'} if payload else {}
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            raw = response.read().decode('utf-8')
+            try:
+                data = json.loads(raw) if raw else {}
+            except ValueError:
+                data = {'raw': raw}
+            return response.status, data
+        finally:
+            conn.close()
+
+    def load_cache(self, key, slot_file, slot=0):
+        """Restore a KV cache into a slot unless it is already resident
+
+        Returns True if a swap was needed.
+        """
+        if self.loaded_caches[slot] == key:
+            return False
+
+        status, data = self._request('POST', f'/slots/{slot}?action=restore', {'filename': slot_file})
+        if status != 200:
+            self.loaded_caches[slot] = None
+            raise WorkerError(f"Failed to restore KV cache {key[0]}: {data}")
+
+        self.loaded_caches[slot] = key
+        return True
+
+    def _completion_body(self, prompt, max_tokens, temperature, seed=None, stream=False, slot=0, prefix=None):
+        body = {
+            # The cached tokens first, so the whole restored KV state is the common prefix
+            'prompt': list(prefix) + [prompt] if prefix else prompt,
+            'n_predict': int(max_tokens),
+            'temperature': float(temperature) if temperature is not None else 0.7,
+            'repeat_penalty': 1.1,
+            'top_p': 0.9,
+            'cache_prompt': True,
+            'id_slot': slot,
+            'stream': stream,
+        }
+        if seed is not None:
+            body['seed'] = int(seed)
+        return body
+
+    def complete(self, prompt, max_tokens, temperature, seed=None, slot=0, prefix=None):
+        """Generate a completion on top of the KV state resident in a slot"""
+        body = self._completion_body(prompt, max_tokens, temperature, seed, slot=slot, prefix=prefix)
+        status, data = self._request('POST', '/completion', body)
+        if status != 200:
+            raise WorkerError(f"Completion failed with HTTP {status}: {data}")
+        return data
+
+    def stream(self, prompt, max_tokens, temperature, seed=None, slot=0, prefix=None):
+        """Yield server-sent completion events as tokens are produced
+
+        Each event is the decoded JSON payload; the last one has `stop` set
+        and carries the server's timings.
+        """
+        body = json.dumps(self._completion_body(prompt, max_tokens, temperature, seed, stream=True, slot=slot,
+                                                prefix=prefix)).encode('utf-8')
+        conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        try:
+            conn.request('POST', '/completion', body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            if response.status != 200:
+                raise WorkerError(f"Completion failed with HTTP {response.status}: "
+                                  f"{response.read().decode('utf-8', 'replace')}")
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line.startswith(b'data:'):
+                    continue
+                event = json.loads(line[5:].decode('utf-8'))
+                yield event
+                if event.get('stop'):
+                    break
+        finally:
+            conn.close()
+
+    def describe(self):
+        return {
+            'id': self.worker_id,
+            'state': self.state,
+            'pid': self.process.pid if self.is_alive() else None,
+            'port': self.port,
+            'slots': self.slots,
+            'loaded_caches': [key[0] if key else None for key in self.loaded_caches],
+            'uptime_seconds': round(time.time() - self.started_at, 1) if self.is_alive() else None,
+            'requests_served': self.requests_served,
+            'restarts': self.restarts,
+            'last_error': self.last_error,
+        }
+
+
+class QueryBatch:
+    """Queries against one KV cache that share a worker, one slot each"""
+
+    def __init__(self, key, capacity):
+        self.key = key
+        self.capacity = capacity
+        self.members = 0  # Slots handed out so far
+        self.active = 0  # Members that have not finished yet
+        self.full = threading.Event()
+        self.ready = threading.Event()
+        self.worker = None
+        self.swapped = []
+        self.load_ms = 0.0  # Time spent staging and restoring the cache
+        self.prefix = None  # Token ids held in the cache, sent ahead of each prompt
+        self.error = None
+
+
+class WorkerPool:
+    """Fixed-size pool of model-resident inference workers"""
+
+    def __init__(self, size, server_bin, model_path, slot_dir, base_port=8100,
+                 threads=4, ctx_size=128000, batch_size=1024,
+                 restart_on_crash=True, acquire_timeout=300, residency=None,
+                 max_batch=1, batch_window=0.02, use_mmap=True):
+        self.server_bin = server_bin
+        self.model_path = model_path
+        # Without a residency budget, caches are linked in and read from disk
+        self.residency = residency or KVResidencyCache(slot_dir)
+        self.slot_dir = self.residency.slot_dir
+        self.restart_on_crash = restart_on_crash
+        self.acquire_timeout = acquire_timeout
+        self.max_batch = max(1, max_batch)
+        self.batch_window = max(0.0, batch_window)
+
+        self.workers = [
+            InferenceWorker(i, server_bin, model_path, base_port + i, self.slot_dir,
+                            threads, ctx_size, batch_size, slots=self.max_batch, use_mmap=use_mmap)
+            for i in range(size)
+        ]
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._monitor = None
+
+        self._batch_lock = threading.Lock()
+        self._open_batches = {}  # cache key -> QueryBatch still accepting members
+        self._prefixes = OrderedDict()  # cache key -> token ids, most recently used last
+        self.batches = 0
+        self.batched_queries = 0
+        self.largest_batch = 0
+
+    def start(self):
+        """Start every worker and the crash monitor"""
+        self.residency.start()
+        for worker in self.workers:
+            try:
+                worker.start()
+            except (OSError, WorkerError) as e:
+                worker.state = 'crashed'
+                worker.last_error = str(e)
+                logger.error(f"Inference worker {worker.worker_id} failed to start: {str(e)}")
+
+        self._monitor = threading.Thread(target=self._watch, name='worker-monitor', daemon=True)
+        self._monitor.start()
+
+    def shutdown(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for worker in self.workers:
+            worker.stop()
+
+    def available(self):
+        """True if at least one worker is loaded (idle or busy)"""
+        return any(w.state in ('idle', 'busy') for w in self.workers)
+
+    def _watch(self):
+        """Detect crashed workers and restart them if configured to"""
+        while not self._stopping:
+            time.sleep(5)
+            for worker in self.workers:
+                if self._stopping:
+                    return
+                if worker.state in ('idle', 'busy') and not worker.is_alive():
+                    logger.error(f"Inference worker {worker.worker_id} exited with code "
+                                 f"{worker.process.returncode}")
+                    with self._cond:
+                        worker.state = 'crashed'
+                        worker.last_error = f"Exited with code {worker.process.returncode}"
+                if worker.state == 'crashed' and self.restart_on_crash:
+                    # Back off exponentially so a broken model does not reload in a tight loop
+                    backoff = min(300, 5 * 2 ** min(worker.restarts, 6))
+                    if time.time() - worker.last_start_attempt < backoff:
+                        continue
+                    worker.restarts += 1
+                    try:
+                        worker.start()
+                    except (OSError, WorkerError) as e:
+                        logger.error(f"Restart of inference worker {worker.worker_id} failed: {str(e)}")
+                        continue
+                    with self._cond:
+                        self._cond.notify_all()
+
+    def acquire(self, key=None):
+        """Wait for an idle worker, preferring one that already holds `key`"""
+        deadline = time.time() + self.acquire_timeout
+        with self._cond:
+            while True:
+                if self._stopping:
+                    raise WorkerError("Worker pool is shutting down")
+
+                idle = [w for w in self.workers if w.state == 'idle' and w.is_alive()]
+                if idle:
+                    worker = next((w for w in idle if key in w.loaded_caches), idle[0])
+                    worker.state = 'busy'
+                    return worker
+
+                if not self.available():
+                    raise WorkerError("No inference workers are running")
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise WorkerError(f"No idle inference worker within {self.acquire_timeout}s")
+                self._cond.wait(remaining)
+
+    def release(self, worker):
+        with self._cond:
+            if worker.state == 'busy':
+                worker.state = 'idle' if worker.is_alive() else 'crashed'
+            self._cond.notify_all()
+
+    def stage(self, cache_path):
+        """Expose a KV cache in the slot directory and return its file name"""
+        return self.residency.stage(cache_path)
+
+    def prefix_tokens(self, key, cache_path):
+        """Token ids a cache holds, read once per cache version"""
+        with self._batch_lock:
+            if key in self._prefixes:
+                self._prefixes.move_to_end(key)
+                return self._prefixes[key]
+        tokens = read_state_tokens(cache_path)
+        if not tokens:
+            raise WorkerError(f"No token ids in the header of {cache_path}; cannot reuse it on a worker")
+        with self._batch_lock:
+            self._prefixes[key] = tokens
+            while len(self._prefixes) > PREFIX_TOKEN_CACHE:
+                self._prefixes.popitem(last=False)
+        return tokens
+
+    def _join_batch(self, cache_path):
+        """Claim a slot in a batch for `cache_path`, opening a new batch if needed
+
+        The first query for a cache waits up to the batching window for others
+        to join, then acquires one worker and restores the cache into as many
+        slots as there are members. Returns (batch, slot) once the worker is
+        ready; the caller must hand the slot back with _leave_batch().
+        """
+        if not os.path.exists(cache_path):
+            raise WorkerError(f"Cache file not found: {cache_path}")
+
+        key = cache_key(cache_path)
+        with self._batch_lock:
+            batch = self._open_batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = QueryBatch(key, self.max_batch)
+                if batch.capacity > 1:
+                    self._open_batches[key] = batch
+            slot = batch.members
+            batch.members += 1
+            batch.active += 1
+            if batch.members >= batch.capacity:
+                self._close_batch(batch)
+
+        if not leader:
+            batch.ready.wait()
+        else:
+            if batch.capacity > 1:
+                batch.full.wait(self.batch_window)
+            with self._batch_lock:
+                self._close_batch(batch)
+                members = batch.members
+            try:
+                batch.prefix = self.prefix_tokens(key, cache_path)
+                batch.worker = self.acquire(key)
+                load_start = time.time()
+                slot_file = self.stage(cache_path)
+                batch.swapped = [batch.worker.load_cache(key, slot_file, s) for s in range(members)]
+                batch.load_ms = (time.time() - load_start) * 1000
+                if any(batch.swapped):
+                    metrics.KV_LOAD_SECONDS.observe(batch.load_ms / 1000)
+            except Exception as e:
+                # Whatever went wrong, the followers waiting on `ready` must be woken with the error
+                if not isinstance(e, (OSError, http.client.HTTPException, WorkerError)):
+                    logger.error(f"Unexpected error preparing a worker: {str(e)}", exc_info=True)
+                batch.error = WorkerError(f"Could not prepare a worker: {str(e)}")
+                if batch.worker is not None:
+                    batch.worker.loaded_caches = [None] * batch.worker.slots
+                    batch.worker.last_error = str(e)
+            with self._batch_lock:
+                self.batches += 1
+                self.batched_queries += members
+                self.largest_batch = max(self.largest_batch, members)
+            if members > 1:
+                logger.info(f"Batched {members} queries on inference worker "
+                            f"{batch.worker.worker_id if batch.worker else '-'}")
+            batch.ready.set()
+
+        if batch.error is not None:
+            self._leave_batch(batch)
+            raise batch.error
+        return batch, slot
+
+    def _close_batch(self, batch):
+        """Stop a batch from accepting members (called with _batch_lock held)"""
+        if self._open_batches.get(batch.key) is batch:
+            del self._open_batches[batch.key]
+        batch.full.set()
+
+    def _leave_batch(self, batch):
+        """Release the batch's worker once its last member has finished"""
+        with self._batch_lock:
+            batch.active -= 1
+            done = batch.active == 0
+        if done and batch.worker is not None:
+            self.release(batch.worker)
+
+    def run_query(self, cache_path, prompt, max_tokens, temperature, seed=None):
+        """Answer a prompt against a KV cache on the next idle worker"""
+        start_time = time.time()
+        batch, slot = self._join_batch(cache_path)
+        worker = batch.worker
+        try:
+            data = worker.complete(prompt, max_tokens, temperature, seed, slot=slot, prefix=batch.prefix)
+            if not cache_reused(data.get('timings'), prompt):
+                raise WorkerError(f"Evaluated {data['timings']['prompt_n']} prompt tokens; "
+                                  f"the restored KV cache was not reused")
+            run_timings = timings.from_server_timings(data.get('timings'), batch.load_ms)
+            timings.record(run_timings, 'worker')
+            worker.requests_served += 1
+            worker.last_error = None
+        except (OSError, http.client.HTTPException, WorkerError) as e:
+            worker.loaded_caches[slot] = None
+            worker.last_error = str(e)
+            raise WorkerError(f"Inference worker {worker.worker_id} failed: {str(e)}")
+        finally:
+            self._leave_batch(batch)
+
+        return {
+            'response': data.get('content', ''),
+            'worker': worker.worker_id,
+            'swapped': batch.swapped[slot],
+            'batch_size': batch.members,
+            'timings': run_timings,
+            'elapsed': time.time() - start_time,
+        }
+
+    def stream_query(self, cache_path, prompt, max_tokens, temperature, seed=None):
+        """Like run_query(), but yield completion events as they arrive
+
+        The slot is held until the generator is exhausted or closed. The last
+        event's `timings` are converted like run_query()'s.
+        """
+        batch, slot = self._join_batch(cache_path)
+        worker = batch.worker
+        start_time = time.time()
+        first_output = True
+        try:
+            for event in worker.stream(prompt, max_tokens, temperature, seed, slot=slot, prefix=batch.prefix):
+                event['worker'] = worker.worker_id
+                if first_output and event.get('content'):
+                    first_output = False
+                    metrics.FIRST_BYTE_SECONDS.observe(time.time() - start_time, source='worker')
+                if event.get('stop'):
+                    if not cache_reused(event.get('timings'), prompt):
+                        if first_output:
+                            raise WorkerError("The restored KV cache was not reused")
+                        # Too late to fall back once tokens were sent; the answer is right, only slow
+                        logger.warning(f"Inference worker {worker.worker_id} re-evaluated {cache_path}")
+                    event['timings'] = timings.from_server_timings(event.get('timings'), batch.load_ms)
+                    event['swapped'] = batch.swapped[slot]
+                    timings.record(event['timings'], 'worker')
+                yield event
+            worker.requests_served += 1
+            worker.last_error = None
+        except (OSError, ValueError, http.client.HTTPException, WorkerError) as e:
+            worker.loaded_caches[slot] = None
+            worker.last_error = str(e)
+            raise WorkerError(f"Inference worker {worker.worker_id} failed: {str(e)}")
+        finally:
+            self._leave_batch(batch)
+
+    def describe(self):
+        return {
+            'size': len(self.workers),
+            'ready': sum(1 for w in self.workers if w.state in ('idle', 'busy')),
+            'busy': sum(1 for w in self.workers if w.state == 'busy'),
+            'restart_on_crash': self.restart_on_crash,
+            'batching': {
+                'max_batch': self.max_batch,
+                'window_ms': round(self.batch_window * 1000, 1),
+                'batches': self.batches,
+                'queries': self.batched_queries,
+                'avg_batch': round(self.batched_queries / self.batches, 2) if self.batches else 0,
+                'largest_batch': self.largest_batch,
+            },
+            'workers': [w.describe() for w in self.workers],
+        }
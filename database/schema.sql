@@ -124,7 +124,11 @@ DROP TRIGGER IF EXISTS trg_update_kv_cache_usage ON cag_document_registry;
 CREATE TRIGGER trg_update_kv_cache_usage
 BEFORE UPDATE ON cag_document_registry
 FOR EACH ROW
-WHEN (NEW.cag_status = 'cached' AND OLD.cag_status = 'cached' AND OLD.last_used IS NOT NULL)
+WHEN (NEW.cag_status = 'cached' AND OLD.cag_status = 'cached' AND OLD.last_used IS NOT NULL
+      -- Moving a cache between storage tiers is not a use
+      AND NEW.kv_cache_path IS NOT DISTINCT FROM OLD.kv_cache_path
+      -- Usage flushed by the bridge carries its own counts and times
+      AND NEW.usage_count IS NOT DISTINCT FROM OLD.usage_count)
 EXECUTE FUNCTION update_kv_cache_usage();
 
 -- Function to log processing errors
@@ -1,6 +1,7 @@
 #!/bin/bash
 # Enhanced script for creating KV caches with better error handling and monitoring
-# Usage: ./create_kv_cache.sh <model_path> <chunk_file> <cache_file> [ctx_size] [threads] [batch_size]
+# Usage: ./create_kv_cache.sh <model_path> <chunk_file> <cache_file> [ctx_size] [threads] [batch_size] [base_cache]
+# With base_cache, the KV state in it is loaded first and only chunk_file (the appended text) is prefilled
 
 # Source the config file if it exists
 if [ -f ~/cag_project/config.sh ]; then
@@ -14,6 +15,14 @@ CACHE_FILE=$3
 CTX_SIZE=${4:-${LLAMACPP_MAX_CONTEXT:-128000}}
 THREADS=${5:-${LLAMACPP_THREADS:-4}}
 BATCH_SIZE=${6:-${LLAMACPP_BATCH_SIZE:-1024}}
+BASE_CACHE=$7
+
+# Memory-map the model read-only so concurrent llama.cpp processes share its pages in the
+# page cache; LLAMACPP_MMAP=false reads it into private memory instead
+MMAP_FLAG=""
+if [ "${LLAMACPP_MMAP:-true}" = "false" ]; then
+  MMAP_FLAG="--no-mmap"
+fi
 
 # Log start time for performance monitoring
 START_TIME=$(date +%s)
@@ -31,6 +40,11 @@ if [ ! -f "$MODEL_PATH" ]; then
   exit 1
 fi
 
+if [ -n "$BASE_CACHE" ] && [ ! -f "$BASE_CACHE" ]; then
+  echo "Error: Base cache file not found: $BASE_CACHE"
+  exit 1
+fi
+
 # Create directory for cache if it doesn't exist
 mkdir -p "$(dirname "$CACHE_FILE")"
 
@@ -56,6 +70,9 @@ echo "Using model: $MODEL_PATH"
 echo "Output KV cache: $CACHE_FILE"
 echo "Context size: $CTX_SIZE tokens (estimated from $CHUNK_SIZE bytes)"
 echo "Using $THREADS threads and batch size $BATCH_SIZE"
+if [ -n "$BASE_CACHE" ]; then
+  echo "Extending KV cache: $BASE_CACHE"
+fi
 
 # Create a unique ID for this run
 RUN_ID=$(date +%s%N | md5sum | head -c 8)
@@ -71,6 +88,7 @@ echo "Model: $MODEL_PATH" >> "$LOG_FILE"
 echo "Input: $CHUNK_FILE" >> "$LOG_FILE"
 echo "Output: $CACHE_FILE" >> "$LOG_FILE"
 echo "Context: $CTX_SIZE tokens" >> "$LOG_FILE"
+echo "Base cache: ${BASE_CACHE:-none}" >> "$LOG_FILE"
 echo "" >> "$LOG_FILE"
 
 # Monitor memory and CPU usage during processing (optional)
@@ -91,17 +109,21 @@ fi
 # Added logging of stderr separately to better diagnose issues
 $LLAMACPP_PATH/build/bin/main \
   -m "$MODEL_PATH" \
+  ${BASE_CACHE:+--load-kv-cache "$BASE_CACHE"} \
   -f "$CHUNK_FILE" \
   --save-kv-cache "$CACHE_FILE" \
   --max-tokens 1 \
   --ctx-size "$CTX_SIZE" \
   --threads "$THREADS" \
   --batch-size "$BATCH_SIZE" \
-  --no-mmap \
+  $MMAP_FLAG \
   --memory-f32 2>> "$LOG_FILE"
 
 RESULT=$?
 
+# Pass llama.cpp's timing summary on to the caller (the CAG bridge parses it from the output)
+grep -E "(llama_print_timings|llama_perf_context_print):" "$LOG_FILE"
+
 # Stop resource monitoring if running
 if [ -n "$MONITOR_PID" ]; then
   kill $MONITOR_PID 2>/dev/null || true
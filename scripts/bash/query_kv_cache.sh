@@ -1,6 +1,6 @@
 #!/bin/bash
 # Enhanced script for querying using a previously created KV cache
-# Usage: ./query_kv_cache.sh <model_path> <cache_file> <query> <max_tokens> [--temp <temperature>]
+# Usage: ./query_kv_cache.sh <model_path> <cache_file> <query> <max_tokens> [--temp <temperature>] [seed] [ctx_size]
 
 # Source the config file if it exists
 if [ -f ~/cag_project/config.sh ]; then
@@ -13,6 +13,7 @@ CACHE_FILE=$2
 QUERY="$3"
 MAX_TOKENS=${4:-1024}
 TEMP_SETTING=${5:-"--temp 0.7"}
+SEED=$6
 
 # Extract temperature value properly
 if [[ $TEMP_SETTING == --temp* ]]; then
@@ -24,8 +25,15 @@ fi
 # Get threads from environment or use default
 THREADS=${LLAMACPP_THREADS:-4}
 
-# Get maximum context size from environment
-MAX_CONTEXT=${LLAMACPP_MAX_CONTEXT:-128000}
+# Memory-map the model read-only so concurrent llama.cpp processes share its pages in the
+# page cache; LLAMACPP_MMAP=false reads it into private memory instead
+MMAP_FLAG=""
+if [ "${LLAMACPP_MMAP:-true}" = "false" ]; then
+  MMAP_FLAG="--no-mmap"
+fi
+
+# Context size: sized by the caller to the cached tokens plus this query, else the maximum
+MAX_CONTEXT=${7:-${LLAMACPP_MAX_CONTEXT:-128000}}
 
 # Create unique ID for this query
 QUERY_ID=$(date +%s%N | md5sum | head -c 8)
@@ -42,6 +50,7 @@ echo "Cache: $CACHE_FILE" >> "$LOG_FILE"
 echo "Query: $QUERY" >> "$LOG_FILE"
 echo "Max tokens: $MAX_TOKENS" >> "$LOG_FILE"
 echo "Temperature: $TEMPERATURE" >> "$LOG_FILE"
+echo "Seed: ${SEED:-random}" >> "$LOG_FILE"
 echo "" >> "$LOG_FILE"
 
 # Check files exist
@@ -82,14 +91,18 @@ $LLAMACPP_PATH/build/bin/main \
   -n "$MAX_TOKENS" \
   --ctx-size "$MAX_CONTEXT" \
   --threads "$THREADS" \
-  --no-mmap \
+  $MMAP_FLAG \
   --memory-f32 \
   --temp "$TEMPERATURE" \
+  ${SEED:+--seed "$SEED"} \
   --repeat-penalty 1.1 \
   --top-p 0.9 2>> "$LOG_FILE"
 
 RESULT=$?
 
+# Pass llama.cpp's timing summary on to the caller (the CAG bridge parses it from stderr)
+grep -E "(llama_print_timings|llama_perf_context_print):" "$LOG_FILE" >&2
+
 # Performance stats
 END_TIME=$(date +%s)
 ELAPSED=$((END_TIME - START_TIME))
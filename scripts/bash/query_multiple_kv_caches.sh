@@ -1,6 +1,7 @@
 #!/bin/bash
 # Enhanced script for querying multiple KV caches with better handling and formatting
 # Usage: ./query_multiple_kv_caches.sh <model_path> <query> <max_tokens> [temperature] <cache_file1> [<cache_file2> ...]
+# Queries the caches one after another; the CAG bridge's /query-multi endpoint does the same concurrently
 
 # Source the config file if it exists
 if [ -f ~/cag_project/config.sh ]; then
@@ -26,6 +27,13 @@ fi
 THREADS=${LLAMACPP_THREADS:-4}
 MAX_CONTEXT=${LLAMACPP_MAX_CONTEXT:-128000}
 
+# Memory-map the model read-only so concurrent llama.cpp processes share its pages in the
+# page cache; LLAMACPP_MMAP=false reads it into private memory instead
+MMAP_FLAG=""
+if [ "${LLAMACPP_MMAP:-true}" = "false" ]; then
+  MMAP_FLAG="--no-mmap"
+fi
+
 # Performance monitoring
 START_TIME=$(date +%s)
 
@@ -103,7 +111,7 @@ for CACHE_FILE in "$@"; do
     -n 512 \
     --ctx-size "$MAX_CONTEXT" \
     --threads "$THREADS" \
-    --no-mmap \
+    $MMAP_FLAG \
     --memory-f32 \
     --temp "$TEMPERATURE" \
     --top-p 0.9 > "$CACHE_OUTPUT" 2>>"$LOG_FILE"
@@ -143,7 +151,7 @@ $LLAMACPP_PATH/build/bin/main \
   --load-kv-cache "$FIRST_CACHE" \
   --ctx-size "$MAX_CONTEXT" \
   --threads "$THREADS" \
-  --no-mmap \
+  $MMAP_FLAG \
   --memory-f32 \
   --temp "$TEMPERATURE" \
   --repeat-penalty 1.1 \
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark compressed KV cache storage for llama-cag-n8n
+
+This script compresses KV cache files with each available codec (zstd and
+lz4, as used by the bridge's cold storage) and reports the compression
+ratio, compression time and the throughput of restoring the file
+(decompressing from a cold page cache) against reading the raw file cold
+from disk.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+import logging
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'bridge'))
+from cold_storage import EXTENSIONS, codec_available, compress_file, decompress_file
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+def drop_page_cache(path):
+    """Evict a file from the page cache so the next read comes from disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def raw_read(path):
+    """Seconds to read a file from disk"""
+    drop_page_cache(path)
+    start = time.time()
+    with open(path, 'rb') as f:
+        while f.read(4 * 1024 * 1024):
+            pass
+    return time.time() - start
+
+def benchmark_codec(cache, codec, level, work_dir):
+    """Compress a cache, then restore it from a cold page cache"""
+    compressed = os.path.join(work_dir, os.path.basename(cache) + EXTENSIONS[codec])
+    restored = os.path.join(work_dir, os.path.basename(cache))
+    try:
+        start = time.time()
+        compressed_size = compress_file(cache, compressed, codec, level)
+        compress_s = time.time() - start
+
+        drop_page_cache(compressed)
+        start = time.time()
+        decompress_file(compressed, restored)
+        decompress_s = time.time() - start
+    finally:
+        for path in (compressed, restored):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    return compressed_size, compress_s, decompress_s
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description='Benchmark compressed KV cache storage')
+    parser.add_argument('caches', nargs='+', help='KV cache files to compress')
+    parser.add_argument('--codecs', default='zstd,lz4', help='Comma-separated codecs to try')
+    parser.add_argument('--zstd-level', type=int, default=3, help='zstd compression level')
+    parser.add_argument('--lz4-level', type=int, default=0, help='lz4 compression level')
+    parser.add_argument('--work-dir', help='Where compressed copies are written (default: next to each cache)')
+    parser.add_argument('--runs', type=int, default=1, help='Runs per cache and codec')
+    parser.add_argument('--json', action='store_true', help='Output in JSON format')
+
+    args = parser.parse_args()
+
+    codecs = [c.strip() for c in args.codecs.split(',') if c.strip()]
+    for codec in codecs:
+        if codec not in EXTENSIONS:
+            logging.error(f"Unknown codec: {codec}")
+            sys.exit(1)
+        if not codec_available(codec):
+            logging.warning(f"Skipping {codec}: install {'zstandard' if codec == 'zstd' else 'lz4'} to benchmark it")
+    codecs = [c for c in codecs if codec_available(c)]
+    if not codecs:
+        logging.error("No compression codec is installed")
+        sys.exit(1)
+
+    results = []
+    for cache in args.caches:
+        if not os.path.isfile(cache):
+            logging.error(f"KV cache not found: {cache}")
+            sys.exit(1)
+        size = os.path.getsize(cache)
+        size_mb = size / (1024 * 1024)
+        work_dir = args.work_dir or os.path.dirname(os.path.abspath(cache))
+
+        for run in range(args.runs):
+            logging.info(f"{os.path.basename(cache)}: raw read, run {run + 1}/{args.runs}")
+            read_s = raw_read(cache)
+            results.append({'cache': cache, 'codec': 'raw', 'level': None, 'size_mb': round(size_mb, 1),
+                            'ratio': 1.0, 'compress_s': None, 'load_s': round(read_s, 3),
+                            'load_mb_s': round(size_mb / read_s, 1) if read_s else None})
+
+            for codec in codecs:
+                level = args.zstd_level if codec == 'zstd' else args.lz4_level
+                logging.info(f"{os.path.basename(cache)}: {codec} level {level}, run {run + 1}/{args.runs}")
+                with tempfile.TemporaryDirectory(dir=work_dir) as scratch:
+                    compressed_size, compress_s, decompress_s = benchmark_codec(cache, codec, level, scratch)
+                results.append({'cache': cache, 'codec': codec, 'level': level, 'size_mb': round(size_mb, 1),
+                                'ratio': round(size / compressed_size, 2) if compressed_size else None,
+                                'compress_s': round(compress_s, 3), 'load_s': round(decompress_s, 3),
+                                'load_mb_s': round(size_mb / decompress_s, 1) if decompress_s else None})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'Cache':30} {'Codec':6} {'Size (MB)':>10} {'Ratio':>6} {'Compress (s)':>13} "
+              f"{'Load (s)':>9} {'Load MB/s':>10}")
+        print("-" * 90)
+        for r in results:
+            compress = f"{r['compress_s']:.2f}" if r['compress_s'] is not None else '-'
+            print(f"{os.path.basename(r['cache'])[:30]:30} {r['codec']:6} {r['size_mb']:10.1f} "
+                  f"{r['ratio']:6.2f} {compress:>13} {r['load_s']:9.2f} {r['load_mb_s'] or 0:10.1f}")
+        print("-" * 90)
+        print("Load is a cold raw read for 'raw' and a cold-cache streaming restore to disk for codecs")
+
+if __name__ == "__main__":
+    main()
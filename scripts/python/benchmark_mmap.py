@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Benchmark mmap vs. --no-mmap loading for llama-cag-n8n
+
+This script runs concurrent llama.cpp queries against a KV cache with the
+model memory-mapped and with --no-mmap, cold (page cache dropped for the
+model and cache files) and warm, and reports wall time, model load time and
+peak resident / proportional / private memory per process.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+import logging
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'bridge'))
+from timings import parse_llama_timings
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+def load_env():
+    """Load environment variables from .env file"""
+    env_vars = {}
+    env_path = Path('.env')
+    
+    if not env_path.exists():
+        env_path = Path('../.env')
+    
+    if not env_path.exists():
+        logging.warning("No .env file found. Using default paths.")
+        return {
+            'LLAMACPP_PATH': os.path.expanduser('~/llama.cpp')
+        }
+    
+    with open(env_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#') and '=' in line:
+                key, value = line.split('=', 1)
+                env_vars[key] = value.strip('"\'')
+    
+    return env_vars
+
+def drop_page_cache(path):
+    """Evict a file from the page cache so the next read comes from disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def read_memory(pid):
+    """Return Rss, Pss and private memory of a process in kB from smaps_rollup"""
+    memory = {'rss_kb': 0, 'pss_kb': 0, 'private_kb': 0}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            for line in f:
+                name, _, rest = line.partition(':')
+                value = rest.split()
+                if not value or not value[0].isdigit():
+                    continue
+                if name == 'Rss':
+                    memory['rss_kb'] = int(value[0])
+                elif name == 'Pss':
+                    memory['pss_kb'] = int(value[0])
+                elif name in ('Private_Clean', 'Private_Dirty'):
+                    memory['private_kb'] += int(value[0])
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        pass
+    return memory
+
+def run_query(llama_bin, model, cache, prompt_file, threads, ctx_size, use_mmap):
+    """Run one query process and return its wall time, load time and peak memory"""
+    command = [
+        llama_bin,
+        '-m', model,
+        '--load-kv-cache', cache,
+        '-f', prompt_file,
+        '-n', '16',
+        '--ctx-size', str(ctx_size),
+        '--threads', str(threads),
+        '--temp', '0',
+    ]
+    if not use_mmap:
+        command.append('--no-mmap')
+    
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    peak = {'rss_kb': 0, 'pss_kb': 0, 'private_kb': 0}
+    
+    def sample():
+        while process.poll() is None:
+            memory = read_memory(process.pid)
+            for key, value in memory.items():
+                peak[key] = max(peak[key], value)
+            time.sleep(0.05)
+    
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    _, stderr = process.communicate()
+    sampler.join()
+    
+    return {
+        'returncode': process.returncode,
+        'wall_s': round(time.time() - start, 3),
+        'load_ms': parse_llama_timings(stderr)['load_ms'],
+        **peak
+    }
+
+def run_round(args, use_mmap, cold, prompt_file):
+    """Run `concurrency` queries at once and summarise them"""
+    if cold:
+        drop_page_cache(args.model)
+        drop_page_cache(args.cache)
+    
+    results = [None] * args.concurrency
+    
+    def worker(i):
+        results[i] = run_query(args.llama_bin, args.model, args.cache, prompt_file,
+                               args.threads, args.ctx_size, use_mmap)
+    
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    load_times = [r['load_ms'] for r in results if r['load_ms'] is not None]
+    return {
+        'mmap': use_mmap,
+        'cold': cold,
+        'round_wall_s': round(time.time() - start, 3),
+        'failed': sum(1 for r in results if r['returncode'] != 0),
+        'mean_wall_s': round(sum(r['wall_s'] for r in results) / len(results), 3),
+        'mean_load_ms': round(sum(load_times) / len(load_times), 1) if load_times else None,
+        'peak_rss_mb': round(max(r['rss_kb'] for r in results) / 1024, 1),
+        'total_pss_mb': round(sum(r['pss_kb'] for r in results) / 1024, 1),
+        'total_private_mb': round(sum(r['private_kb'] for r in results) / 1024, 1),
+    }
+
+def main():
+    """Main function"""
+    env_vars = load_env()
+    llamacpp_path = os.path.expanduser(env_vars.get('LLAMACPP_PATH', '~/llama.cpp'))
+    
+    parser = argparse.ArgumentParser(description='Benchmark mmap vs. --no-mmap model loading')
+    parser.add_argument('--model', default=env_vars.get('LLAMACPP_MODEL_PATH'), help='Path to the GGUF model')
+    parser.add_argument('--cache', required=True, help='KV cache file to query')
+    parser.add_argument('--llama-bin', default=os.path.join(llamacpp_path, 'build/bin/main'),
+                        help='llama.cpp main binary')
+    parser.add_argument('--runs', type=int, default=3, help='Rounds per mode')
+    parser.add_argument('--concurrency', type=int, default=2, help='Concurrent queries per round')
+    parser.add_argument('--threads', type=int, default=int(env_vars.get('LLAMACPP_THREADS', 4)),
+                        help='Threads per query process')
+    parser.add_argument('--ctx-size', type=int, default=int(env_vars.get('LLAMACPP_MAX_CONTEXT', 128000)),
+                        help='Context size per query process')
+    parser.add_argument('--prompt', default='Summarize the document in one sentence.', help='Query text')
+    parser.add_argument('--json', action='store_true', help='Output in JSON format')
+    
+    args = parser.parse_args()
+    
+    if not args.model or not os.path.isfile(args.model):
+        logging.error(f"Model not found: {args.model}")
+        sys.exit(1)
+    if not os.path.isfile(args.cache):
+        logging.error(f"KV cache not found: {args.cache}")
+        sys.exit(1)
+    
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write(args.prompt + '\n')
+        prompt_file = f.name
+    
+    rounds = []
+    try:
+        for use_mmap in (True, False):
+            for cold in (True, False):
+                for run in range(args.runs):
+                    logging.info(f"mmap={use_mmap} cold={cold} run {run + 1}/{args.runs}")
+                    rounds.append(run_round(args, use_mmap, cold, prompt_file))
+    finally:
+        os.unlink(prompt_file)
+    
+    if args.json:
+        print(json.dumps(rounds, indent=2))
+    else:
+        print(f"{'Mode':10} {'Cache':6} {'Round (s)':>10} {'Query (s)':>10} {'Load (ms)':>10} "
+              f"{'Peak RSS':>10} {'Sum PSS':>10} {'Private':>10}")
+        print("-" * 84)
+        for r in rounds:
+            mode = 'mmap' if r['mmap'] else 'no-mmap'
+            load = f"{r['mean_load_ms']:.1f}" if r['mean_load_ms'] is not None else '-'
+            print(f"{mode:10} {'cold' if r['cold'] else 'warm':6} {r['round_wall_s']:10.2f} "
+                  f"{r['mean_wall_s']:10.2f} {load:>10} {r['peak_rss_mb']:9.1f}M "
+                  f"{r['total_pss_mb']:9.1f}M {r['total_private_mb']:9.1f}M")
+    
+    sys.exit(0 if not any(r['failed'] for r in rounds) else 1)
+
+if __name__ == "__main__":
+    main()